@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+# Dispatch throughput benchmark.
+#
+# Runs a real OpenCenterAgent.dispatch() loop against the synthetic
+# input plugin in benchmarks/plugins/input and the bench output plugin
+# in benchmarks/plugins/output, and reports:
+#
+#   throughput   tasks reported per second, over the whole run
+#   latency      p50/p99 seconds from a task being emitted by the input
+#                plugin to its result being handed back
+#   service      p50/p99 seconds from fetch to result
+#   threads      peak thread count
+#   rss          peak resident set size, in KB
+#
+# Each run is compared with the last saved run of the same scenario on
+# the same machine in benchmarks/results.json, and --save adds it
+# there.  With --max-regression, a throughput drop or p99 latency rise
+# of more than that percentage fails the run.
+#
+# The numbers only mean anything against others from the same machine,
+# so results.json isn't checked in.  Save a baseline before making
+# changes, then compare against it:
+#
+#   git stash; python benchmarks/bench_dispatch.py --save; git stash pop
+#   python benchmarks/bench_dispatch.py --max-regression 10
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import thread
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(BENCH_DIR, 'results.json')
+
+CONFIG = """
+[main]
+base_dir = %(base_dir)s
+plugin_dir = %(base_dir)s/opencenteragent/plugins
+trans_log_dir = %(trans_log_dir)s
+log_config = %(log_config)s
+input_handlers = %(bench_dir)s/plugins/input/synthetic.py
+output_handlers = %(bench_dir)s/plugins/output/bench.py
+dispatch_workers = %(workers)d
+dispatch_queue = %(queue)d
+fetch_interval = 1
+
+[synthetic]
+tasks = %(tasks)d
+rate = %(rate)s
+action = bench.%(handler)s
+payload = %(payload)s
+"""
+
+LOG_CONFIG = """
+[loggers]
+keys=root
+
+[handlers]
+keys=stderr
+
+[formatters]
+keys=
+
+[logger_root]
+level=WARNING
+handlers=stderr
+
+[handler_stderr]
+class=StreamHandler
+level=NOTSET
+args=(sys.stderr,)
+"""
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def peak_rss():
+    # VmHWM is the high water mark of the resident set
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class Sampler(threading.Thread):
+    def __init__(self):
+        super(Sampler, self).__init__()
+        self.setDaemon(True)
+        self.threads = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.threads = max(self.threads, threading.active_count())
+            time.sleep(0.05)
+
+
+def run(options):
+    # run against the tree we're in, not an installed agent
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    from opencenteragent import OpenCenterAgent
+    from opencenteragent import utils
+
+    with utils.temporary_directory() as tmpdir:
+        trans_log_dir = os.path.join(tmpdir, 'trans_logs')
+        os.mkdir(trans_log_dir)
+        log_config = os.path.join(tmpdir, 'log.cfg')
+        with open(log_config, 'w') as f:
+            f.write(LOG_CONFIG)
+
+        payload = {}
+        if options.handler == 'delay':
+            payload['delay'] = options.delay
+
+        configfile = os.path.join(tmpdir, 'agent.conf')
+        with open(configfile, 'w') as f:
+            f.write(CONFIG % {'base_dir': os.path.dirname(BENCH_DIR),
+                              'bench_dir': BENCH_DIR,
+                              'trans_log_dir': trans_log_dir,
+                              'log_config': log_config,
+                              'workers': options.workers,
+                              'queue': options.queue,
+                              'tasks': options.tasks,
+                              'rate': options.rate,
+                              'handler': options.handler,
+                              'payload': json.dumps(payload)})
+
+        sampler = Sampler()
+        sampler.start()
+
+        start = time.time()
+        agent = OpenCenterAgent(['-c', configfile])
+        plugin = agent.input_handler.plugins['synthetic']
+
+        def _stop():
+            plugin['finished'].wait()
+            # the dispatch loop only stops for ^C
+            thread.interrupt_main()
+            agent.input_handler.wakeup.notify()
+
+        stopper = threading.Thread(target=_stop)
+        stopper.setDaemon(True)
+        stopper.start()
+
+        try:
+            agent.dispatch()
+        except SystemExit:
+            pass
+        elapsed = time.time() - start
+        sampler.running = False
+
+        reported = plugin['reported']
+        latency = [reported[x][0] - plugin['emitted'][x] for x in reported]
+        service = [reported[x][0] - plugin['fetched'][x] for x in reported]
+        failed = len([x for x in reported.values() if x[1] != 0])
+
+        return {'tasks': len(reported),
+                'failed': failed,
+                'elapsed': round(elapsed, 3),
+                'throughput': round(len(reported) / elapsed, 1),
+                'latency_p50': round(percentile(latency, 50), 4),
+                'latency_p99': round(percentile(latency, 99), 4),
+                'service_p50': round(percentile(service, 50), 4),
+                'service_p99': round(percentile(service, 99), 4),
+                'threads': sampler.threads,
+                'rss': peak_rss()}
+
+
+def machine():
+    # runs are only compared with others from the same machine
+    return '%s/%s/cpus=%d' % (platform.node(), platform.machine(),
+                              multiprocessing.cpu_count())
+
+
+def scenario(options):
+    return '%s/tasks=%d/rate=%g/workers=%d/queue=%d%s' % (
+        options.handler, options.tasks, options.rate, options.workers,
+        options.queue,
+        '/delay=%g' % options.delay if options.handler == 'delay' else '')
+
+
+def load_results():
+    if not os.path.exists(RESULTS):
+        return []
+    with open(RESULTS) as f:
+        return json.load(f)
+
+
+def compare(previous, result, max_regression):
+    """Print the change since the previous run.
+
+    :returns: False if the run regressed by more than max_regression
+              percent
+    """
+    ok = True
+    for key in ('throughput', 'latency_p50', 'latency_p99', 'service_p50',
+                'service_p99', 'threads', 'rss'):
+        old = previous['result'].get(key)
+        new = result.get(key)
+        if not old or new is None:
+            continue
+
+        change = 100.0 * (new - old) / old
+        print '  %-12s %12s -> %-12s (%+.1f%%)' % (key, old, new, change)
+
+        if max_regression is None:
+            continue
+        if key == 'throughput' and change < -max_regression:
+            ok = False
+        if key == 'latency_p99' and change > max_regression:
+            ok = False
+    return ok
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--handler', default='noop',
+                      choices=['noop', 'delay', 'script'],
+                      help='bench output action to run (default noop)')
+    parser.add_option('--delay', type='float', default=0.01,
+                      help='seconds each task sleeps, for --handler delay')
+    parser.add_option('--tasks', type='int', default=1000)
+    parser.add_option('--rate', type='float', default=0,
+                      help='tasks emitted per second (0 for all at once)')
+    parser.add_option('--workers', type='int', default=8)
+    parser.add_option('--queue', type='int', default=64)
+    parser.add_option('--save', action='store_true',
+                      help='add this run to %s' % RESULTS)
+    parser.add_option('--max-regression', type='float', default=None,
+                      help='fail on a bigger percentage regression than '
+                      'this against the last saved run')
+    options, args = parser.parse_args()
+
+    name = scenario(options)
+    result = run(options)
+
+    print name
+    for key in sorted(result):
+        print '  %-12s %s' % (key, result[key])
+
+    host = machine()
+    results = load_results()
+    previous = [x for x in results if x['scenario'] == name and
+                x.get('machine') == host]
+    ok = True
+    if previous:
+        print 'compared with %s (%s):' % (previous[-1]['revision'],
+                                          previous[-1]['date'])
+        ok = compare(previous[-1], result, options.max_regression)
+
+    if options.save:
+        try:
+            revision = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=BENCH_DIR).strip()
+        except (OSError, subprocess.CalledProcessError):
+            revision = 'unknown'
+
+        results.append({'scenario': name,
+                        'machine': host,
+                        'revision': revision,
+                        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'result': result})
+        with open(RESULTS, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+
+    if not ok:
+        print 'regression of more than %s%%' % options.max_regression
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+# A stand-in OpenCenter API server for offline load tests.
+#
+# It keeps nodes, tasks, attrs, facts and adventures in memory and
+# serves the subset of the OpenCenter REST API the agent's plugins use
+# through opencenterclient:
+#
+#   GET/POST        /<collection>/
+#   GET/PUT/DELETE  /<collection>/<id>
+#   POST            /<collection>/filter     {"filter": "a = 1 and b = x"}
+#   POST            /nodes/whoami            {"hostname": ...} or
+#                                            {"node_id": ...}
+#   GET             /nodes/<id>/tasks        next pending task
+#   GET             /nodes/<id>/tasks_blocking  same, long-polling
+#   POST            /adventures/<id>/execute {"nodes": [...]}
+#
+# all under a configurable prefix (/admin by default).  Responses wrap
+# objects as {"node": {...}} or {"nodes": [...]}, like the real server.
+#
+# Every request can be delayed (--latency, --jitter, in milliseconds)
+# and a fraction of them failed with a 500 (--fail-rate).  Requests
+# carrying an "X-Load-Driver" header are the load test setting up work,
+# and are neither delayed, failed nor counted as agent traffic.
+#
+# GET /_stats (outside the prefix) returns request counts per route and
+# the completion time of every finished task.
+
+import BaseHTTPServer
+import SocketServer
+import json
+import optparse
+import random
+import re
+import threading
+import time
+
+COLLECTIONS = {'nodes': 'node',
+               'tasks': 'task',
+               'attrs': 'attr',
+               'facts': 'fact',
+               'adventures': 'adventure'}
+
+
+def _parse_value(value):
+    value = value.strip()
+    if value == 'None':
+        return None
+    if len(value) > 1 and value[0] in '"\'' and value[-1] == value[0]:
+        return value[1:-1]
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _matches(obj, expression):
+    # just enough of the filter language for "a.b = x and c = y"
+    for clause in re.split(r'\s+and\s+', expression.strip()):
+        key, value = clause.split('=', 1)
+        here = obj
+        for part in key.strip().split('.'):
+            here = here.get(part) if isinstance(here, dict) else None
+        if here != _parse_value(value):
+            return False
+    return True
+
+
+class FakeOpenCenter(object):
+    def __init__(self, latency=0, jitter=0, fail_rate=0, poll_timeout=5):
+        """
+        :param: latency:      milliseconds added to each request
+        :param: jitter:       up to this many more milliseconds, at random
+        :param: fail_rate:    fraction of requests to fail with a 500
+        :param: poll_timeout: seconds tasks_blocking waits for a task
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.poll_timeout = poll_timeout
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.data = dict([(c, {}) for c in COLLECTIONS])
+        self.next_id = 1
+        self.requests = {}
+        self.failures = 0
+        self.driver_requests = 0
+        self.completed = {}
+
+        self.workspace = self.create('nodes', {'name': 'workspace',
+                                               'facts': {'parent_id': None}})
+        self.create('adventures', {'name': 'noop',
+                                   'dsl': [], 'criteria': 'true'})
+
+    def create(self, collection, obj):
+        self.lock.acquire()
+        try:
+            obj = dict(obj)
+            obj['id'] = self.next_id
+            self.next_id += 1
+            if collection == 'nodes':
+                obj.setdefault('facts', {})
+                obj.setdefault('attrs', {})
+                obj.setdefault('task_id', None)
+            elif collection == 'tasks':
+                obj.setdefault('state', 'pending')
+                obj.setdefault('payload', {})
+                obj['submitted'] = time.time()
+            self.data[collection][obj['id']] = obj
+            self.changed.notify_all()
+            return dict(obj)
+        finally:
+            self.lock.release()
+
+    def list(self, collection):
+        """Copies of every object in a collection."""
+        self.lock.acquire()
+        try:
+            return [dict(obj) for obj in self.data[collection].values()]
+        finally:
+            self.lock.release()
+
+    def get(self, collection, oid):
+        self.lock.acquire()
+        try:
+            obj = self.data[collection].get(oid)
+            return None if obj is None else dict(obj)
+        finally:
+            self.lock.release()
+
+    def update(self, collection, oid, values):
+        self.lock.acquire()
+        try:
+            obj = self.data[collection].get(oid)
+            if obj is None:
+                return None
+            values = dict(values)
+            values.pop('id', None)
+            obj.update(values)
+            if collection == 'tasks' and values.get('state') == 'done' and \
+                    not oid in self.completed:
+                obj['completed'] = time.time()
+                self.completed[oid] = obj['completed'] - obj['submitted']
+            self.changed.notify_all()
+            return dict(obj)
+        finally:
+            self.lock.release()
+
+    def next_task(self, node_id, timeout=0):
+        """Hand out the next pending task for a node, as the server does."""
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            while True:
+                pending = [t for t in self.data['tasks'].values()
+                           if t['node_id'] == node_id and
+                           t['state'] == 'pending']
+                if pending:
+                    task = min(pending, key=lambda t: t['id'])
+                    task['state'] = 'delivered'
+                    return dict(task)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+        finally:
+            self.lock.release()
+
+    def whoami(self, body):
+        if 'node_id' in body:
+            node = self.get('nodes', int(body['node_id']))
+            if node is None:
+                return 404, {'message': 'no such node'}
+            return 200, {'node': node}
+
+        hostname = body.get('hostname')
+        for node in self.list('nodes'):
+            if node['name'] == hostname:
+                return 200, {'node_id': node['id']}
+        node = self.create('nodes', {
+            'name': hostname,
+            'facts': {'parent_id': self.workspace['id'],
+                      'backends': ['node', 'agent']}})
+        return 200, {'node_id': node['id']}
+
+    def count(self, method, route):
+        self.lock.acquire()
+        key = '%s %s' % (method, route)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'requests': dict(self.requests),
+                    'failures': self.failures,
+                    'driver_requests': self.driver_requests,
+                    'completed': dict(self.completed)}
+        finally:
+            self.lock.release()
+
+    def handle(self, method, path, body):
+        """Route a request.
+
+        :returns: (status, response body, route) -- the route is the
+                  path with ids replaced, for counting
+        """
+        parts = [x for x in path.split('?')[0].split('/') if x]
+        if not parts or not parts[0] in COLLECTIONS:
+            return 404, {'message': 'not found'}, path
+
+        collection = parts[0]
+        singular = COLLECTIONS[collection]
+
+        if len(parts) == 1:
+            route = '/%s/' % collection
+            if method == 'GET':
+                return 200, {collection: self.list(collection)}, route
+            if method == 'POST':
+                return 201, {singular: self.create(collection, body)}, route
+
+        elif parts[1] == 'filter' and method == 'POST':
+            found = [o for o in self.list(collection)
+                     if _matches(o, body.get('filter', ''))]
+            return 200, {collection: found}, '/%s/filter' % collection
+
+        elif parts[1] == 'whoami' and collection == 'nodes':
+            status, response = self.whoami(body)
+            return status, response, '/nodes/whoami'
+
+        elif parts[1].isdigit():
+            oid = int(parts[1])
+            route = '/%s/<id>' % collection
+            if len(parts) == 2:
+                obj = self.get(collection, oid)
+                if obj is None:
+                    return 404, {'message': 'not found'}, route
+                if method == 'GET':
+                    return 200, {singular: obj}, route
+                if method == 'PUT':
+                    return 200, {singular: self.update(collection, oid,
+                                                       body)}, route
+                if method == 'DELETE':
+                    self.lock.acquire()
+                    self.data[collection].pop(oid, None)
+                    self.lock.release()
+                    return 200, {'message': 'deleted'}, route
+
+            elif collection == 'nodes' and \
+                    parts[2] in ('tasks', 'tasks_blocking'):
+                timeout = 0
+                if parts[2] == 'tasks_blocking':
+                    timeout = self.poll_timeout
+                task = self.next_task(oid, timeout)
+                route = '/nodes/<id>/%s' % parts[2]
+                if task is None:
+                    return 404, {'message': 'no task found'}, route
+                return 200, {'task': task}, route
+
+            elif collection == 'adventures' and parts[2] == 'execute':
+                # the server hands adventures to its own adventurator
+                # node as an "adventurate" task
+                task = self.create('tasks', {
+                    'node_id': body.get('adventurator',
+                                        self.workspace['id']),
+                    'action': 'adventurate',
+                    'payload': {'adventure': oid,
+                                'nodes': body.get('nodes', [])}})
+                return 202, {'task': task}, '/adventures/<id>/execute'
+
+        return 405, {'message': 'not supported'}, path
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self, method):
+        fake = self.server.fake
+        prefix = self.server.prefix
+
+        if self.path == '/_stats':
+            return self._respond(200, fake.stats())
+
+        body = {}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self._respond(400, {'message': 'bad json'})
+
+        if not self.path.startswith(prefix):
+            return self._respond(404, {'message': 'not found'})
+        path = self.path[len(prefix):]
+
+        if self.headers.get('X-Load-Driver'):
+            fake.lock.acquire()
+            fake.driver_requests += 1
+            fake.lock.release()
+            status, response, route = fake.handle(method, path, body)
+            return self._respond(status, response)
+
+        if fake.latency or fake.jitter:
+            time.sleep((fake.latency + random.uniform(0, fake.jitter)) /
+                       1000.0)
+
+        if fake.fail_rate and random.random() < fake.fail_rate:
+            fake.lock.acquire()
+            fake.failures += 1
+            fake.lock.release()
+            return self._respond(500, {'message': 'injected failure'})
+
+        status, response, route = fake.handle(method, path, body)
+        fake.count(method, route)
+        self._respond(status, response)
+
+    def _respond(self, status, response):
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fake, host='127.0.0.1', port=0, prefix='/admin'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           RequestHandler)
+        self.fake = fake
+        self.prefix = prefix
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.server_address[0],
+                                   self.server_address[1], self.prefix)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--prefix', default='/admin')
+    parser.add_option('--latency', type='float', default=0,
+                      help='milliseconds added to each request')
+    parser.add_option('--jitter', type='float', default=0,
+                      help='up to this many more milliseconds')
+    parser.add_option('--fail-rate', type='float', default=0,
+                      help='fraction of requests to fail with a 500')
+    parser.add_option('--poll-timeout', type='float', default=5,
+                      help='seconds tasks_blocking waits for a task')
+    options, args = parser.parse_args()
+
+    fake = FakeOpenCenter(options.latency, options.jitter,
+                          options.fail_rate, options.poll_timeout)
+    server = FakeServer(fake, options.host, options.port, options.prefix)
+    print 'serving fake OpenCenter API at %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
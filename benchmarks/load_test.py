@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+# End-to-end load test against the fake OpenCenter server.
+#
+# Starts fake_server.py in-process, then starts --agents real agent
+# processes (opencenter-agent.py, with the task input plugin and the
+# bench output plugin), each registering as its own node.  Once they
+# have all registered, it queues --tasks tasks for each of them and
+# waits for the agents to mark them done, then reports:
+#
+#   tasks            tasks completed
+#   elapsed          seconds from queueing the first task to the last
+#                    completing
+#   throughput       tasks completed per second
+#   latency p50/p99  seconds from a task being queued to it being done
+#   calls/task       agent REST calls per completed task, and the
+#                    busiest routes
+#
+# The agents need opencenterclient installed.
+#
+#   python benchmarks/load_test.py --agents 10 --tasks 50 --latency 20
+
+import json
+import optparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib2
+
+from fake_server import FakeOpenCenter
+from fake_server import FakeServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+
+CONFIG = """
+[main]
+base_dir = %(base_dir)s
+plugin_dir = %(base_dir)s/opencenteragent/plugins
+trans_log_dir = %(agent_dir)s/trans_logs
+hostidfile = %(agent_dir)s/hostid
+log_config = %(log_config)s
+input_handlers = %(plugin_dir)s/input/task_input.py
+output_handlers = %(bench_dir)s/plugins/output/bench.py
+fetch_interval = 1
+
+[endpoints]
+admin = %(url)s
+
+[taskerator]
+hostname = load-agent-%(index)d
+"""
+
+LOG_CONFIG = """
+[loggers]
+keys=root
+
+[handlers]
+keys=stderr
+
+[formatters]
+keys=
+
+[logger_root]
+level=WARNING
+handlers=stderr
+
+[handler_stderr]
+class=StreamHandler
+level=NOTSET
+args=(sys.stderr,)
+"""
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def driver_request(url, method='GET', body=None):
+    request = urllib2.Request(url, json.dumps(body) if body else None,
+                              {'Content-Type': 'application/json',
+                               'X-Load-Driver': '1'})
+    request.get_method = lambda: method
+    return json.loads(urllib2.urlopen(request).read())
+
+
+def start_agents(count, url, workdir):
+    log_config = os.path.join(workdir, 'log.cfg')
+    with open(log_config, 'w') as f:
+        f.write(LOG_CONFIG)
+
+    agents = []
+    for index in range(count):
+        agent_dir = os.path.join(workdir, 'agent%d' % index)
+        os.makedirs(os.path.join(agent_dir, 'trans_logs'))
+        configfile = os.path.join(agent_dir, 'agent.conf')
+        with open(configfile, 'w') as f:
+            f.write(CONFIG % {'base_dir': BASE_DIR,
+                              'plugin_dir': os.path.join(
+                                  BASE_DIR, 'opencenteragent', 'plugins'),
+                              'bench_dir': BENCH_DIR,
+                              'agent_dir': agent_dir,
+                              'log_config': log_config,
+                              'url': url,
+                              'index': index})
+        agents.append(subprocess.Popen(
+            [sys.executable, os.path.join(BASE_DIR, 'opencenter-agent.py'),
+             '-c', configfile], cwd=BASE_DIR))
+    return agents
+
+
+def wait_for(predicate, timeout, what):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise RuntimeError('timed out waiting for %s' % what)
+        time.sleep(0.1)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--agents', type='int', default=4)
+    parser.add_option('--tasks', type='int', default=25,
+                      help='tasks per agent')
+    parser.add_option('--action', default='bench.noop')
+    parser.add_option('--latency', type='float', default=0,
+                      help='milliseconds added to each API request')
+    parser.add_option('--jitter', type='float', default=0)
+    parser.add_option('--fail-rate', type='float', default=0,
+                      help='fraction of agent API requests to fail')
+    parser.add_option('--timeout', type='float', default=300,
+                      help='seconds to wait for the tasks to finish')
+    options, args = parser.parse_args()
+
+    try:
+        import opencenterclient
+    except ImportError:
+        parser.error('the agents need opencenterclient installed')
+
+    sys.path.insert(0, BASE_DIR)
+    from opencenteragent import utils
+
+    fake = FakeOpenCenter(options.latency, options.jitter,
+                          options.fail_rate)
+    server = FakeServer(fake)
+    server.start()
+
+    agents = []
+    with utils.temporary_directory() as workdir:
+        try:
+            agents = start_agents(options.agents, server.url, workdir)
+
+            def _agent_nodes():
+                return [n['id'] for n in fake.list('nodes')
+                        if n['name'].startswith('load-agent-')]
+            wait_for(lambda: len(_agent_nodes()) == len(agents), 60,
+                     'agents to register')
+            nodes = _agent_nodes()
+
+            # let the start-up module list tasks drain before we count
+            time.sleep(2)
+            before = fake.stats()
+
+            start = time.time()
+            task_ids = []
+            for x in range(options.tasks):
+                for node_id in nodes:
+                    task = driver_request(
+                        '%s/tasks/' % server.url, 'POST',
+                        {'node_id': node_id, 'action': options.action,
+                         'payload': {}})
+                    task_ids.append(task['task']['id'])
+
+            def _completed():
+                completed = fake.stats()['completed']
+                return all([x in completed for x in task_ids])
+            wait_for(_completed, options.timeout, 'tasks to complete')
+            elapsed = time.time() - start
+        finally:
+            for agent in agents:
+                if agent.poll() is None:
+                    agent.send_signal(signal.SIGINT)
+            for agent in agents:
+                agent.wait()
+            server.stop()
+
+    after = fake.stats()
+    calls = dict([(k, v - before['requests'].get(k, 0))
+                  for k, v in after['requests'].items()])
+    latency = [after['completed'][x] for x in task_ids]
+
+    print 'agents       %d' % len(agents)
+    print 'tasks        %d' % len(task_ids)
+    print 'elapsed      %.3f' % elapsed
+    print 'throughput   %.1f' % (len(task_ids) / elapsed)
+    print 'latency p50  %.4f' % percentile(latency, 50)
+    print 'latency p99  %.4f' % percentile(latency, 99)
+    print 'failures     %d' % (after['failures'] - before['failures'])
+    print 'calls/task   %.2f' % (sum(calls.values()) /
+                                 float(len(task_ids)))
+    for route, count in sorted(calls.items(), key=lambda x: -x[1]):
+        if count:
+            print '  %-32s %.2f' % (route, count / float(len(task_ids)))
+
+
+if __name__ == '__main__':
+    main()
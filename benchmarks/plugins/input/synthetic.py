@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import json
+import threading
+import time
+
+# Synthetic input plugin for the dispatch benchmark.
+#
+# Emits "tasks" tasks for "action" at "rate" tasks a second (0 for
+# all at once), and records when each was emitted, fetched and
+# reported.  Configured from its own config section:
+#
+# [synthetic]
+# tasks = 1000
+# rate = 0
+# action = bench.noop
+# payload = {}
+
+name = 'synthetic'
+
+lock = threading.Lock()
+queue = []
+emitted = {}
+fetched = {}
+reported = {}
+finished = threading.Event()
+total = 0
+producer = None
+
+
+def _produce(count, rate, action, payload):
+    start = time.time()
+    for seq in range(count):
+        if rate:
+            delay = start + float(seq) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        task = {'id': seq + 1, 'action': action, 'payload': dict(payload)}
+        task['payload']['seq'] = seq
+
+        lock.acquire()
+        emitted[task['id']] = time.time()
+        queue.append(task)
+        lock.release()
+        wakeup()
+
+
+def setup(config={}):
+    global total, producer
+
+    total = int(config.get('tasks', 1000))
+    producer = threading.Thread(
+        target=_produce,
+        args=(total, float(config.get('rate', 0)),
+              config.get('action', 'bench.noop'),
+              json.loads(config.get('payload', '{}'))))
+    producer.setDaemon(True)
+    producer.start()
+
+
+def fetch():
+    lock.acquire()
+    try:
+        if not queue:
+            return {}
+        task = queue.pop(0)
+        fetched[task['id']] = time.time()
+        return task
+    finally:
+        lock.release()
+
+
+def depth():
+    return len(queue)
+
+
+def results(batch):
+    now = time.time()
+    lock.acquire()
+    try:
+        for input_data, output_data in batch:
+            reported[input_data['id']] = (now, output_data['result_code'])
+        done = len(reported) >= total
+    finally:
+        lock.release()
+
+    if done:
+        finished.set()
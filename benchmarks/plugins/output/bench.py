@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import os
+import time
+
+from bashscriptrunner import BashScriptRunner
+
+# Output actions for the dispatch benchmark.
+#
+# bench.noop   - returns straight away
+# bench.delay  - sleeps for payload "delay" seconds (fractions allowed)
+# bench.script - runs bench.sh through BashScriptRunner
+
+name = 'bench'
+
+script_path = [os.path.join(os.path.dirname(__file__), '..', '..',
+                            'scripts')]
+
+
+def setup(config={}):
+    register_action('bench.noop', handle_noop)
+    register_action('bench.delay', handle_delay)
+    register_action('bench.script', handle_script)
+
+
+def handle_noop(input_data):
+    return {'result_code': 0,
+            'result_str': 'success',
+            'result_data': {}}
+
+
+def handle_delay(input_data):
+    time.sleep(float(input_data['payload'].get('delay', 0)))
+    return handle_noop(input_data)
+
+
+def handle_script(input_data):
+    runner = BashScriptRunner(script_path=script_path, log=LOG)
+    return runner.run_env('bench.sh', input_data['payload'], 'BENCH')
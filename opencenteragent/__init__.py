@@ -24,11 +24,14 @@
 ##############################################################################
 #
 
+import errno
 import fcntl
 import getopt
+import hashlib
 import json
 import logging
 import logging.config
+import marshal
 import os
 import signal
 import socket
@@ -36,25 +39,51 @@ import sys
 import time
 import traceback
 
+from functools import partial
+from threading import Lock
 from threading import Thread
 
 from ConfigParser import ConfigParser
+from ConfigParser import RawConfigParser
 
 from opencenteragent import exceptions
+from opencenteragent.journal import Journal
+from opencenteragent.metrics import registry
+from opencenteragent.metrics import StatsServer
 from opencenteragent.modules import OutputManager
 from opencenteragent.modules import InputManager
+from opencenteragent import tracing
+from opencenteragent import translog
+from opencenteragent.pool import DispatchPool
+from opencenteragent.utils import boolean
 from opencenteragent.utils import detailed_exception
+from opencenteragent.utils import trans_log_path
+from opencenteragent.watchdog import Watchdog
+
+# main config options that can't be changed by a reload on SIGHUP
+RESTART_OPTIONS = ['base_dir', 'plugin_dir', 'input_handlers',
+                   'output_handlers', 'enforce_timeouts', 'journal',
+                   'journal_file', 'journal_sync_interval',
+                   'journal_compact_after', 'stats_socket', 'pidfile',
+                   'cache_dir', 'lazy_load', 'setup_threads',
+                   'trans_log_janitor_interval', 'trans_log_compress_after',
+                   'trans_log_max_age', 'trans_log_max_size']
 
 
 class OpenCenterAgentDispatchWorker(Thread):
-    def __init__(self, input_handler, output_handler, data):
+    def __init__(self, input_handler, output_handler, watchdog, pool):
         super(OpenCenterAgentDispatchWorker, self).__init__()
 
-        self.data = data
+        self.pool = pool
+        self.watchdog = watchdog
         self.output_handler = output_handler
         self.input_handler = input_handler
         self.logger = logging.getLogger('opencenter-agent.dispatch')
 
+        # whether a timed out task has given its slot back yet
+        self.lock = Lock()
+        self.released = False
+
     # apparently signals can only be set in python on the mainline thread.
     # they are already blocked on threads and only handled in mainline.
     #
@@ -63,19 +92,61 @@ class OpenCenterAgentDispatchWorker(Thread):
     #     signal.signal(signal.SIGINT, signal.SIG_IGN) # Workers should ignore
 
     def run(self):
-        data = self.data
-        input_handler = self.input_handler
-        output_handler = self.output_handler
+        # self._worker_signals()
+
+        while True:
+            job = self.pool.get()
+            if job is None:
+                break
+
+            data, limits, key = job
+            if not self.dispatch(data, limits, key):
+                # we hung, and the watchdog has already replaced us
+                break
 
-#        self._worker_signals()
+            if self.pool.forked():
+                # the handler forked, and this is the child
+                break
 
-        data['output'] = {'result_code': 255,
-                          'result_str': 'unknown error',
-                          'result_data': ''}
+        self.logger.debug('dispatch worker terminating')
 
+    def dispatch(self, data, limits, key=None):
+        """Run a task and pass the result back to the input handler.
+
+        :param: data:   the task, as returned from InputManager.fetch()
+        :param: limits: the pool concurrency caps the task holds
+        :param: key:    the pool coalescing key for the task, if any
+
+        :returns: False if the watchdog timed the task out first, in
+                  which case the result has been discarded
+        """
+        input_handler = self.input_handler
+        output_handler = self.output_handler
+        action = data['input'].get('action')
+
+        trace = data.setdefault('trace', tracing.Trace())
+        if 'queued_at' in data:
+            now = time.time()
+            trace.add('queue', data['queued_at'], now)
+            registry.observe('queue.wait', now - data['queued_at'],
+                             key=action)
+
+        output = {'result_code': 255,
+                  'result_str': 'unknown error',
+                  'result_data': ''}
+
+        watch = None
+        timeout = output_handler.timeout(action)
+        if self.watchdog and timeout:
+            watch = self.watchdog.watch(
+                timeout, partial(self._expire, data, limits, key, timeout))
+
+        registry.gauge('tasks.inflight', 1)
+        tracing.begin(trace)
+        start = time.time()
         try:
             self.logger.debug('sending input data to output handler')
-            data['output'] = output_handler.dispatch(data['input'])
+            output = output_handler.dispatch(data['input'])
             self.logger.debug('got return from output handler')
 
         except KeyboardInterrupt:
@@ -84,14 +155,96 @@ class OpenCenterAgentDispatchWorker(Thread):
         except Exception as e:
             etext = detailed_exception()
             self.logger.debug('exception in output handler: %s' % etext)
-            data['output'] = {'result_code': 254,
-                              'result_str': 'dispatch error',
-                              'result_data': etext}
+            registry.incr('dispatch.errors', key=action)
+            output = {'result_code': 254,
+                      'result_str': 'dispatch error',
+                      'result_data': etext}
+
+        finally:
+            trace.add('dispatch', start, time.time())
+            tracing.end()
+            registry.gauge('tasks.inflight', -1)
+
+        if watch is not None and not self.watchdog.release(watch):
+            self.logger.warning('discarding result of timed out task')
+            self._release(limits)
+            self.pool.returned(self)
+            return False
+
+        # copy rather than add to the handler's dicts, which it may
+        # hand out more than once
+        if isinstance(output.get('result_data'), dict):
+            output = dict(output)
+            output['result_data'] = dict(output['result_data'],
+                                         trace=trace.summary())
+        trace.write()
 
-        self.logger.debug(
-            'passing output handler result back to input handler')
-        input_handler.result(data)
-        self.logger.debug('dispatch handler terminating')
+        try:
+            self.logger.debug(
+                'passing output handler result back to input handler')
+            self._report(data, output, key)
+            self.logger.debug('dispatch handler finished')
+        finally:
+            self.pool.done(limits)
+
+        return True
+
+    def _report(self, data, output, key):
+        # identical tasks that arrived while this one was queued were
+        # coalesced onto it, and get the same result
+        followers = self.pool.detach(key)
+        data['output'] = output
+        self.input_handler.result(data)
+
+        for follower in followers:
+            self.logger.debug('sending coalesced result to task %s' %
+                              follower['input'].get('id'))
+            self._point_to(follower, data)
+            follower['output'] = dict(output)
+            self.input_handler.result(follower)
+
+    def _point_to(self, follower, data):
+        # a coalesced task's log just says where to look instead
+        trace = follower.get('trace')
+        if trace is None or trace.logfile is None:
+            return
+
+        leader = data.get('trace')
+        where = 'its log was not kept'
+        if leader is not None and leader.logfile is not None:
+            where = 'see %s' % leader.logfile
+        translog.writer.begin(trace.logfile)
+        translog.writer.write(trace.logfile,
+                              'coalesced with task %s, %s\n' %
+                              (data['input'].get('id'), where))
+        translog.writer.close(trace.logfile)
+
+    def _expire(self, data, limits, key, timeout):
+        # called from the watchdog thread while we're still stuck in
+        # the handler.  report the timeout and give our slot away.
+        output = {'result_code': 252,
+                  'result_str': 'action timed out after %s seconds' % timeout,
+                  'result_data': ''}
+        registry.incr('dispatch.timeouts', key=data['input'].get('action'))
+
+        trace = data.get('trace')
+        if trace is not None and trace.logfile is not None:
+            translog.spill(trace.logfile, 'timeout')
+
+        self.pool.replace(self)
+        self._report(dict(data), output, key)
+
+        # the task keeps its slot and concurrency caps until it comes
+        # back, or its scripts have had kill_grace to die
+        self.watchdog.later(self.watchdog.kill_grace,
+                            partial(self._release, limits))
+
+    def _release(self, limits):
+        self.lock.acquire()
+        released, self.released = self.released, True
+        self.lock.release()
+        if not released:
+            self.pool.done(limits)
 
 
 class OpenCenterAgent():
@@ -101,6 +254,15 @@ class OpenCenterAgent():
         self.config_section = config_section
         self.input_handler = None
         self.output_handler = None
+        self.pool = None
+        self.watchdog = None
+        self.journal = None
+        self.stats_server = None
+        self.janitor = None
+        self.configfile = None
+        # merged configuration is cached here, if set (--config-cache)
+        self.config_cache_dir = None
+        self.reload_pending = False
         self.logger = logging.getLogger()
         self.logger.addHandler(logging.StreamHandler(sys.stderr))
         self.config = {config_section: {}}
@@ -156,6 +318,19 @@ class OpenCenterAgent():
         output_handler = self.output_handler
         input_handler = self.input_handler
 
+        if self.stats_server:
+            self.stats_server.stop()
+
+        if self.janitor:
+            self.janitor.stop()
+
+        if self.pool:
+            self.logger.debug('Stopping dispatch pool.')
+            self.pool.stop()
+
+        if self.watchdog:
+            self.watchdog.stop()
+
         if input_handler:
             self.logger.debug('Stopping input handler.')
             try:
@@ -163,6 +338,13 @@ class OpenCenterAgent():
             except:
                 pass
 
+        # after the input handler, which reports any last results
+        if self.journal:
+            try:
+                self.journal.close()
+            except:
+                pass
+
         if output_handler:
             self.logger.debug('Stopping output handler.')
             try:
@@ -170,22 +352,27 @@ class OpenCenterAgent():
             except:
                 pass
 
+        # last, as everything above may still be writing task logs
+        translog.writer.stop()
+
     def _usage(self):
         """Print a usage message."""
 
         print """The following command line flags are supported:
 
-[-c|--config] <file>: use this config file
-[-v|--verbose]:       include if you want verbose logging
-[-d|--deamonize]:     if set then opencenter will run as a daemon"""
+[-c|--config] <file>:      use this config file
+[-C|--config-cache] <dir>: cache the merged config in this directory
+[-v|--verbose]:            include if you want verbose logging
+[-d|--deamonize]:          if set then opencenter will run as a daemon"""
 
     def _parse_opts(self, argv):
         background = debug = False
         configfile = None
 
         try:
-            opts, args = getopt.getopt(argv, 'c:vd',
-                                       ['config=', 'verbose', 'daemonize'])
+            opts, args = getopt.getopt(argv, 'c:C:vd',
+                                       ['config=', 'config-cache=',
+                                        'verbose', 'daemonize'])
         except getopt.GetoptError as err:
             print str(err)
             self._usage()
@@ -194,6 +381,8 @@ class OpenCenterAgent():
         for o, a in opts:
             if o in ('-c', '--config'):
                 configfile = a
+            elif o in ('-C', '--config-cache'):
+                self.config_cache_dir = a
             elif o in ('-v', '--verbose'):
                 debug = True
             elif o in ('-d', '--daemonize'):
@@ -218,6 +407,10 @@ class OpenCenterAgent():
     def _read_config(self, configfile, defaults=None):
         """Read a configuration file from disk.
 
+        The file is read along with everything it includes, each file
+        once, and the merged result is cached in config_cache_dir (if
+        set) until one of the files changes.
+
         :param: configfile: the path to a configuration file
         :para: defaults:    default configuration values as a dictionary
 
@@ -230,63 +423,151 @@ class OpenCenterAgent():
         if not defaults:
             defaults = {}
 
-        cp = ConfigParser(defaults=defaults)
+        cache_path = None
+        if self.config_cache_dir:
+            try:
+                os.makedirs(self.config_cache_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    self.logger.warning('Unable to create %s, not caching '
+                                        'configuration: %s' %
+                                        (self.config_cache_dir, str(e)))
+            if os.path.isdir(self.config_cache_dir):
+                cache_path = os.path.join(
+                    self.config_cache_dir, 'config-%s' % hashlib.sha1(
+                        os.path.abspath(configfile)).hexdigest())
+        else:
+            self.logger.info('Configuration caching is off (see '
+                             '--config-cache)')
+        key = json.dumps([self.config_section, defaults], sort_keys=True,
+                         default=repr)
+
+        config = self._read_config_cache(cache_path, key)
+        if config is None:
+            raw = {}
+            sources = []
+            self._read_config_file(configfile, raw, sources)
+
+            # interpolate once everything is merged, so later files
+            # can override values earlier ones refer to
+            cp = ConfigParser(defaults=dict(
+                [(k, v) for k, v in defaults.items()
+                 if not isinstance(v, dict)]))
+            for section in sorted(raw):
+                cp.add_section(section)
+                for option, value in raw[section].items():
+                    cp.set(section, option, value)
+            config = dict([[s, dict(cp.items(s))] for s in cp.sections()])
+            config.setdefault('main', {}).setdefault(
+                'hostidfile', '/etc/opencenter/hostid')
+
+            self._write_config_cache(cache_path, key, sources, config)
+
+        # merge in the read config into the exisiting config
+        for section in config:
+            if section in defaults:
+                defaults[section].update(config[section])
+            else:
+                defaults[section] = config[section]
+
+        # pass logging config off to logger
+        return defaults
+
+    def _read_config_file(self, configfile, raw, sources):
+        """Merge a configuration file and its includes into raw.
 
+        :param: raw:     uninterpolated values, by section
+        :param: sources: list of (path, stat) for the files and
+                         directories read, in order
+
+        :returns: the merged values for our own section from this file
+                  and everything it included
+        """
         if not os.path.exists(configfile):
             raise exceptions.FileNotFound(
                 'Configuraton file %s is missing' % configfile)
 
+        # stat before reading, so a change while we read isn't missed
+        st = os.stat(configfile)
+        cp = RawConfigParser()
         cp.read(configfile)
         if not cp.sections():
             raise exceptions.NoConfigFound(
                 'The configuration file %s appears to contain no configuration'
                 % configfile)
 
-        config = self.config = dict([[s, dict(cp.items(s))]
-                                     for s in cp.sections()])
-        config.setdefault('main', {})['hostidfile'] = '/etc/opencenter/hostid'
-        config_section = self.config_section
+        sources.append((configfile, st))
+        for section in cp.sections():
+            raw.setdefault(section, {}).update(cp.items(section))
+
+        own = {}
+        if cp.has_section(self.config_section):
+            own = dict(cp.items(self.config_section))
+
+        if 'include' in own:
+            # import and merge a single file
+            if not os.path.isfile(own['include']):
+                raise RuntimeError(
+                    'file %s: include directive %s is not a file' % (
+                        configfile, own['include']))
+            own.update(self._read_config_file(own['include'], raw, sources))
+
+        if 'include_dir' in own:
+            # import and merge a whole directory
+            include_dir = own['include_dir']
+            if not os.path.isdir(include_dir):
+                raise RuntimeError(
+                    'file %s: include_dir directive %s is not a directory'
+                    % (configfile, include_dir))
+
+            # files coming and going change the directory's mtime
+            sources.append((include_dir, os.stat(include_dir)))
+            for f in sorted(os.listdir(include_dir)):
+                if not f.endswith('.conf'):
+                    self.logger.info('Skipping file %s because it does '
+                                     'not end in .conf' % f)
+                else:
+                    own.update(self._read_config_file(
+                        os.path.join(include_dir, f), raw, sources))
 
-        if config_section in config:
-            if 'include' in config[config_section]:
-                # import and merge a single file
-                if not os.path.isfile(config[config_section]['include']):
-                    raise RuntimeError(
-                        'file %s: include directive %s is not a file' % (
-                            configfile,
-                            config[config_section]['include']))
-                config = self.config = self._read_config(
-                    config[config_section]['include'], defaults=config)
-
-            if 'include_dir' in config[config_section]:
-                # import and merge a whole directory
-                if not os.path.isdir(config[config_section]['include_dir']):
-                    raise RuntimeError(
-                        'file %s: include_dir directive %s is not a directory'
-                        % (configfile,
-                           config[config_section]['include_dir']))
-
-                for f in sorted(os.listdir(
-                        config[config_section]['include_dir'])):
-                    if not f.endswith('.conf'):
-                        self.logger.info('Skipping file %s because it does '
-                                         'not end in .conf' % f)
-                    else:
-                        import_file = os.path.join(
-                            config[config_section]['include_dir'],
-                            f)
-                        config = self.config = self._read_config(
-                            import_file, defaults=config)
+        return own
 
-        # merge in the read config into the exisiting config
-        for section in config:
-            if section in defaults:
-                defaults[section].update(config[section])
-            else:
-                defaults[section] = config[section]
+    def _read_config_cache(self, cache_path, key):
+        """The cached config, if none of the files it came from changed."""
+        if cache_path is None:
+            return None
 
-        # pass logging config off to logger
-        return defaults
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = marshal.load(f)
+            if cached['key'] != key:
+                return None
+            for path, mtime, size in cached['sources']:
+                st = os.stat(path)
+                if (st.st_mtime, st.st_size) != (mtime, size):
+                    return None
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                KeyError):
+            return None
+
+        self.logger.debug('Using cached configuration %s' % cache_path)
+        return cached['config']
+
+    def _write_config_cache(self, cache_path, key, sources, config):
+        if cache_path is None:
+            return
+
+        tmp = '%s.%d' % (cache_path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                marshal.dump({'key': key,
+                              'sources': [(path, st.st_mtime, st.st_size)
+                                          for path, st in sources],
+                              'config': config}, f)
+            os.rename(tmp, cache_path)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning('Unable to cache configuration in %s: %s'
+                                % (cache_path, str(e)))
 
     def _handle_pidfile(self):
         pidfile = open(self.config[self.config_section]['pidfile'], 'a+')
@@ -310,6 +591,7 @@ class OpenCenterAgent():
         config_section = self.config_section
         config = self.config
         if configfile:
+            self.configfile = configfile
             config = self.config = self._read_config(configfile, defaults={
                 'base_dir': self.base})
             self._configure_logs(config[config_section]['log_config'])
@@ -335,6 +617,87 @@ class OpenCenterAgent():
             if 'pidfile' in config[config_section]:
                 self._handle_pidfile()
 
+    def _hup(self, signum, frame):
+        # picked up by the dispatch loop
+        self.reload_pending = True
+        self.input_handler.wakeup.notify()
+
+    def _reload_config(self):
+        """Re-read the config file and apply any changes to it.
+
+        The config dict is updated in place, as the managers and
+        plugins all hold references to it.  Plugins whose sections
+        changed are reconfigured, and the dispatch pool is resized if
+        need be.
+        """
+        if not self.configfile:
+            self.logger.warning('Not started with a config file, '
+                                'nothing to reload')
+            return
+
+        self.logger.info('Reloading configuration from %s' % self.configfile)
+        try:
+            new = self._read_config(self.configfile, defaults={
+                'base_dir': self.base})
+        except Exception:
+            self.logger.error('Unable to reload configuration, keeping the '
+                              'old one: %s' % detailed_exception())
+            return
+
+        config = self.config
+        changed = sorted([section for section in set(config) | set(new)
+                          if config.get(section) != new.get(section)])
+        if not changed:
+            self.logger.info('Configuration unchanged')
+            return
+        self.logger.info('Configuration changed in: %s' % ', '.join(changed))
+
+        old_main = dict(config.get(self.config_section, {}))
+        for section in changed:
+            if not section in new:
+                del config[section]
+            elif isinstance(config.get(section), dict) and \
+                    isinstance(new[section], dict):
+                # never leave a section empty for someone to read
+                config[section].update(new[section])
+                for key in [k for k in config[section]
+                            if not k in new[section]]:
+                    del config[section][key]
+            else:
+                config[section] = new[section]
+
+        if self.config_section in changed:
+            self._reconfigure_main(old_main, config[self.config_section])
+
+        self.output_handler.reconfigure(changed)
+        self.input_handler.reconfigure(changed)
+
+    def _reconfigure_main(self, old, new):
+        changed = set([key for key in set(old) | set(new)
+                       if old.get(key) != new.get(key)])
+
+        if 'log_config' in changed and new.get('log_config'):
+            self._configure_logs(new['log_config'])
+
+        if 'dispatch_workers' in changed or 'dispatch_queue' in changed:
+            self.pool.resize(new.get('dispatch_workers', 8),
+                             new.get('dispatch_queue', 64))
+
+        if 'trans_log_max_open' in changed:
+            translog.writer.max_open = int(new.get('trans_log_max_open', 32))
+
+        if 'kill_grace' in changed and self.watchdog:
+            self.watchdog.kill_grace = int(new.get('kill_grace', 10))
+
+        if 'result_batch_window' in changed:
+            self.input_handler.reporter.window = float(
+                new.get('result_batch_window', 0.2))
+
+        restart = sorted(changed & set(RESTART_OPTIONS))
+        if restart:
+            self.logger.warning('Changes to %s need an agent restart' %
+                                ', '.join(restart))
+
     def _setup_handlers(self):
         config = self.config
         config_section = self.config_section
@@ -357,35 +720,157 @@ class OpenCenterAgent():
         input_handlers = config[config_section].get('input_handlers',
                                                     default_in)
 
+        # worker threads are only started once we begin dispatching
+        self.pool = DispatchPool(
+            config[config_section].get('dispatch_workers', 8),
+            config[config_section].get('dispatch_queue', 64))
+
         self.output_handler = OutputManager(
             [x.strip() for x in output_handlers.split(',')], config)
         self.input_handler = InputManager(
-            [x.strip() for x in input_handlers.split(',')], config)
+            [x.strip() for x in input_handlers.split(',')], config,
+            capacity=self.pool.stats)
+
+        registry.register_collector('pool', self.pool.stats)
+        registry.register_collector('input', self.input_handler.stats)
+
+        translog.writer.max_open = int(
+            config[config_section].get('trans_log_max_open', 32))
+        translog.writer.max_buffered = int(
+            config[config_section].get('trans_log_buffer', 1024)) * 1024
+        registry.register_collector('translog', translog.writer.stats)
+
+        if boolean(config[config_section].get('enforce_timeouts', True)):
+            self.watchdog = Watchdog(
+                int(config[config_section].get('kill_grace', 10)))
+
+        # the journal isn't opened until we start dispatching
+        if boolean(config[config_section].get('journal', True)):
+            trans_log_dir = config.get('main', {}).get('trans_log_dir',
+                                                       '/var/log/opencenter')
+            self.journal = Journal(
+                config[config_section].get(
+                    'journal_file',
+                    os.path.join(trans_log_dir, 'agent.journal')),
+                float(config[config_section].get('journal_sync_interval',
+                                                 1.0)),
+                int(config[config_section].get('journal_compact_after',
+                                               1000)))
+
+    def _start_janitor(self):
+        main = self.config[self.config_section]
+        compress_after = int(main.get('trans_log_compress_after', 3600))
+        max_age = int(main.get('trans_log_max_age', 0)) * 86400
+        max_size = int(main.get('trans_log_max_size', 0)) * 1024 * 1024
+        if not (compress_after or max_age or max_size):
+            return
+
+        self.janitor = translog.TransLogJanitor(
+            self.config.get('main', {}).get('trans_log_dir',
+                                            '/var/log/opencenter'),
+            int(main.get('trans_log_janitor_interval', 3600)),
+            compress_after, max_age, max_size)
+        self.janitor.start()
+
+    def _recover(self):
+        """Deal with tasks left in flight by the last run of the agent.
+
+        Tasks for idempotent actions are run again.  Anything else may
+        have been partly done, so it's reported back as failed rather
+        than being left "running" forever.
+        """
+        try:
+            tasks = self.input_handler.recover(self.journal)
+        except (IOError, OSError):
+            self.logger.error('Unable to open task journal %s, running '
+                              'without one: %s' % (self.journal.path,
+                                                   detailed_exception()))
+            self.journal = None
+            return
+
+        for task in tasks:
+            action = task['input'].get('action')
+            if self.output_handler.idempotent(action):
+                self.logger.info('Re-running interrupted task %s (%s)' %
+                                 (task['input'].get('id'), action))
+                self.pool.put(task, self.output_handler.limits(action),
+                              self.output_handler.coalesce_key(task['input']))
+            else:
+                self.logger.warning('Reporting interrupted task %s (%s) '
+                                    'as failed' % (task['input'].get('id'),
+                                                   action))
+                task['output'] = {'result_code': 251,
+                                  'result_str': 'task interrupted by agent '
+                                                'restart',
+                                  'result_data': ''}
+                self.input_handler.result(task)
 
     def dispatch(self):
         output_handler = self.output_handler
         input_handler = self.input_handler
+        pool = self.pool
+
+        if self.watchdog:
+            self.watchdog.start()
+
+        pool.start(partial(OpenCenterAgentDispatchWorker,
+                           input_handler, output_handler, self.watchdog))
+
+        if self.journal:
+            self._recover()
+
+        self._start_janitor()
+
+        stats_socket = self.config[self.config_section].get('stats_socket')
+        if stats_socket:
+            try:
+                self.stats_server = StatsServer(stats_socket)
+                self.stats_server.start()
+            except socket.error:
+                self.logger.error('Unable to serve stats on %s: %s' %
+                                  (stats_socket, detailed_exception()))
+
+        # fetch is non-blocking.  When nothing is ready we sleep until
+        # an input plugin calls wakeup(), falling back to polling for
+        # plugins that don't.
+        fetch_interval = float(self.config[self.config_section].get(
+            'fetch_interval', 5))
+
+        signal.signal(signal.SIGHUP, self._hup)
 
-        # we'll assume non-blocking.  we should negotiate this
-        # with the plugins, I suppose
         do_quit = False
         try:
             while not do_quit:
+                if self.reload_pending:
+                    self.reload_pending = False
+                    self._reload_config()
+                    fetch_interval = float(
+                        self.config[self.config_section].get(
+                            'fetch_interval', 5))
+
                 self.logger.debug('FETCH')
                 result = input_handler.fetch()
                 if len(result) == 0:
-                    time.sleep(5)
+                    input_handler.wait(fetch_interval)
                 else:
                     self.logger.debug('Got input from input handler "%s"'
                                       % (result['plugin']))
                     self.logger.debug('Data: %s' % result['input'])
 
-                    # Apply to the pool
-                    worker = OpenCenterAgentDispatchWorker(input_handler,
-                                                           output_handler,
-                                                           result)
-                    worker.setDaemon(True)
-                    worker.start()
+                    # Apply to the pool.  This blocks while the
+                    # pool's wait queue is full.
+                    action = result['input'].get('action')
+                    logfile = None
+                    if 'id' in result['input']:
+                        logfile = trans_log_path(self.config,
+                                                 result['input']['id'])
+                    result['trace'] = tracing.Trace(result.pop('spans', []),
+                                                    logfile)
+                    result['queued_at'] = time.time()
+                    pool.put(result, output_handler.limits(action),
+                             output_handler.coalesce_key(result['input']))
+                    registry.observe('dispatch.put_wait',
+                                     time.time() - result['queued_at'])
         except KeyboardInterrupt:
             self.logger.debug('Got keyboard interrupt.')
             self._exit(False)
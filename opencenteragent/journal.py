@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import json
+import logging
+import os
+import threading
+
+from opencenteragent.utils import Wakeup
+
+LOG = logging.getLogger('opencenter.journal')
+
+# The task journal is an append-only file of JSON records, one per
+# line, noting each task as it is fetched from an input plugin and
+# again once its result has been handed back.
+#
+# {"op": "intake", "id": 12, "plugin": "taskerator", "input": {...}}
+# {"op": "done", "id": 12}
+#
+# Any task with an intake record but no done record was in flight
+# when the agent last stopped.  open() returns those so the agent can
+# re-run or report them.
+#
+# Records are written straight through to the OS, so they survive the
+# agent itself crashing.  They are fsynced to disk in batches, at most
+# sync_interval seconds after being written, so a task completing
+# doesn't cost a disk flush.  Once compact_after tasks have finished
+# the file is rewritten with just the open ones.
+
+
+class Journal(threading.Thread):
+    def __init__(self, path, sync_interval=1.0, compact_after=1000):
+        super(Journal, self).__init__()
+        self.setDaemon(True)
+
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_after = max(1, compact_after)
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
+        self.stopping = Wakeup()
+        self.fd = None
+        self.entries = {}
+        self.next_id = 1
+        self.finished = 0
+        self.dirty = False
+        self.running = False
+
+    def open(self):
+        """Replay the journal and start accepting records.
+
+        :returns: a list of intake records for the tasks left unfinished
+                  by the last run, oldest first
+        """
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # most likely a write cut short by a crash
+                        LOG.warning('Skipping bad record at %s:%d' %
+                                    (self.path, lineno))
+                        continue
+
+                    if record['op'] == 'intake':
+                        entries[record['id']] = record
+                    elif record['op'] == 'done':
+                        entries.pop(record['id'], None)
+                    self.next_id = max(self.next_id, record['id'] + 1)
+        else:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        self.entries = entries
+
+        # start from a clean file holding only what we recovered
+        self._compact()
+
+        self.running = True
+        self.start()
+
+        return [entries[k] for k in sorted(entries)]
+
+    def intake(self, task):
+        """Record a task that's been fetched.
+
+        :param: task: the task, as returned from InputManager.fetch()
+
+        :returns: the journal id to close the task with
+        """
+        self.lock.acquire()
+        try:
+            record = {'op': 'intake',
+                      'id': self.next_id,
+                      'plugin': task['plugin'],
+                      'input': task['input']}
+            self.next_id += 1
+            self.entries[record['id']] = record
+            self._write(record)
+            return record['id']
+        finally:
+            self.lock.release()
+
+    def done(self, jid):
+        """Record that a task's result has been handed back."""
+        self.lock.acquire()
+        try:
+            if self.entries.pop(jid, None) is None:
+                return
+            self.finished += 1
+            self._write({'op': 'done', 'id': jid})
+        finally:
+            self.lock.release()
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        while line:
+            written = os.write(self.fd, line)
+            line = line[written:]
+        self.dirty = True
+        self.wakeup.notify()
+
+    def _compact(self):
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            for jid in sorted(self.entries):
+                f.write(json.dumps(self.entries[jid]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.finished = 0
+        self.dirty = False
+
+    def sync(self):
+        """Flush written records to disk, compacting if it's time."""
+        self.lock.acquire()
+        try:
+            if self.fd is None:
+                return
+            if self.finished >= self.compact_after:
+                LOG.debug('Compacting task journal (%d open)' %
+                          len(self.entries))
+                self._compact()
+            elif self.dirty:
+                os.fsync(self.fd)
+                self.dirty = False
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+
+            # let records written around the same time share a sync
+            if self.sync_interval and self.running:
+                self.stopping.wait(self.sync_interval)
+            try:
+                self.sync()
+            except (IOError, OSError):
+                LOG.exception('Error syncing task journal')
+
+    def close(self):
+        running = self.running
+        self.running = False
+        if running:
+            self.wakeup.notify()
+            self.stopping.notify()
+            self.join(5)
+
+        self.sync()
+        self.lock.acquire()
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.lock.release()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import BaseHTTPServer
+import SocketServer
+import bisect
+import errno
+import json
+import logging
+import os
+import threading
+
+from opencenteragent.utils import detailed_exception
+
+LOG = logging.getLogger('opencenter.metrics')
+
+# Agent metrics.
+#
+# Code anywhere in the agent can record into the shared registry:
+#
+# metrics.registry.incr('action.failures', key=action)
+# metrics.registry.observe('action.latency', seconds, key=action)
+# metrics.registry.gauge('tasks.inflight', +1)
+#
+# Counters only go up.  Gauges hold a current value and may be moved up
+# and down.  Histograms count observations into fixed buckets (upper
+# bounds, in seconds) so they can be summed across agents.  Each may
+# be split by a key -- usually an action or plugin name.
+#
+# Other components can register a collector, a function returning a
+# dict of their own stats, which is called each time a snapshot is
+# taken.
+#
+# Snapshots can be read with the built-in "agent.stats" action, or over
+# HTTP on a unix socket if "stats_socket" is set in the main config
+# section:
+#
+# curl --unix-socket /var/run/opencenter-agent.stats http://agent/stats
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': buckets}
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = {}
+
+    def _slot(self, table, name, key, default):
+        values = table.setdefault(name, {})
+        if not key in values:
+            values[key] = default()
+        return values
+
+    def incr(self, name, value=1, key=None):
+        """Add to a counter."""
+        self.lock.acquire()
+        try:
+            values = self._slot(self.counters, name, key, int)
+            values[key] += value
+        finally:
+            self.lock.release()
+
+    def gauge(self, name, delta, key=None):
+        """Move a gauge up or down."""
+        self.lock.acquire()
+        try:
+            values = self._slot(self.gauges, name, key, int)
+            values[key] += delta
+        finally:
+            self.lock.release()
+
+    def set_gauge(self, name, value, key=None):
+        """Set a gauge to a value."""
+        self.lock.acquire()
+        try:
+            values = self._slot(self.gauges, name, key, int)
+            values[key] = value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, key=None):
+        """Record an observation, usually a duration in seconds."""
+        self.lock.acquire()
+        try:
+            values = self._slot(self.histograms, name, key, Histogram)
+            values[key].observe(value)
+        finally:
+            self.lock.release()
+
+    def register_collector(self, name, fn):
+        """Include the dict returned by fn in snapshots, under name."""
+        self.lock.acquire()
+        self.collectors[name] = fn
+        self.lock.release()
+
+    def unregister_collector(self, name):
+        self.lock.acquire()
+        self.collectors.pop(name, None)
+        self.lock.release()
+
+    def snapshot(self):
+        """All current metrics, as a JSON-able dict."""
+        def _unkey(values, fn=lambda x: x):
+            # metrics that aren't split by key are reported bare
+            if values.keys() == [None]:
+                return fn(values[None])
+            return dict([(k, fn(v)) for k, v in values.items()])
+
+        self.lock.acquire()
+        try:
+            result = {
+                'counters': dict([(name, _unkey(values))
+                                  for name, values in self.counters.items()]),
+                'gauges': dict([(name, _unkey(values))
+                                for name, values in self.gauges.items()]),
+                'histograms': dict(
+                    [(name, _unkey(values, lambda h: h.snapshot()))
+                     for name, values in self.histograms.items()])}
+            collectors = self.collectors.items()
+        finally:
+            self.lock.release()
+
+        for name, fn in collectors:
+            try:
+                result[name] = fn()
+            except Exception:
+                LOG.error('Error collecting %s stats: %s' %
+                          (name, detailed_exception()))
+        return result
+
+    def reset(self):
+        self.lock.acquire()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock.release()
+
+
+registry = Registry()
+
+
+class StatsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not self.path.split('?')[0] in ('/', '/stats'):
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.registry.snapshot(), indent=2,
+                          sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return 'stats_socket'
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+class StatsServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serve registry snapshots as JSON over HTTP on a unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path, registry=registry):
+        self.path = path
+        self.registry = registry
+
+        # clear out a socket left behind by an earlier run
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               StatsRequestHandler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -26,9 +26,15 @@
 
 import os
 import logging
+import threading
+import time
 
 import manager
 
+from opencenteragent.metrics import registry
+from opencenteragent.utils import detailed_exception
+from opencenteragent.utils import Wakeup
+
 LOG = logging.getLogger('opencenter.input')
 
 # Input modules export a number of functions and attributes:
@@ -36,8 +42,11 @@ LOG = logging.getLogger('opencenter.input')
 # name = <string>
 # setup()                       # optional
 # teardown()                    # optional
+# reconfigure(config)           # optional (see manager.py)
 # fetch(blocking=False)         # blocking optional (see below)
 # result(transaction, result)   # optional
+# results(list)                 # optional
+# depth()                       # optional
 #
 # the "name" attribute is an optional "friendly name" for
 # logging purposes.  Default name is derived from file name.
@@ -84,37 +93,346 @@ LOG = logging.getLogger('opencenter.input')
 # well as a "result" dict (as returned from the output plugin).  If
 # the plugin has a need to update status, it can do so.
 #
+# Results are not passed back on the dispatch thread.  They're queued
+# and handed to the plugin from a reporter thread in batches, gathered
+# over "result_batch_window" seconds (from the main config section,
+# default 0.2).  A plugin that exports a "results" function is given
+# each batch in one call, as a list of (input, result) tuples;
+# otherwise "result" is called once per task.  Results from a child a
+# handler forked (agent_restart, say) are handed over straight away,
+# as the reporter thread doesn't exist in the child.
+#
+# A task may also include a "trace" list of [name, start, end] spans
+# timing what the plugin did to get it (claiming it from a server,
+# say).  The list is taken out of the task and added to its trace --
+# see tracing.py.
+#
+# The optional "depth" function returns the number of tasks the plugin
+# has queued and ready to be fetched.  It is only used for the
+# scheduling statistics.
+#
+# When several input plugins are loaded, fetches are shared between
+# them in proportion to their "weight" (set in each plugin's config
+# section, default 1).
+#
+# A "wakeup()" function is injected into each input plugin's namespace.
+# Plugins that queue work from a background thread should call it
+# whenever new work becomes available.  The dispatch loop sleeps until
+# some plugin calls wakeup(), so a plugin that never calls it will only
+# be polled every "fetch_interval" seconds (from the main config
+# section, default 5).
+#
+# A "capacity()" function is also injected.  It returns a dict
+# describing the dispatch pool ("workers", "busy", "queued",
+# "max_queued" and "available", the number of tasks that could start
+# right away), or None if the agent isn't dispatching through a pool.
+# Plugins that claim work from a shared source should avoid claiming
+# more than "available", leaving the rest for less busy agents.
+#
+# When the agent keeps a task journal, tasks that were in flight when
+# it last stopped are handed back through result() like any other,
+# with "recovered" set in their input.  The plugin may not remember
+# them, but should still pass the result on.
+#
+# A task is closed in the journal once its result has been handed to
+# the plugin.  A plugin that may hold results back to deliver later
+# (when its server is unreachable, say) should set
+# "defers_results = True", and call the injected "delivered(input)"
+# with each task's input once its result has actually gone out.  Until
+# then the task stays open in the journal, and is handed back again
+# after a restart.
+#
 
 
 class InputManager(manager.Manager):
-    def __init__(self, path, config={}):
+    def __init__(self, path, config={}, capacity=None):
         super(InputManager, self).__init__(path, config=config)
+        self.wakeup = Wakeup()
+        self.capacity_fn = capacity
+        self.exports['wakeup'] = self.wakeup.notify
+        self.exports['capacity'] = self.capacity
+        self.exports['delivered'] = self.delivered
+        self.fetch_lock = threading.Lock()
+        self.fetch_stats = {}
+        self.credit = {}
+        self.journal = None
+        # journal records of results plugins have yet to deliver, by
+        # the id() of the task's input, with the input itself
+        self.undelivered = {}
+        self.undelivered_lock = threading.Lock()
+        self.reporter = ResultReporter(
+            self, float(config.get('main', {}).get('result_batch_window',
+                                                   0.2)))
         self.load(path)
 
+    def capacity(self):
+        """Report how much more work the agent can take on, or None."""
+        if self.capacity_fn is None:
+            return None
+        return self.capacity_fn()
+
+    def delivered(self, input_data):
+        """Close the journal record of a task whose result went out."""
+        self.undelivered_lock.acquire()
+        entry = self.undelivered.pop(id(input_data), None)
+        self.undelivered_lock.release()
+
+        if entry is not None and self.journal:
+            self.journal.done(entry[1])
+
+    def wait(self, timeout=None):
+        """Block until an input plugin signals new work, or timeout."""
+        return self.wakeup.wait(timeout)
+
+    def recover(self, journal):
+        """Start journaling fetched tasks, replaying the journal first.
+
+        :param: journal: an unopened Journal
+
+        :returns: the tasks that were unfinished when the agent last
+                  stopped, in the form fetch() returns them
+        """
+        tasks = []
+        for record in journal.open():
+            if not record['plugin'] in self.plugins:
+                LOG.warning('Dropping journaled task %s for missing input '
+                            'plugin "%s"' % (record['input'].get('id'),
+                                             record['plugin']))
+                journal.done(record['id'])
+                continue
+
+            record['input']['recovered'] = True
+            tasks.append({'plugin': record['plugin'],
+                          'input': record['input'],
+                          'journal': record['id']})
+
+        self.journal = journal
+        return tasks
+
     def result(self, result):
-        input_data = result['input']
-        output_data = result['output']
-        plugin = result['plugin']
+        """Queue a finished task's result to go back to its plugin."""
+        result['finished_at'] = time.time()
+        self.reporter.put(result)
+
+    def report(self, batch):
+        """Pass a batch of finished task results back to their plugins."""
+        by_plugin = {}
+        for result in batch:
+            by_plugin.setdefault(result['plugin'], []).append(result)
+
+        for plugin, plugin_batch in by_plugin.items():
+            ns = self.plugins[plugin]
+            results = [(result['input'], result['output'])
+                       for result in plugin_batch]
+
+            # the plugin may call delivered() before it returns
+            if ns.get('defers_results'):
+                self.undelivered_lock.acquire()
+                for result in plugin_batch:
+                    if 'journal' in result:
+                        self.undelivered[id(result['input'])] = \
+                            (result['input'], result['journal'])
+                self.undelivered_lock.release()
+
+            start = time.time()
+            try:
+                if 'results' in ns:
+                    LOG.debug('sending %d result outcomes to plugin "%s"' %
+                              (len(results), plugin))
+                    ns['results'](results)
+                elif 'result' in ns:
+                    LOG.debug('sending result outcomes to plugin "%s"' %
+                              plugin)
+                    for input_data, output_data in results:
+                        ns['result'](input_data, output_data)
+            except Exception:
+                LOG.error('Error passing results to plugin "%s": %s' %
+                          (plugin, detailed_exception()))
+                registry.incr('input.report_errors', key=plugin)
+
+            end = time.time()
+            for result in plugin_batch:
+                if 'trace' in result:
+                    if 'finished_at' in result:
+                        result['trace'].add('report_wait',
+                                            result['finished_at'], start)
+                    result['trace'].add('report', start, end)
+                    result['trace'].write()
+
+        now = time.time()
+        for result in batch:
+            if 'finished_at' in result:
+                registry.observe('input.report_latency',
+                                 now - result['finished_at'],
+                                 key=result['plugin'])
 
-        if 'result' in self.plugins[plugin]:
-            LOG.debug('sending result outcome to plugin "%s"' % plugin)
-            self.plugins[plugin]['result'](input_data, output_data)
+        if self.journal:
+            for result in batch:
+                if 'journal' in result and \
+                        not self.plugins[result['plugin']].get(
+                            'defers_results'):
+                    self.journal.done(result['journal'])
+
+    def stop(self):
+        # get any outstanding results back before tearing plugins down
+        self.reporter.stop()
+        super(InputManager, self).stop()
+
+    def _weight(self, plugin):
+        try:
+            weight = int(self.config.get(plugin, {}).get('weight', 1))
+        except ValueError:
+            LOG.warning('Bad weight for input plugin "%s". Using 1.' % plugin)
+            weight = 1
+        return max(weight, 1)
+
+    def _stats_for(self, plugin):
+        return self.fetch_stats.setdefault(plugin, {'weight': 1,
+                                                    'served': 0,
+                                                    'depth': None,
+                                                    'ready_since': None,
+                                                    'wait_total': 0.0,
+                                                    'wait_max': 0.0})
+
+    def stats(self):
+        """Per-plugin scheduling counters.
+
+        :returns: a dict of plugin name to weight, tasks served, last
+                  reported queue depth, and total/max seconds a plugin
+                  with queued work waited to be served
+        """
+        self.fetch_lock.acquire()
+        try:
+            return dict([(plugin, dict([(k, v) for k, v in stats.items()
+                                        if k != 'ready_since']))
+                         for plugin, stats in self.fetch_stats.items()])
+        finally:
+            self.fetch_lock.release()
 
     def fetch(self):
-        # walk through all the different input managers and fetch the
-        # next input message.
+        # walk through the input plugins and fetch the next input
+        # message, using smooth weighted round-robin so that one busy
+        # plugin can't starve the others.
         #
-        # there is a possibility of starvation here if one plugin manages
-        # to get much more input than the other.  Probably could order the
-        # plugins by last valid response or something to keep one plugin
-        # from monopolizing the input queue.  In fact, FIXME
+        # every call, each plugin earns its weight in credit, and
+        # plugins are tried in order of credit.  the plugin that
+        # supplies a task pays back the total weight earned.  a plugin
+        # with nothing to give earns nothing that round and forfeits
+        # any credit, so an idle plugin can't bank credit and then
+        # monopolize the queue.
         #
-        for input_plugin in self.plugins:
-            if 'fetch' in self.plugins[input_plugin]:
-                fetch_result = self.plugins[input_plugin]['fetch']()
+        self.fetch_lock.acquire()
+        try:
+            now = time.time()
+            candidates = [p for p in self.plugins
+                          if 'fetch' in self.plugins[p]]
+            total = 0
+
+            for plugin in candidates:
+                stats = self._stats_for(plugin)
+                stats['weight'] = self._weight(plugin)
+                total += stats['weight']
+                self.credit[plugin] = self.credit.get(plugin, 0) + \
+                    stats['weight']
+
+                if 'depth' in self.plugins[plugin]:
+                    stats['depth'] = self.plugins[plugin]['depth']()
+                    if stats['depth'] and stats['ready_since'] is None:
+                        stats['ready_since'] = now
+
+            candidates.sort(key=lambda p: self.credit[p], reverse=True)
+
+            for plugin in candidates:
+                fetch_result = self.plugins[plugin]['fetch']()
                 if len(fetch_result):
-                    return {"plugin": self.plugins[input_plugin]['name'],
+                    self.credit[plugin] -= total
+
+                    stats = self.fetch_stats[plugin]
+                    stats['served'] += 1
+                    registry.incr('input.fetched', key=plugin)
+                    if stats['ready_since'] is not None:
+                        wait = now - stats['ready_since']
+                        stats['wait_total'] += wait
+                        stats['wait_max'] = max(stats['wait_max'], wait)
+                        stats['ready_since'] = None
+
+                    task = {"plugin": self.plugins[plugin]['name'],
                             "input": fetch_result}
+                    if 'trace' in fetch_result:
+                        task['spans'] = fetch_result.pop('trace')
+                    if self.journal:
+                        task['journal'] = self.journal.intake(task)
+                    return task
+
+                weight = self.fetch_stats[plugin]['weight']
+                self.credit[plugin] = min(self.credit[plugin] - weight, 0)
+                total -= weight
+
+            # otherwise, nothing
+            return {}
+        finally:
+            self.fetch_lock.release()
+
+
+class ResultReporter(threading.Thread):
+    """Hands finished task results back to input plugins in batches."""
+    def __init__(self, manager, window):
+        super(ResultReporter, self).__init__()
+        self.setDaemon(True)
+
+        self.manager = manager
+        self.window = window
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.wakeup = Wakeup()
+        self.stopping = Wakeup()
+        self.running = False
+
+    def put(self, result):
+        if os.getpid() != self.pid:
+            # a handler forked, and this thread didn't come with it.
+            # the child won't be around for long, so report now.
+            self.manager.report([result])
+            return
+
+        self.lock.acquire()
+        try:
+            if not self.running:
+                self.running = True
+                self.start()
+            self.pending.append(result)
+        finally:
+            self.lock.release()
+        self.wakeup.notify()
+
+    def flush(self):
+        self.lock.acquire()
+        batch = self.pending
+        self.pending = []
+        self.lock.release()
+
+        if batch:
+            self.manager.report(batch)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+
+            # give other tasks finishing around the same time a chance
+            # to join this batch
+            if self.window and self.running:
+                self.stopping.wait(self.window)
+            self.flush()
+
+    def stop(self):
+        self.lock.acquire()
+        running = self.running
+        self.running = False
+        self.lock.release()
 
-        # otherwise, nothing
-        return {}
+        if running:
+            self.wakeup.notify()
+            self.stopping.notify()
+            self.join(5)
+        self.flush()
@@ -24,17 +24,51 @@
 ##############################################################################
 #
 
+import hashlib
+import imp
 import logging
+import marshal
 import os
+import struct
+import sys
+import threading
+import time
 
 from functools import partial
 
+from opencenteragent.metrics import registry
+from opencenteragent.translog import TaskLogProxy
+from opencenteragent.utils import detailed_exception
+
 
 # Parent class for the input and output managers
+#
+# Plugins are compiled once and their code objects kept in
+# <cache_dir>/code (cache_dir from the main config section, if set),
+# so they don't have to be parsed again on each start or reload.  A
+# cached copy is used as long as the plugin file's mtime and size are
+# the same as when it was compiled.
+#
+# The plugins in a directory are loaded on up to "setup_threads"
+# threads at once (main config section, default 4), so one plugin with
+# a slow setup() doesn't hold up the rest.  How long each plugin took
+# to import and to set up is logged, and kept in the
+# plugin.import_time and plugin.setup_time metrics.  If one plugin fails
+# to set up, no more are started, the ones already set up are torn
+# down again, and the error is raised.
+#
+# When the agent's configuration is reloaded (on SIGHUP), plugins whose
+# config section changed have their optional reconfigure() function
+# called with the new section.  A plugin that depends on other
+# sections can list them in a "config_sections" attribute to be told
+# about changes to those too.
 
 
 LOG = logging.getLogger('opencenter.manager')
 
+# python magic number, plugin file mtime and size
+_CODE_HEADER = struct.Struct('<4sdQ')
+
 
 class Manager(object):
     def __init__(self, path, config={}):
@@ -44,45 +78,228 @@ class Manager(object):
         self.loaded_modules = ['modules']
         self.config = config
 
+        # extra names injected into every plugin namespace
+        self.exports = {}
+
+        # held while registering plugins and their actions, as
+        # plugins may be set up concurrently
+        self.load_lock = threading.RLock()
+
     def _load_directory(self, path):
         LOG.debug('Preparing to load modules in directory %s' % path)
-        dirlist = os.listdir(path)
-        for relpath in dirlist:
+        paths = []
+        for relpath in sorted(os.listdir(path)):
             p = os.path.join(path, relpath)
 
             if not os.path.isdir(p) and p.endswith('.py'):
-                self._load_file(p)
+                paths.append(p)
+
+        start = time.time()
+        self._load_files(paths)
+        LOG.info('Loaded %d plugin file(s) from %s in %.3fs' %
+                 (len(paths), path, time.time() - start))
+
+    def _load_files(self, paths):
+        workers = min(len(paths), int(self.config.get('main', {}).get(
+            'setup_threads', 4)))
+
+        pending = list(paths)
+        loaded = []
+        failures = []
+        lock = threading.Lock()
+        before = set(self.plugins)
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    # once one plugin has failed, don't start any more
+                    if not pending or failures:
+                        return
+                    path = pending.pop(0)
+                finally:
+                    lock.release()
+
+                try:
+                    ns = self._load_file(path)
+                except Exception:
+                    LOG.error('Error loading plugin %s: %s' %
+                              (path, detailed_exception()))
+                    lock.acquire()
+                    failures.append(sys.exc_info())
+                    lock.release()
+                else:
+                    lock.acquire()
+                    if ns is not None:
+                        loaded.append(ns)
+                    lock.release()
+
+        if workers <= 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker)
+                       for x in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if not failures:
+            return
+
+        for ns in reversed(loaded):
+            self._teardown_plugin(ns)
+        self.load_lock.acquire()
+        try:
+            for name in [x for x in self.plugins if not x in before]:
+                del self.plugins[name]
+                if name in self.loaded_modules:
+                    self.loaded_modules.remove(name)
+        finally:
+            self.load_lock.release()
+        raise failures[0][0], failures[0][1], failures[0][2]
 
     def _load_file(self, path):
+        ns = self._read_file(path)
+        if ns is None:
+            return
+
+        self.load_lock.acquire()
+        try:
+            if not ns['name'] in self.loaded_modules:
+                self.loaded_modules.append(ns['name'])
+            self.plugins[ns['name']] = ns
+        finally:
+            self.load_lock.release()
+        self._setup_plugin(ns)
+        return ns
+
+    def _read_file(self, path):
+        """Load a plugin file into a fresh namespace, without setting it up.
+
+        :returns: the plugin namespace, or None if it isn't a plugin
+        """
         shortpath = os.path.basename(path)
 
         # we can't really load this into the existing namespace --
         # we'll have registration collisions.
         ns = {'global_config': self.config,
-              'LOG': LOG}
+              'LOG': LOG,
+              '__file__': path}
         LOG.debug('Loading output plugin file %s' % shortpath)
-        execfile(path, ns)
+        start = time.time()
+        exec self._compile(path) in ns
 
         if not 'name' in ns:
             LOG.warning('Plugin missing "name" value. Ignoring.')
-            return
+            return None
 
         name = ns['name']
+        elapsed = time.time() - start
+        registry.set_gauge('plugin.import_time', elapsed, key=name)
+        LOG.info('Imported plugin %s in %.3fs' % (name, elapsed))
 
         # getChild is only available on python2.7
         # ns['LOG'] = ns['LOG'].getChild('output_%s' % name)
-        ns['LOG'] = logging.getLogger('%s.%s' % (ns['LOG'],
-                                                 'output_%s' % name))
+        ns['LOG'] = TaskLogProxy(logging.getLogger(
+            '%s.%s' % (ns['LOG'], 'output_%s' % name)))
         ns['register_action'] = partial(self.register_action, name, shortpath)
+        ns.update(self.exports)
+        return ns
+
+    def _compile(self, path):
+        """Compile a plugin file, using the code cache if possible.
+
+        :returns: the plugin's code object
+        """
+        st = os.stat(path)
+        header = _CODE_HEADER.pack(imp.get_magic(), st.st_mtime,
+                                   st.st_size)
+
+        cache_dir = self.config.get('main', {}).get('cache_dir')
+        if not cache_dir:
+            return self._compile_source(path)
+
+        cache_path = os.path.join(
+            cache_dir, 'code',
+            hashlib.sha1(os.path.abspath(path)).hexdigest() + '.pyc')
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            if data[:_CODE_HEADER.size] == header:
+                return marshal.loads(data[_CODE_HEADER.size:])
+        except (IOError, OSError):
+            pass
+        except (EOFError, ValueError, TypeError):
+            LOG.warning('Ignoring corrupt cached code for %s' % path)
+
+        code = self._compile_source(path)
+
+        tmp = '%s.%d' % (cache_path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            with open(tmp, 'wb') as f:
+                f.write(header + marshal.dumps(code))
+            os.rename(tmp, cache_path)
+        except (IOError, OSError) as e:
+            LOG.warning('Could not cache code for %s: %s' % (path, str(e)))
+        return code
 
-        self.loaded_modules.append(name)
-        self.plugins[name] = ns
-        config = self.config.get(name, {})
+    def _compile_source(self, path):
+        with open(path, 'rU') as f:
+            source = f.read()
+        # as execfile would, but without our own __future__ flags
+        return compile(source + '\n', path, 'exec', 0, True)
+
+    def _setup_plugin(self, ns):
+        config = self.config.get(ns['name'], {})
         ns['module_config'] = config
         if 'setup' in ns:
+            start = time.time()
             ns['setup'](config)
+            elapsed = time.time() - start
+            registry.set_gauge('plugin.setup_time', elapsed,
+                               key=ns['name'])
+            LOG.info('Set up plugin %s in %.3fs' % (ns['name'], elapsed))
         else:
-            LOG.warning('No setup function in %s. Ignoring.' % shortpath)
+            LOG.warning('No setup function in %s. Ignoring.' %
+                        os.path.basename(ns['__file__']))
+
+    def _teardown_plugin(self, ns):
+        if 'teardown' in ns:
+            try:
+                ns['teardown']()
+            except Exception:
+                LOG.error('Error tearing down plugin %s: %s' %
+                          (ns['name'], detailed_exception()))
+
+    def reconfigure(self, sections):
+        """Pass configuration changes on to the plugins they affect.
+
+        :param: sections: names of the config sections that changed
+        """
+        for name, ns in self.plugins.items():
+            wanted = [name] + list(ns.get('config_sections', []))
+            if not [x for x in wanted if x in sections]:
+                continue
+
+            ns['module_config'] = self.config.get(name, {})
+            self._reconfigure_plugin(ns)
+
+    def _reconfigure_plugin(self, ns):
+        name = ns['name']
+        if not 'reconfigure' in ns:
+            LOG.warning('Plugin %s can\'t be reconfigured, reload it or '
+                        'restart the agent to apply changes' % name)
+            return
+
+        LOG.info('Reconfiguring plugin %s' % name)
+        try:
+            ns['reconfigure'](ns['module_config'])
+        except Exception:
+            LOG.error('Error reconfiguring plugin %s: %s' %
+                      (name, detailed_exception()))
 
     def register_action(self, plugin, action, method,
                         constraints=[],
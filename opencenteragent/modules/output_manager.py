@@ -24,15 +24,34 @@
 ##############################################################################
 #
 
+import cProfile
+import cStringIO
+import errno
+import gzip
+import hashlib
+import json
 import os
 import logging
+import random
+import shutil
 import socket
 import select
+import tempfile
+import threading
 import time
 from functools import partial
 
 import manager
 
+from opencenteragent import tracing
+from opencenteragent import translog
+from opencenteragent.metrics import registry
+from opencenteragent.utils import boolean
+from opencenteragent.utils import detailed_exception
+from opencenteragent.utils import find_trans_log
+from opencenteragent.utils import trans_log_path
+from process_pool import ProcessPool
+
 LOG = logging.getLogger('opencenter.output')
 
 # output modules recieve an input action, and return an output
@@ -48,13 +67,78 @@ LOG = logging.getLogger('opencenter.output')
 # that it is willing to handle.  It can use the "register_action()"
 # function exported into the module namespace to do so.
 #
+# plugins may also export "teardown", called when the plugin is
+# unloaded, and "reconfigure", called with the new config hash when
+# the plugin's config section changes while the agent is running.
+#
 # other items injected into module namespace:
 #
-# LOG - a python logging handler
+# LOG - a python logging handler.  Within a dispatch handler, it
+#       logs to the transaction log of the task being run.
 # global_config - the global config hash
 # module_config - the configuration for the module
 # register_action()
 #
+# register_action() takes optional keyword arguments describing how the
+# action should be run:
+#
+# timeout - seconds the action may take (default 30).  Unless
+#           "enforce_timeouts" is turned off in the main config
+#           section, a task still running after this long is reported
+#           as failed and any scripts it started are killed.
+# concurrency - the most instances of this action the agent will run
+#               at the same time (default unlimited)
+# idempotent - True if running the action twice with the same payload
+#              is no different from running it once.  Identical
+#              requests for an idempotent action that arrive while one
+#              is already queued or running are merged into it, and all
+#              get its result.
+#
+# A plugin as a whole can be capped by setting "max_concurrency" in
+# its config section.
+#
+# Plugins that do heavy work in python can have their actions run in
+# a pool of worker processes instead of in the agent's own threads, by
+# setting "execution = process" in their config section.  See
+# process_pool.py for the related options.
+#
+# Plugins can be loaded or reloaded while the agent is running, with
+# the "modules.load" action (payload {"path": <file>}) or
+# "modules.reload" (optional payload {"plugins": [<name>, ...]},
+# default all plugins).  The new code is set up alongside the old, and
+# its actions are swapped into the dispatch table in one go once every
+# setup() has succeeded -- if one fails, the old plugins stay in place.
+# Tasks already running finish on the old code, after which the old
+# plugins' teardown() is called.
+#
+# Any task can be run under the python profiler by setting "profile"
+# in its payload.  Tasks for the actions listed in "profile_actions" in
+# the main config section are always profiled, and a random
+# "profile_sample_rate" fraction (0 to 1) of all other tasks are too.
+# The profile is written as trans_<id>.prof next to the transaction
+# log, and can be fetched with logfile.tail (payload "type": "prof").
+# logfile.tail and logfile.watch find logs wherever they are -- gzipped
+# by the janitor (see translog.py), or in the flat trans_log_dir layout
+# of older agents.
+#
+# Setting "trans_log_memory" (KB) in the main config section holds
+# each task's transaction log in memory, up to that size, rather than
+# writing it as the task runs.  The log is only written out if the
+# task fails or times out, if a logfile.watch is started on it, or if
+# it outgrows the limit; otherwise it's dropped once the task is done.
+# logfile.tail reads a log held in memory directly.  Plugins in process
+# execution mode always write their logs out.
+#
+# If "cache_dir" is set in the main config section, the actions each
+# plugin registers are written to a manifest there after the plugins
+# are loaded.  On later starts, a plugin whose file and configuration
+# haven't changed since is not loaded at all -- its actions are
+# registered from the manifest, and the plugin is only read and set up
+# the first time one of them is dispatched.  Set "lazy_load = no" in
+# the main config section to turn this off for all plugins, or in a
+# plugin's own section for a plugin whose setup() must run at startup.
+# Plugins in process execution mode are always loaded up front.
+#
 # after registering an action, any incoming data sent to
 # a specific action will be sent to the registered dispatch
 # handler, as registered by the module.
@@ -87,21 +171,44 @@ def _fail(code=1, message='unknown failure', data={}):
     return _ok(code, message, data)
 
 
+def _gunzip(path):
+    """A compressed log, decompressed into a temporary file."""
+    fd = tempfile.TemporaryFile()
+    gz = gzip.open(path, 'rb')
+    try:
+        shutil.copyfileobj(gz, fd)
+    finally:
+        gz.close()
+    fd.seek(0)
+    return fd
+
+
 def _xfer_to_eof(fd_in, sock_out):
+    """Send the rest of a file down a socket.
+
+    :returns: the number of bytes sent, or False if the remote end
+              went away
+    """
+    sent = 0
     while True:
-        bytes_read = fd_in.read(1024)
+        bytes_read = fd_in.read(64 * 1024)
         if len(bytes_read) == 0:
             # fd_in EOF.
-            return True
+            return sent
 
-        try:
-            bytes_sent = sock_out.send(bytes_read)
-        except:
-            return False
+        # send() may take less than it's given
+        while bytes_read:
+            try:
+                bytes_sent = sock_out.send(bytes_read)
+            except Exception:
+                return False
+
+            if bytes_sent == 0:
+                # remote socket shut down
+                return False
 
-        if bytes_sent == 0:
-            # remote socket shut down
-            return False
+            bytes_read = bytes_read[bytes_sent:]
+            sent += bytes_sent
 
 
 class OutputManager(manager.Manager):
@@ -110,42 +217,227 @@ class OutputManager(manager.Manager):
 
         # should all actions be named module.action?
         self.dispatch_table = {}
+
+        # while reloading, actions are registered here, and the table
+        # is swapped in once all the reloaded plugins are set up
+        self.staging_table = None
+        self.reload_lock = threading.Lock()
+
+        # swap_lock covers replacing the dispatch table, plugins and
+        # process pools, and the count of tasks running against each
+        # plugin namespace
+        self.swap_lock = threading.Lock()
+        self.drained = threading.Condition(self.swap_lock)
+        self.lazy_lock = threading.Lock()
+        self.inflight = {}
+        self.process_pools = {}
+
+        # threads tearing down replaced plugins once their tasks finish
+        self.retiring = []
+
+        # plugins whose actions were registered from the manifest, by
+        # name, with the file they'll be loaded from when first used
+        self.lazy = {}
+        self.manifest_path = None
+        self.manifest = {}
+        self.manifest_entries = {}
+
+        main = self.config.get('main', {})
+        if main.get('cache_dir') and boolean(main.get('lazy_load', True)):
+            self.manifest_path = os.path.join(main['cache_dir'],
+                                              'output-manifest.json')
+            self.manifest = self._read_manifest()
+
         self.register_action('modules', 'modules', 'logfile.tail',
                              self.handle_logfile)
         self.register_action('modules', 'modules', 'logfile.watch',
                              self.handle_logfile)
         self.register_action('modules', 'modules', 'modules.list',
-                             self.handle_modules)
+                             self.handle_modules, idempotent=True)
         self.register_action('modules', 'modules', 'modules.load',
                              self.handle_modules)
         self.register_action('modules', 'modules', 'modules.actions',
-                             self.handle_modules)
+                             self.handle_modules, idempotent=True)
         self.register_action('modules', 'modules', 'modules.reload',
                              self.handle_modules)
+        self.register_action('modules', 'modules', 'agent.stats',
+                             self.handle_stats, idempotent=True)
 
         self.load(path)
+        self._write_manifest()
+
+        # fork any worker processes now, while we're still small and
+        # before the input plugins have started their threads
+        self._start_process_pools()
 
         LOG.debug('Dispatch methods: %s' % self.dispatch_table.keys())
 
+    def _load_file(self, path):
+        entry = self._cached_entry(path)
+        if entry is None:
+            ns = super(OutputManager, self)._load_file(path)
+            if ns is not None and self.manifest_path is not None:
+                self._record_entry(path, ns['name'])
+            return ns
+
+        name = entry['name']
+        LOG.debug('Deferring load of plugin %s until first use' % name)
+        self.load_lock.acquire()
+        try:
+            for action, params in entry['actions'].items():
+                if action in self.dispatch_table:
+                    action_details = self.dispatch_table[action]
+                    raise NameError('Action %s already registered to %s:%s'
+                                    % (action, action_details['shortpath'],
+                                       action_details['method']))
+                self.dispatch_table[action] = dict(params, method=None,
+                                                   lazy=True)
+
+            if not name in self.loaded_modules:
+                self.loaded_modules.append(name)
+            self.lazy[name] = path
+            self.manifest_entries[path] = entry
+        finally:
+            self.load_lock.release()
+
+    def _config_hash(self):
+        return hashlib.sha1(json.dumps(self.config, sort_keys=True,
+                                       default=repr)).hexdigest()
+
+    def _file_signature(self, path):
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': digest}
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if not isinstance(manifest, dict) or \
+                manifest.get('config') != self._config_hash():
+            LOG.debug('Plugin manifest is out of date, ignoring it')
+            return {}
+        return manifest.get('plugins', {})
+
+    def _cached_entry(self, path):
+        """The manifest entry for a plugin file, if it can be trusted.
+
+        :returns: the entry, or None if the plugin has to be loaded now
+        """
+        entry = self.manifest.get(path)
+        if entry is None:
+            return None
+
+        config = self.config.get(entry['name'], {})
+        if config.get('execution', 'thread') == 'process' or \
+                not boolean(config.get('lazy_load', True)):
+            return None
+
+        try:
+            signature = self._file_signature(path)
+        except (IOError, OSError):
+            return None
+
+        for key, value in signature.items():
+            if entry.get(key) != value:
+                return None
+        return entry
+
+    def _record_entry(self, path, name):
+        actions = {}
+        self.load_lock.acquire()
+        for action, params in self.dispatch_table.items():
+            if params['plugin'] == name:
+                actions[action] = dict([(k, v) for k, v in params.items()
+                                        if k != 'method'])
+        self.load_lock.release()
+
+        try:
+            entry = self._file_signature(path)
+            # arguments have to survive being written out as json
+            json.dumps(actions)
+        except (IOError, OSError, TypeError, ValueError):
+            LOG.debug('Not caching actions for plugin %s' % name)
+            return
+
+        entry.update({'name': name, 'actions': actions})
+        self.load_lock.acquire()
+        self.manifest_entries[path] = entry
+        self.load_lock.release()
+
+    def _write_manifest(self):
+        if self.manifest_path is None or \
+                self.manifest_entries == self.manifest:
+            return
+
+        tmp = self.manifest_path + '.tmp'
+        try:
+            if not os.path.isdir(os.path.dirname(self.manifest_path)):
+                os.makedirs(os.path.dirname(self.manifest_path))
+            with open(tmp, 'w') as f:
+                json.dump({'config': self._config_hash(),
+                           'plugins': self.manifest_entries}, f,
+                          sort_keys=True)
+            os.rename(tmp, self.manifest_path)
+        except (IOError, OSError) as e:
+            LOG.warning('Could not write plugin manifest %s: %s' %
+                        (self.manifest_path, str(e)))
+
+    def _load_lazy(self, name):
+        """Load and set up a plugin registered from the manifest."""
+        self.lazy_lock.acquire()
+        try:
+            if not name in self.lazy:
+                return
+
+            LOG.info('Loading plugin %s on first use' % name)
+            self._swap([self.lazy[name]])
+
+            # the file may no longer provide this plugin at all
+            self.lazy.pop(name, None)
+        finally:
+            self.lazy_lock.release()
+
     def register_action(self, plugin, shortpath, action, method,
                         constraints=[], consequences=[], args={},
-                        timeout=30):
+                        timeout=30, concurrency=None, idempotent=False):
         LOG.debug('Registering handler for action %s' % action)
+        self.load_lock.acquire()
+        try:
+            self._register_action(plugin, shortpath, action, method,
+                                  constraints, consequences, args,
+                                  timeout, concurrency, idempotent)
+        finally:
+            self.load_lock.release()
+
+    def _register_action(self, plugin, shortpath, action, method,
+                         constraints, consequences, args,
+                         timeout, concurrency, idempotent):
+        table = self.dispatch_table
+        if self.staging_table is not None:
+            table = self.staging_table
+
         # First handler wins
-        if action in self.dispatch_table:
-            action_details = self.dispatch_table[action]
+        if action in table:
+            action_details = table[action]
             raise NameError('Action %s already registered to %s:%s'
-                            % (action, action_details['short_path'],
+                            % (action, action_details['shortpath'],
                                action_details['method']))
         else:
-            self.dispatch_table[action] = {'method': method,
-                                           'shortpath': shortpath,
-                                           'function': method.func_name,
-                                           'plugin': plugin,
-                                           'constraints': constraints,
-                                           'consequences': consequences,
-                                           'arguments': args,
-                                           'timeout': timeout}
+            table[action] = {'method': method,
+                             'shortpath': shortpath,
+                             'function': method.func_name,
+                             'plugin': plugin,
+                             'constraints': constraints,
+                             'consequences': consequences,
+                             'arguments': args,
+                             'timeout': timeout,
+                             'concurrency': concurrency,
+                             'idempotent': idempotent}
 
     def actions(self):
         d = {}
@@ -157,6 +449,57 @@ class OutputManager(manager.Manager):
                          'timeout': params['timeout']}
         return d
 
+    def limits(self, action):
+        """Concurrency caps that apply to an action.
+
+        :param: action: the action name
+
+        :returns: a list of (key, limit) tuples suitable for DispatchPool
+        """
+        if not action in self.dispatch_table:
+            return []
+
+        params = self.dispatch_table[action]
+        plugin = params['plugin']
+        plugin_limit = self.config.get(plugin, {}).get('max_concurrency')
+        if plugin_limit:
+            plugin_limit = int(plugin_limit)
+
+        return [(('action', action), params['concurrency']),
+                (('plugin', plugin), plugin_limit)]
+
+    def idempotent(self, action):
+        """Whether an action was registered as safe to run twice."""
+        return action in self.dispatch_table and \
+            self.dispatch_table[action]['idempotent']
+
+    def coalesce_key(self, input_data):
+        """Key identifying identical requests for an idempotent action.
+
+        :param: input_data: the task input
+
+        :returns: a hashable key, or None if the task can't be coalesced
+        """
+        action = input_data.get('action')
+        if not self.idempotent(action):
+            return None
+
+        return (action, json.dumps(input_data.get('payload'),
+                                   sort_keys=True))
+
+    def timeout(self, action):
+        """The enforced timeout for an action, or None."""
+        if not action in self.dispatch_table:
+            return None
+
+        # our own introspection actions aren't subject to timeouts --
+        # logfile.watch runs for as long as the log keeps growing
+        params = self.dispatch_table[action]
+        if params['plugin'] == 'modules':
+            return None
+
+        return params['timeout']
+
     def dispatch(self, input_data):
         # look at the dispatch table for matching actions
         # and dispatch them in order to the registered
@@ -170,57 +513,353 @@ class OutputManager(manager.Manager):
         result = {'result_code': 253,
                   'result_str': 'no dispatcher found for action "%s"' % action,
                   'result_data': ''}
-        if action in self.dispatch_table:
-            # TODO(mikal): we don't really need the locals here
-            params = self.dispatch_table[action]
-            fn = params['method']
-            path = params['shortpath']
-            plugin = params['plugin']
-
-            LOG.debug('Plugin_manager: dispatching action %s from plugin %s' %
-                      (action, plugin))
-            LOG.debug('Received input_data %s' % (input_data))
-            base = self.config['main'].get('trans_log_dir',
-                                           '/var/log/opencenter')
-
-            if not os.path.isdir(base):
-                raise OSError(2, 'Specified path "%s" ' % (base) +
-                              'does not exist or is not a directory.')
-
-            if not os.access(base, os.W_OK):
-                raise OSError(13,
-                              'Specified path "%s" is not writable.' %
-                              base)
-
-            # we won't log from built-in functions
-            ns = None
-            if plugin in self.plugins:
-                ns = self.plugins[plugin]
-                t_LOG = ns['LOG']
-                if 'id' in input_data:
-                    ns['LOG'] = logging.getLogger(
-                        'opencenter.output.trans_%s' % input_data['id'])
-                    h = logging.FileHandler(
-                        os.path.join(base,
-                                     'trans_%s.log' % input_data['id']), 'w')
-                    ns['LOG'].addHandler(h)
 
-            # FIXME(rp): handle exceptions
-            result = fn(input_data)
+        params = self.dispatch_table.get(action)
+        if params is not None and params.get('lazy'):
+            self._load_lazy(params['plugin'])
 
+        # pin the plugin code this task runs against, so a reload
+        # can't change it underneath us
+        self.swap_lock.acquire()
+        params = self.dispatch_table.get(action)
+        if params is not None and params.get('lazy'):
+            # the plugin's file stopped registering the action
+            params = None
+        ns = None
+        pool = None
+        if params is not None:
+            ns = self.plugins.get(params['plugin'])
+            pool = self.process_pools.get(params['plugin'])
             if ns is not None:
-                ns['LOG'] = t_LOG
+                self.inflight[id(ns)] = self.inflight.get(id(ns), 0) + 1
+        self.swap_lock.release()
 
-            LOG.debug('Got result %s' % result)
-        else:
-            if action.startswith('rollback_'):
-                result = {'result_code': 0,
-                          'result_str': 'no rollback action for %s' % action,
-                          'result_data': {}}
+        try:
+            if params is not None:
+                plugin = params['plugin']
+
+                LOG.debug('Plugin_manager: dispatching action %s from '
+                          'plugin %s' % (action, plugin))
+                LOG.debug('Received input_data %s' % (input_data))
+                base = self.config['main'].get('trans_log_dir',
+                                               '/var/log/opencenter')
+
+                if not os.path.isdir(base):
+                    raise OSError(2, 'Specified path "%s" ' % (base) +
+                                  'does not exist or is not a directory.')
+
+                if not os.access(base, os.W_OK):
+                    raise OSError(13,
+                                  'Specified path "%s" is not writable.' %
+                                  base)
+
+                start = time.time()
+                if pool is not None:
+                    main = self.config.get('main', {})
+                    timeout = None
+                    if boolean(main.get('enforce_timeouts', True)):
+                        timeout = self.timeout(action)
+                    result = pool.apply(action, input_data, timeout,
+                                        int(main.get('kill_grace', 10)))
+                else:
+                    result = self._invoke(action, input_data, params, ns)
+                registry.observe('action.latency', time.time() - start,
+                                 key=action)
+                if isinstance(result, dict) and result.get('result_code'):
+                    registry.incr('action.failures', key=action)
+
+                LOG.debug('Got result %s' % result)
             else:
-                LOG.warning('No dispatch for action "%s"' % action)
+                if action.startswith('rollback_'):
+                    result = {'result_code': 0,
+                              'result_str': 'no rollback action for %s' %
+                              action,
+                              'result_data': {}}
+                else:
+                    LOG.warning('No dispatch for action "%s"' % action)
+                    # not keyed by action, as anyone can make those up
+                    registry.incr('action.unknown')
+        finally:
+            if ns is not None:
+                self.swap_lock.acquire()
+                self.inflight[id(ns)] -= 1
+                if not self.inflight[id(ns)]:
+                    del self.inflight[id(ns)]
+                    self.drained.notify_all()
+                self.swap_lock.release()
+
         return result
 
+    def _invoke(self, action, input_data, params=None, ns=None,
+                in_memory=True):
+        """Run an action's handler, logging to the transaction log.
+
+        This is the part of dispatch that runs in a worker process for
+        plugins in process execution mode.
+
+        :param: params:    the action's dispatch table entry, if already
+                           looked up
+        :param: ns:        the namespace of the plugin providing it
+        :param: in_memory: whether the log may be held in memory
+        """
+        # TODO(mikal): we don't really need the locals here
+        if params is None:
+            params = self.dispatch_table[action]
+            ns = self.plugins.get(params['plugin'])
+        fn = params['method']
+
+        # we won't log from built-in functions
+        log_path = None
+        log_buffer = None
+        # an action may run another one on the same thread
+        previous_log = translog.current_logger()
+        if ns is not None and 'id' in input_data:
+            log_path = trans_log_path(self.config, input_data['id'])
+            memory = int(self.config.get('main', {}).get(
+                'trans_log_memory', 0)) * 1024
+            if memory and in_memory:
+                log_buffer = translog.TransLogBuffer(log_path, memory)
+            else:
+                translog.writer.begin(log_path)
+
+            # made directly rather than with getLogger(), so it isn't
+            # kept around forever once the task is done.  the plugin's
+            # LOG picks it up for this thread only (see translog.py).
+            task_log = logging.Logger(
+                'opencenter.output.trans_%s' % input_data['id'])
+            task_log.parent = logging.getLogger('opencenter.output')
+            task_log.addHandler(translog.TransLogHandler(log_path,
+                                                         buffer=log_buffer))
+            translog.set_logger(task_log)
+
+        result = None
+        try:
+            # FIXME(rp): handle exceptions
+            if 'id' in input_data and self._profiling(action, input_data):
+                registry.incr('action.profiled', key=action)
+                profiler = cProfile.Profile()
+                try:
+                    result = profiler.runcall(fn, input_data)
+                finally:
+                    prof_path = trans_log_path(self.config, input_data['id'],
+                                               'prof')
+                    try:
+                        os.makedirs(os.path.dirname(prof_path))
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                    profiler.dump_stats(prof_path)
+            else:
+                result = fn(input_data)
+        finally:
+            if log_path is not None:
+                translog.set_logger(previous_log)
+            if log_buffer is not None:
+                failed = not isinstance(result, dict) or \
+                    result.get('result_code') != 0
+                if not log_buffer.close(keep=failed):
+                    # nothing to add the task's trace to
+                    trace = tracing.current()
+                    if trace is not None and trace.logfile == log_path:
+                        trace.logfile = None
+            elif log_path is not None:
+                translog.writer.close(log_path)
+
+        return result
+
+    def _profiling(self, action, input_data):
+        """Whether to run a task under the profiler."""
+        payload = input_data.get('payload')
+        if isinstance(payload, dict) and \
+                boolean(payload.get('profile', False)):
+            return True
+
+        main = self.config.get('main', {})
+        actions = [x.strip() for x in
+                   main.get('profile_actions', '').split(',')]
+        if action in actions:
+            return True
+
+        rate = float(main.get('profile_sample_rate', 0))
+        return rate > 0 and random.random() < rate
+
+    def _start_process_pools(self):
+        for plugin in self.plugins:
+            config = self.config.get(plugin, {})
+            if config.get('execution', 'thread') != 'process':
+                continue
+
+            LOG.info('Running actions for plugin %s in worker processes' %
+                     plugin)
+            self.process_pools[plugin] = ProcessPool(self, plugin, config)
+
+    def loadfile(self, path):
+        """Load a plugin file, replacing any plugin of the same name."""
+        self._swap([path])
+
+    def reload(self, names=None):
+        """Reload plugins from the files they were loaded from.
+
+        :param: names: plugin names to reload, or None for all of them
+        """
+        if names is None:
+            names = sorted(set(self.plugins.keys()) | set(self.lazy.keys()))
+        self._swap([self.lazy[name] if name in self.lazy
+                    else self.plugins[name]['__file__'] for name in names])
+
+    def _swap(self, paths):
+        self.reload_lock.acquire()
+        try:
+            names, old, drain_time = self._replace(paths)
+
+            for name in names:
+                LOG.info('Loaded plugin %s' % name)
+                if not name in self.loaded_modules:
+                    self.loaded_modules.append(name)
+
+            # the agent is running threads by now, so worker processes
+            # aren't forked again.  they load the new code themselves
+            # before their next task (see process_pool.py).
+            pools = dict(self.process_pools)
+            old_pools = []
+            for name in names:
+                config = self.config.get(name, {})
+                if config.get('execution', 'thread') != 'process':
+                    if name in pools:
+                        old_pools.append(pools.pop(name))
+                elif name in pools:
+                    pools[name].reload(self.plugins[name]['__file__'],
+                                       self._sections(self.plugins[name]))
+                else:
+                    LOG.warning('Plugin %s will run in worker processes '
+                                'once the agent is restarted' % name)
+
+            self.swap_lock.acquire()
+            self.process_pools = pools
+            self.swap_lock.release()
+        finally:
+            self.reload_lock.release()
+
+        # the old code is torn down once its tasks are done, without
+        # holding up this dispatch worker or other reloads meanwhile
+        if old or old_pools:
+            retire = threading.Thread(target=self._retire,
+                                      args=(old, old_pools, drain_time))
+            retire.setDaemon(True)
+            self.retiring = [t for t in self.retiring if t.isAlive()]
+            self.retiring.append(retire)
+            retire.start()
+
+    def _replace(self, paths):
+        """Load and set up plugins, and swap them in for the old ones.
+
+        :returns: the names of the plugins loaded, the namespaces they
+                  replaced, and the longest any of those may still be
+                  running a task for
+        """
+        new = []
+        for path in paths:
+            ns = self._read_file(path)
+            if ns is not None:
+                new.append(ns)
+        names = [ns['name'] for ns in new]
+
+        # set the new plugins up against a copy of the dispatch
+        # table with the old versions' actions taken out
+        self.staging_table = dict(
+            [(action, params)
+             for action, params in self.dispatch_table.items()
+             if not params['plugin'] in names])
+        started = []
+        try:
+            for ns in new:
+                self._setup_plugin(ns)
+                started.append(ns)
+        except Exception:
+            LOG.error('Error setting up new plugins, keeping the old '
+                      'ones: %s' % detailed_exception())
+            for ns in started:
+                self._teardown_plugin(ns)
+            raise
+        finally:
+            table = self.staging_table
+            self.staging_table = None
+
+        old = [self.plugins[name] for name in names
+               if name in self.plugins]
+        drain_time = max([params['timeout'] or 0
+                          for params in self.dispatch_table.values()
+                          if params['plugin'] in names] or [0])
+
+        plugins = dict(self.plugins)
+        for ns in new:
+            plugins[ns['name']] = ns
+
+        self.swap_lock.acquire()
+        self.dispatch_table = table
+        self.plugins = plugins
+        for name in names:
+            self.lazy.pop(name, None)
+        self.swap_lock.release()
+
+        return names, old, drain_time
+
+    def _retire(self, old, old_pools, drain_time):
+        # let tasks running on the old code finish before tearing it
+        # down, but don't wait on them for longer than they're allowed
+        # to run
+        deadline = time.time() + drain_time
+        self.swap_lock.acquire()
+        try:
+            for ns in old:
+                while self.inflight.get(id(ns)):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        LOG.warning('Tearing down old plugin %s with '
+                                    'tasks still running' % ns['name'])
+                        break
+                    self.drained.wait(remaining)
+        finally:
+            self.swap_lock.release()
+
+        for ns in old:
+            self._teardown_plugin(ns)
+        for pool in old_pools:
+            pool.stop()
+
+    def _sections(self, ns):
+        # the config sections a plugin running in worker processes
+        # needs to be sent when it's reloaded there
+        return dict([(section, self.config.get(section, {}))
+                     for section in ['main', ns['name']] +
+                     list(ns.get('config_sections', []))])
+
+    def _reconfigure_plugin(self, ns):
+        pool = self.process_pools.get(ns['name'])
+        if pool is None:
+            return super(OutputManager, self)._reconfigure_plugin(ns)
+
+        # the workers only have the configuration they were forked with
+        LOG.info('Reloading plugin %s in its worker processes to apply '
+                 'configuration changes' % ns['name'])
+        pool.reload(ns['__file__'], self._sections(ns))
+
+    def _forked(self):
+        """Start afresh with locks other threads held when we forked."""
+        self.load_lock = threading.RLock()
+        self.reload_lock = threading.Lock()
+        self.swap_lock = threading.Lock()
+        self.drained = threading.Condition(self.swap_lock)
+        self.lazy_lock = threading.Lock()
+
+    def stop(self):
+        for plugin, pool in self.process_pools.items():
+            LOG.debug('Stopping worker processes for plugin %s' % plugin)
+            pool.stop()
+        self.process_pools = {}
+
+        super(OutputManager, self).stop()
+
     # some internal methods to provide some agent introspection
     def handle_logfile(self, input_data, sock=None):
         """Handle logfile reading.
@@ -241,21 +880,42 @@ class OutputManager(manager.Manager):
             return _fail(message='must specify task_id, '
                          'dest_ip and dest_port')
 
-        base = self.config['main'].get('trans_log_dir', '/var/log/opencenter')
-        log_path = os.path.join(base, 'trans_%s.log' % payload['task_id'])
+        # a task's profile is fetched whole unless asked otherwise,
+        # as the tail of one is no use
+        kind = payload.get('type', 'log')
+        if not kind in ('log', 'prof'):
+            return _fail(message='type must be "log" or "prof"')
+
+        fd = None
+        if kind == 'log':
+            path = trans_log_path(self.config, payload['task_id'])
+            live = translog.live_buffer(path)
+            if live is not None and timeout:
+                # a watched log is followed on disk
+                live.spill('watch')
+                translog.writer.flush()
+            elif live is not None:
+                data = live.getvalue()
+                if data is not None:
+                    fd = cStringIO.StringIO(data)
 
-        if not os.path.exists(log_path):
-            return _fail(message='no such transaction log file')
+        if fd is None:
+            log_path = find_trans_log(self.config, payload['task_id'], kind)
 
-        data = ''
-        fd = open(log_path, 'r')
+            if log_path is None:
+                return _fail(message='no such transaction log file')
+
+            if log_path.endswith('.gz'):
+                fd = _gunzip(log_path)
+            else:
+                fd = open(log_path, 'rb')
 
         try:
             position = payload['offset']['position']
             length = payload['offset']['length']
         except (KeyError, TypeError):
-            position = 'end'
-            length = 1024
+            position = {'log': 'end', 'prof': 'start'}[kind]
+            length = {'log': 1024, 'prof': 0}[kind]
         sign = {'start': 1, 'end': -1}
         whence = {'start': os.SEEK_SET, 'end': os.SEEK_END}
         try:
@@ -287,9 +947,10 @@ class OutputManager(manager.Manager):
 
             if result is False:
                 return _fail(code=1, message='remote socket disconnect')
+            sent = result
 
             if timeout == 0:
-                return _ok()
+                return _ok(data={'bytes': sent})
 
             # we're polling to end of file.  Socket and fd are open,
             # fd is at EOF.  Wait for file size to change
@@ -308,8 +969,10 @@ class OutputManager(manager.Manager):
                     # new data in file
                     fd.seek(pos, os.SEEK_SET)
                     result = _xfer_to_eof(fd, sock)
-                    if not result:
-                        return _fail(message='remote socket disconnect')
+                    if result is False:
+                        return _fail(message='remote socket disconnect',
+                                     data={'bytes': sent})
+                    sent += result
 
                     pos = fd.tell()
                     remaining_timeout = timeout
@@ -322,7 +985,10 @@ class OutputManager(manager.Manager):
                 pass
             sock.close()
 
-        return _ok()
+        return _ok(data={'bytes': sent})
+
+    def handle_stats(self, input_data):
+        return _ok(data=registry.snapshot())
 
     def handle_modules(self, input_data):
         action = input_data['action']
@@ -345,5 +1011,15 @@ class OutputManager(manager.Manager):
             # any exceptions we'll bubble up from the manager
             self.loadfile(payload['path'])
         elif action == 'modules.reload':
-            pass
+            names = None
+            if payload and 'plugins' in payload:
+                names = payload['plugins']
+                missing = [name for name in names
+                           if not name in self.plugins and
+                           not name in self.lazy]
+                if missing:
+                    return _fail(message='no such plugin(s): %s' %
+                                 ', '.join(missing))
+
+            self.reload(names)
         return _ok()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import errno
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.queues
+import os
+import resource
+import signal
+import threading
+import time
+
+from opencenteragent.utils import detailed_exception
+from opencenteragent.watchdog import Watchdog
+
+LOG = logging.getLogger('opencenter.output.process_pool')
+
+# Process execution mode for output plugins.
+#
+# Setting "execution = process" in a plugin's config section runs that
+# plugin's actions in a pool of forked worker processes rather than in
+# the agent's dispatch threads, so heavy python work in one plugin
+# doesn't hold the GIL against everything else.  Other options in the
+# same section:
+#
+# processes = <n>               # worker processes (default 1)
+# max_tasks_per_process = <n>   # recycle a worker after n tasks
+#                               # (default 100, 0 to never recycle)
+# memory_limit = <MB>           # RLIMIT_AS for each worker
+# cpu_limit = <seconds>         # RLIMIT_CPU for each worker
+#
+# Workers are forked from the agent after the plugin has been set up,
+# so they already have the plugin loaded.  When the plugin is reloaded,
+# the workers aren't forked again -- the agent is running threads by
+# then -- but load the new code themselves before their next task.
+# Workers recycled after max_tasks_per_process are still forked from
+# the running agent.  The workers reload the plugin the same way when
+# its config sections change, as they can't see the agent's new
+# configuration otherwise.  Only the action name and
+# the input data go over to the worker, and only the result dict comes
+# back, so both must be picklable (they're already JSON-able).
+#
+# A worker that dies while running a task -- killed, or out of CPU
+# time, which kills it with SIGXCPU -- fails the task with a 254.
+#
+# Action timeouts apply here too.  Each worker runs its own watchdog,
+# which kills the scripts a task started once it times out, just as
+# the agent's watchdog would.  A worker still stuck kill_grace seconds
+# after that is killed, and the task fails with a 252.
+
+# the OutputManager whose dispatch table the workers use.  It's set
+# before any worker is forked, so each worker inherits it.
+_manager = None
+
+# in a worker, the queue it reports the tasks it starts on, its
+# watchdog, and the generation of the plugin code it has loaded
+_started = None
+_watchdog = None
+_generation = 0
+
+
+def _initialize(memory_limit, cpu_limit, pool):
+    global _started, _generation
+    _started = pool.started
+    _generation = pool.generation
+
+    # other threads in the agent may have held the manager's locks
+    # when this worker was forked
+    _manager._forked()
+
+    # the agent handles ^C, not its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    if cpu_limit:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+
+
+def _reload(generation, path, sections):
+    global _generation
+    LOG.info('Reloading plugin in worker process %s' % os.getpid())
+    _manager.config.update(sections)
+    names, old, drain_time = _manager._replace([path])
+    for ns in old:
+        _manager._teardown_plugin(ns)
+    _generation = generation
+
+
+def _run(token, action, input_data, timeout, kill_grace, generation, path,
+         sections):
+    global _watchdog
+    _started.put((token, os.getpid()))
+
+    if generation != _generation:
+        try:
+            _reload(generation, path, sections)
+        except Exception:
+            return {'result_code': 254,
+                    'result_str': 'error reloading plugin',
+                    'result_data': detailed_exception()}
+
+    watch = None
+    if timeout:
+        if _watchdog is None:
+            _watchdog = Watchdog(kill_grace)
+            _watchdog.start()
+        watch = _watchdog.watch(timeout, lambda: None)
+
+    try:
+        # the agent can't see logs held in this process's memory
+        return _manager._invoke(action, input_data, in_memory=False)
+    except Exception:
+        return {'result_code': 254,
+                'result_str': 'dispatch error',
+                'result_data': detailed_exception()}
+    finally:
+        if watch is not None:
+            _watchdog.release(watch)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+class ProcessPool(object):
+    def __init__(self, manager, name, config):
+        global _manager
+        _manager = manager
+
+        self.name = name
+        self.lock = threading.Lock()
+        self.tokens = itertools.count()
+        self.started = multiprocessing.queues.SimpleQueue()
+        # tasks handed to workers and not yet returned, and the pids
+        # of the workers running them, by token
+        self.outstanding = set()
+        self.pids = {}
+
+        # bumped each time the plugin is reloaded, with the file to
+        # load it from and the config sections it uses
+        self.generation = 0
+        self.path = None
+        self.sections = {}
+
+        processes = int(config.get('processes', 1))
+        max_tasks = int(config.get('max_tasks_per_process', 100)) or None
+        memory_limit = int(config.get('memory_limit', 0))
+        cpu_limit = int(config.get('cpu_limit', 0))
+
+        self.pool = multiprocessing.Pool(processes,
+                                         initializer=_initialize,
+                                         initargs=(memory_limit, cpu_limit,
+                                                   self),
+                                         maxtasksperchild=max_tasks)
+
+    def reload(self, path, sections):
+        """Have the workers load the plugin from path again.
+
+        :param: sections: the config sections the plugin uses, by name
+        """
+        self.lock.acquire()
+        self.generation += 1
+        self.path = path
+        self.sections = sections
+        self.lock.release()
+
+    def _drain(self):
+        # called with the lock held.  tasks that have already returned
+        # don't need their worker's pid.
+        while not self.started.empty():
+            started, pid = self.started.get()
+            if started in self.outstanding:
+                self.pids[started] = pid
+
+    def _worker(self, token):
+        # the pid of the worker running a task, once it's started
+        self.lock.acquire()
+        try:
+            self._drain()
+            return self.pids.get(token)
+        finally:
+            self.lock.release()
+
+    def apply(self, action, input_data, timeout=None, kill_grace=10):
+        """Run an action in a worker process and wait for the result.
+
+        :param: timeout:    seconds the action may take, or None
+        :param: kill_grace: seconds to wait, past the timeout, before
+                            killing the worker
+        """
+        LOG.debug('Handing action %s to a %s worker process' %
+                  (action, self.name))
+        self.lock.acquire()
+        token = self.tokens.next()
+        self.outstanding.add(token)
+        generation, path = self.generation, self.path
+        sections = self.sections
+        self.lock.release()
+
+        result = self.pool.apply_async(_run, (token, action, input_data,
+                                              timeout, kill_grace,
+                                              generation, path, sections))
+
+        # the clock starts once a worker picks the task up
+        deadline = None
+        try:
+            while True:
+                try:
+                    return result.get(1)
+                except multiprocessing.TimeoutError:
+                    pass
+
+                pid = self._worker(token)
+                if pid is None:
+                    continue
+                if deadline is None and timeout:
+                    deadline = time.time() + timeout + kill_grace
+
+                if not _alive(pid):
+                    LOG.warning('%s worker process %s died running %s' %
+                                (self.name, pid, action))
+                    return {'result_code': 254,
+                            'result_str': 'worker process died',
+                            'result_data': ''}
+
+                if deadline is not None and time.time() > deadline:
+                    LOG.warning('%s worker process %s stuck running %s, '
+                                'killing' % (self.name, pid, action))
+                    os.kill(pid, signal.SIGKILL)
+                    return {'result_code': 252,
+                            'result_str': 'action timed out after %s '
+                            'seconds' % timeout,
+                            'result_data': ''}
+        finally:
+            self.lock.acquire()
+            self.outstanding.discard(token)
+            self.pids.pop(token, None)
+            self._drain()
+            self.lock.release()
+
+    def stop(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -60,10 +60,11 @@ class RestishHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         producer_lock.acquire()
         producer_queue.append(retval)
-
-        # should use a pthread_cond here
         producer_lock.release()
 
+        # let the dispatch loop know there is work
+        wakeup()
+
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
@@ -132,6 +133,10 @@ def fetch():
     return result
 
 
+def depth():
+    return len(producer_queue)
+
+
 def result(input_data, output_data):
     LOG.debug('Got finish callback for id %s: %s\n' % (input_data['id'],
                                                        output_data))
@@ -33,10 +33,20 @@ import time
 from requests import ConnectionError
 
 from opencenterclient.client import OpenCenterEndpoint
+from opencenteragent.utils import detailed_exception
 
 name = 'taskerator'
 task_getter = None
 
+# results are retried until they reach the server (see input_manager.py)
+defers_results = True
+
+# give up on a result the server keeps refusing after this many tries
+MAX_REPORT_ATTEMPTS = 5
+
+# we connect to the admin endpoint, and read our hostid file
+config_sections = ['main', 'endpoints']
+
 
 class TaskThread(threading.Thread):
     def __init__(self, endpoint, name, host_id, hostidfile):
@@ -50,6 +60,11 @@ class TaskThread(threading.Thread):
         self.producer_condition = threading.Condition(self.producer_lock)
         self.pending_tasks = []
         self.running_tasks = {}
+        # (input, result) pairs we couldn't get to the server, to try
+        # again, and how often each has failed for reasons other than
+        # the connection, by task id
+        self.unreported = []
+        self.failures = {}
         self.host_id = host_id
         self.hostidfile = hostidfile
         self._maybe_init()
@@ -108,6 +123,7 @@ class TaskThread(threading.Thread):
                 'id': -1}
         self.pending_tasks.append(task)
         self.producer_condition.notify()
+        wakeup()
         LOG.debug('added module_list task to work queue')
         self.producer_lock.release()
         self.producer_lock.acquire()
@@ -116,15 +132,30 @@ class TaskThread(threading.Thread):
                 'id': -1}
         self.pending_tasks.append(task)
         self.producer_condition.notify()
+        wakeup()
         LOG.debug('added module_list task to work queue')
         self.producer_lock.release()
 
         return True
 
+    def _has_capacity(self):
+        # don't claim tasks we can't start yet.  anything we leave on
+        # the server can still be handed to someone else.
+        pool = capacity()
+        if pool is None:
+            return True
+        return pool['available'] > len(self.pending_tasks)
+
     def stop(self):
         self.endpoint = None
         self.running = False
 
+    def reconnect(self, endpoint):
+        # we'll connect to the new endpoint next time round run()
+        LOG.info('Switching to endpoint %s' % endpoint)
+        self.endpoint_uri = endpoint
+        self.endpoint = None
+
     def run(self):
         self.running = True
 
@@ -135,6 +166,17 @@ class TaskThread(threading.Thread):
                 time.sleep(15)
                 continue
 
+            if self.unreported:
+                try:
+                    self.results([])
+                except Exception:
+                    LOG.error('Error reporting results: %s' %
+                              detailed_exception())
+
+            if not self._has_capacity():
+                time.sleep(1)
+                continue
+
             try:
                 task = self.endpoint.nodes[self.host_id].task_blocking
             except ConnectionError:
@@ -143,6 +185,7 @@ class TaskThread(threading.Thread):
                 raise
 
             if task:
+                claim_start = time.time()
                 self.producer_lock.acquire()
                 if task.id not in [x['id'] for x in self.pending_tasks]:
                     LOG.debug('Found new pending task with id %s' % task.id)
@@ -158,9 +201,13 @@ class TaskThread(threading.Thread):
                     myself.task_id = task['id']
                     myself.save()
 
-                    self.pending_tasks.append(task.to_hash())
+                    task_hash = task.to_hash()
+                    task_hash['trace'] = [['claim', claim_start,
+                                           time.time()]]
+                    self.pending_tasks.append(task_hash)
                     self.producer_condition.notify()
-                    LOG.debug('added task to work queue' % task.to_hash())
+                    wakeup()
+                    LOG.debug('added task to work queue' % task_hash)
                 self.producer_lock.release()
 
         self.running = False
@@ -185,6 +232,11 @@ class TaskThread(threading.Thread):
                       'action': task['action'],
                       'payload': task['payload']}
 
+            if 'trace' in task:
+                claimed = task['trace'][-1][2]
+                retval['trace'] = task['trace'] + [['pending', claimed,
+                                                    time.time()]]
+
             LOG.debug('Marking task %s as running' % task['id'])
 
             # throw it into the running list -- I don't know that we really
@@ -194,42 +246,107 @@ class TaskThread(threading.Thread):
         self.producer_lock.release()
         return retval
 
-    def result(self, txid, result):
+    def depth(self):
+        # len() of a list is atomic, and we don't want to wait behind
+        # run() holding the lock across REST calls
+        return len(self.pending_tasks)
+
+    def adopt(self, task):
+        # a task we were running before the agent restarted.  the
+        # server still has it as ours, so we'll report on it.
         self.producer_lock.acquire()
-        if txid in self.running_tasks.keys():
-            try:
+        self.running_tasks[task['id']] = task
+        self.producer_lock.release()
+
+    def result(self, input_data, result):
+        self.results([(input_data, result)])
+
+    def results(self, batch):
+        # only hold the lock to look at our bookkeeping, so fetch()
+        # isn't stuck behind the REST calls
+        self.producer_lock.acquire()
+        for input_data, result in batch:
+            if not input_data['id'] in self.running_tasks:
+                # nothing to tell the server
+                delivered(input_data)
+        batch = self.unreported + [(input_data, result)
+                                   for input_data, result in batch
+                                   if input_data['id'] in self.running_tasks]
+        self.unreported = []
+        endpoint = self.endpoint
+        self.producer_lock.release()
+
+        done = []
+        sent = 0
+        try:
+            if endpoint is None:
+                # not connected yet; run() retries once we are
+                return
+
+            for input_data, result in batch:
+                txid = input_data['id']
                 if txid > 0:
                     # update the db
-                    task = self.endpoint.tasks[txid]
+                    task = endpoint.tasks[txid]
                     task._request_get()
                     task.state = 'done'
                     task.result = result
                     task.save()
-                    del self.running_tasks[txid]
-
-                    myself = self.endpoint.nodes[self.host_id]
-                    myself._request_get()
-                    if myself.task_id == task['id']:
-                        myself.task_id = None
-                        myself.save()
+                    done.append(txid)
 
                 elif txid == -1:
                     # module list?
                     if result['result_code'] == 0:
-                        newattr = self.endpoint.attrs.new(
+                        newattr = endpoint.attrs.new(
                             node_id=self.host_id,
                             key=result['result_data']['name'],
                             value=result['result_data']['value'])
                         newattr.save()
+                sent += 1
+                self.failures.pop(txid, None)
+                delivered(input_data)
+
+            if done:
+                # one node update covers the whole batch
+                myself = endpoint.nodes[self.host_id]
+                myself._request_get()
+                if myself.task_id in done:
+                    myself.task_id = None
+                    myself.save()
 
-            except ConnectionError:
-                # FIXME(rp):
-                # we should enqueue the task into a "retry update" list
-                # so we can update it once we get back to a connected
-                # state
-                pass
-
-        self.producer_lock.release()
+        except ConnectionError:
+            pass
+
+        except Exception:
+            # the server turned this one down.  try again, but not for
+            # ever, or it would hold up everything behind it.
+            if sent < len(batch):
+                input_data, result = batch[sent]
+                txid = input_data['id']
+                self.failures[txid] = self.failures.get(txid, 0) + 1
+                if self.failures[txid] >= MAX_REPORT_ATTEMPTS:
+                    LOG.error('Giving up reporting the result of task %s: '
+                              '%s' % (txid, detailed_exception()))
+                    self.failures.pop(txid)
+                    delivered(input_data)
+                    sent += 1
+            raise
+
+        finally:
+            # try the rest again on the next flush, or once we're
+            # connected again
+            retry = batch[sent:]
+            if retry:
+                LOG.warning('Unable to report results for tasks %s, will '
+                            'retry' % ', '.join(
+                                [str(input_data['id'])
+                                 for input_data, result in retry]))
+
+            self.producer_lock.acquire()
+            self.unreported = retry + self.unreported
+            for txid in done:
+                self.running_tasks.pop(txid, None)
+            self.producer_lock.release()
 
 
 class TaskGetter:
@@ -260,8 +377,28 @@ class TaskGetter:
     def fetch(self):
         return self.server_thread.fetch()
 
-    def result(self, txid, result):
-        return self.server_thread.result(txid, result)
+    def depth(self):
+        return self.server_thread.depth()
+
+    def result(self, input_data, result):
+        return self.server_thread.result(input_data, result)
+
+    def results(self, batch):
+        return self.server_thread.results(batch)
+
+    def adopt(self, task):
+        return self.server_thread.adopt(task)
+
+    def reconnect(self, endpoint):
+        self.endpoint = endpoint
+        self.server_thread.reconnect(endpoint)
+
+
+def _settings(config):
+    endpoint = global_config.get('endpoints', {}).get(
+        'admin', 'http://localhost:8080/admin')
+    return (endpoint, config.get('hostname', socket.getfqdn().strip()),
+            global_config['main']['hostidfile'])
 
 
 def setup(config=None):
@@ -269,8 +406,7 @@ def setup(config=None):
     if config is None:
         config = {}
 
-    hostidfile = global_config['main']['hostidfile']
-    name = config.get('hostname', socket.getfqdn().strip())
+    endpoint, name, hostidfile = _settings(config)
     try:
         with open(hostidfile) as f:
             host_id = f.read()
@@ -279,13 +415,21 @@ def setup(config=None):
             host_id = None
         else:
             raise e
-    endpoint = global_config.get('endpoints', {}).get(
-        'admin', 'http://localhost:8080/admin')
 
     task_getter = TaskGetter(endpoint, name, host_id, hostidfile)
     task_getter.run()
 
 
+def reconfigure(config):
+    global task_getter
+
+    endpoint, name, hostidfile = _settings(config)
+    if (name, hostidfile) != (task_getter.name, task_getter.hostidfile):
+        LOG.warning('hostname and hostidfile changes need an agent restart')
+    if endpoint != task_getter.endpoint:
+        task_getter.reconnect(endpoint)
+
+
 def teardown():
     global task_getter
     task_getter.stop()
@@ -296,9 +440,25 @@ def fetch():
     return task_getter.fetch()
 
 
+def depth():
+    global task_getter
+    return task_getter.depth()
+
+
 def result(input_data, output_data):
     global task_getter
 
-    txid = input_data['id']
-    result_hash = output_data
-    return task_getter.result(txid, result_hash)
+    if input_data.get('recovered'):
+        task_getter.adopt(input_data)
+
+    return task_getter.result(input_data, output_data)
+
+
+def results(batch):
+    global task_getter
+
+    for input_data, output_data in batch:
+        if input_data.get('recovered'):
+            task_getter.adopt(input_data)
+
+    return task_getter.results(batch)
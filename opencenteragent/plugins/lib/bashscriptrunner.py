@@ -1,8 +1,21 @@
 
+import contextlib
 import fcntl
 import os
 import string
 
+try:
+    from opencenteragent import watchdog
+except ImportError:
+    watchdog = None
+
+try:
+    from opencenteragent.tracing import span
+except ImportError:
+    @contextlib.contextmanager
+    def span(name):
+        yield
+
 
 def name_mangle(s, prefix=""):
     # we only support upper case variables and as a convenience convert
@@ -73,16 +86,36 @@ class BashScriptRunner(object):
             return response
 
         to_run = [path] + list(args)
-        try:
-            fh = [h for h in self.log.handlers if hasattr(h, "stream") and
-                  h.stream.fileno() > 2][0].stream.fileno()
-        except IndexError:
+
+        # transaction log handlers hand out their descriptor for as
+        # long as it takes to start the script
+        handler = None
+        fh = None
+        for h in getattr(self.log, 'handlers', []):
+            if hasattr(h, "open_fd"):
+                fh = h.open_fd()
+                if fh is not None:
+                    handler = h
+                break
+        if fh is None:
+            try:
+                fh = [h for h in self.log.handlers if hasattr(h, "stream") and
+                      h.stream.fileno() > 2][0].stream.fileno()
+            except (AttributeError, IndexError):
+                pass
+        if fh is None:
             fh = 2
+
         #first pass, never use bash to run things
-        c = BashExec(to_run,
-                     stdout=fh,
-                     stderr=fh,
-                     env=env)
+        try:
+            with span('script.fork'):
+                c = BashExec(to_run,
+                             stdout=fh,
+                             stderr=fh,
+                             env=env)
+        finally:
+            if handler is not None:
+                handler.close_fd(fh)
         response['result_data'] = {"script": path}
         ret_code, outputs = c.wait()
         response['result_data'].update(outputs)
@@ -102,8 +135,19 @@ class BashExec(object):
             # parent process
             self.child_pid = pid
             os.close(self.pipe_write)
+
+            # the child runs in its own process group so a hung script
+            # can be killed along with everything it started.  set it
+            # from both sides to avoid racing the child.
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                pass
+            if watchdog is not None:
+                watchdog.register_child(pid)
         else:
             # child process
+            os.setpgid(0, 0)
             os.close(self.pipe_read)
             if stdin is None:
                 f = open("/dev/null", "r")
@@ -123,9 +167,17 @@ class BashExec(object):
             output_variables = []
 
         # Wait for process to run
-        status_code = os.waitpid(self.child_pid, 0)[1]
+        with span('script.run'):
+            status_code = os.waitpid(self.child_pid, 0)[1]
         ret_code = status_code >> 8
+        if watchdog is not None:
+            watchdog.unregister_child(self.child_pid)
 
+        with span('script.output'):
+            outputs = self._read_outputs()
+        return ret_code, outputs
+
+    def _read_outputs(self):
         fl = fcntl.fcntl(self.pipe_read, fcntl.F_GETFL)
         fcntl.fcntl(self.pipe_read, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
@@ -161,4 +213,4 @@ class BashExec(object):
                 else:
                     break
 
-        return ret_code, outputs
+        return outputs
@@ -67,17 +67,20 @@ def setup(config={}):
                              'facts.chef_server_pem'},
          'CHEF_SERVER_HOSTNAME': {'type': 'evaluated',
                                   'expression': 'nodes.{chef_server}.name'}},
-        timeout=300)
-    register_action('run_chef', chef.dispatch, timeout=600)
-    register_action('install_chef_server', chef.dispatch, timeout=600)
+        timeout=300, concurrency=1)
+    register_action('run_chef', chef.dispatch, timeout=600, concurrency=1,
+                    idempotent=True)
+    register_action('install_chef_server', chef.dispatch, timeout=600,
+                    concurrency=1)
     register_action('uninstall_chef_server', chef.dispatch)
     register_action('rollback_install_chef_server', chef.dispatch)
-    register_action('get_chef_info', chef.dispatch)
-    register_action('get_cookbook_channels', chef.dispatch)
+    register_action('get_chef_info', chef.dispatch, idempotent=True)
+    register_action('get_cookbook_channels', chef.dispatch, idempotent=True)
     register_action(
         'get_latest_channel_version', chef.dispatch, [], [],
         {'channel_name': {'type': 'string',
-                          'required': True}})
+                          'required': True}},
+        idempotent=True)
     register_action(
         'download_cookbooks', chef.dispatch, [], [],
         {'CHEF_SERVER_COOKBOOK_CHANNELS': {
@@ -288,7 +291,6 @@ class ChefThing(object):
                        'chef_endpoint': 'http://%s:4000' % ipaddr})
 
     def dispatch(self, input_data):
-        self.script.log = LOG
         f = getattr(self, input_data['action'])
         if callable(f):
             return f(input_data)
@@ -31,8 +31,8 @@ name = 'files'
 
 def setup(config={}):
     LOG.debug('doing setup for files handler')
-    register_action('files_list', handle_files)
-    register_action('files_get', handle_files)
+    register_action('files_list', handle_files, idempotent=True)
+    register_action('files_get', handle_files, idempotent=True)
 
 
 def handle_files(input_data):
@@ -115,7 +115,6 @@ class OpenStackThing(object):
         return self.script.run_env("evacuate_host.sh", env, "")
 
     def dispatch(self, input_data):
-        self.script.log = LOG
         f = getattr(self, input_data['action'])
         if callable(f):
             return f(input_data)
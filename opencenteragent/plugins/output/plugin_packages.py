@@ -46,9 +46,12 @@ def setup(config={}):
     script = BashScriptRunner(script_path=script_path, log=LOG,
                               environment=env)
     packages = PackageThing(script, config)
-    register_action('get_updates', packages.dispatch, timeout=300)  # 5 min
-    register_action('do_updates', packages.dispatch, timeout=600)   # 10 min
-    register_action('upgrade_agent', packages.dispatch, timeout=300)  # 5 min
+    register_action('get_updates', packages.dispatch, timeout=300,
+                    idempotent=True)  # 5 min
+    register_action('do_updates', packages.dispatch, timeout=600,
+                    concurrency=1)  # 10 min
+    register_action('upgrade_agent', packages.dispatch, timeout=300,
+                    concurrency=1)  # 5 min
 
 
 def get_environment(required, optional, payload):
@@ -266,7 +269,6 @@ class PackageThing(object):
                 'attrs.SkippedPackageList := %s' % json.dumps(skipped_list)]}))
 
     def dispatch(self, input_data):
-        self.script.log = LOG
         f = getattr(self, input_data['action'])
         if callable(f):
             return f(input_data)
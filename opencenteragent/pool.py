@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import logging
+import os
+import threading
+
+LOG = logging.getLogger('opencenter.pool')
+
+# The dispatch pool is a fixed set of long-lived worker threads fed
+# from a bounded wait queue.
+#
+# Each queued job carries a list of (key, limit) pairs -- typically
+# one for the action and one for the plugin that owns the action.  A
+# worker will only pick up a job if running it would not push any of
+# those keys over its limit.  Jobs that are over their limits stay in
+# the wait queue (in order) until a running job with the same key
+# completes.  A limit of None or 0 means "unlimited".
+#
+# When the wait queue is full, put() blocks, which stalls the main
+# dispatch loop and leaves further work with the input plugins.
+#
+# Jobs may also be given a coalescing key.  If a job with the same key
+# is already queued, the new job is attached to it as a follower
+# instead of being queued.  Once the job starts running, later jobs
+# with its key are queued afresh (they may have been sent because
+# something changed since it started), but aren't started until it's
+# done.  Whoever runs the job calls detach() once it has a result,
+# and reports that result to the followers as well.
+#
+# A worker stuck on a timed-out job is replaced with a fresh one.  It's
+# counted as orphaned in the stats until it comes unstuck.
+#
+# A handler may fork (agent_restart does).  The child's copy of the
+# worker has no pool to go back to -- the other workers didn't come
+# with it -- so it exits once it has reported the job (see forked()).
+
+
+class DispatchPool(object):
+    def __init__(self, size=8, max_queued=64):
+        self.size = max(1, int(size))
+        self.max_queued = max(1, int(max_queued))
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.queue = []
+        self.running = {}
+        # followers of queued jobs, and of running ones, by key
+        self.coalesced = {}
+        self.detached = {}
+        self.busy = 0
+        # workers replaced while stuck, that haven't come back yet
+        self.orphaned = 0
+        self.workers = []
+        self.worker_factory = None
+        self.stopping = False
+        self.pid = os.getpid()
+
+    def start(self, worker_factory):
+        """Start the worker threads.
+
+        :param: worker_factory: callable taking the pool and returning an
+                                unstarted thread that services it
+        """
+        self.worker_factory = worker_factory
+        for x in range(self.size):
+            self._spawn()
+
+    def _spawn(self):
+        worker = self.worker_factory(self)
+        worker.setDaemon(True)
+        self.workers.append(worker)
+        worker.start()
+        return worker
+
+    def forked(self):
+        """Whether we're in a child forked since the pool was made."""
+        return os.getpid() != self.pid
+
+    def _runnable(self, limits):
+        for key, limit in limits:
+            if limit and self.running.get(key, 0) >= limit:
+                return False
+        return True
+
+    def put(self, data, limits=None, key=None):
+        """Queue a job, blocking while the wait queue is full.
+
+        :param: data:   the job to hand to a worker
+        :param: limits: list of (key, limit) concurrency caps
+        :param: key:    coalescing key, or None if the job is unique
+
+        :returns: False if the pool was stopped while waiting
+        """
+        if limits is None:
+            limits = []
+
+        self.lock.acquire()
+        try:
+            if key is not None and key in self.coalesced:
+                LOG.debug('coalescing job with %s' % (key,))
+                self.coalesced[key].append(data)
+                return True
+
+            while len(self.queue) >= self.max_queued and not self.stopping:
+                LOG.debug('dispatch queue full, waiting')
+                self.changed.wait()
+
+            if self.stopping:
+                return False
+
+            if key is not None:
+                # a matching job may have been queued while we waited
+                if key in self.coalesced:
+                    self.coalesced[key].append(data)
+                    return True
+                self.coalesced[key] = []
+
+            self.queue.append((data, limits, key))
+            self.changed.notify_all()
+            return True
+        finally:
+            self.lock.release()
+
+    def get(self):
+        """Take the next runnable job, blocking until there is one.
+
+        :returns: a (data, limits, key) tuple, or None if the pool is
+                  stopping
+        """
+        self.lock.acquire()
+        try:
+            while not self.stopping:
+                # the pool has been shrunk, and we're surplus
+                worker = threading.current_thread()
+                if len(self.workers) > self.size and worker in self.workers:
+                    self.workers.remove(worker)
+                    return None
+
+                for idx, job in enumerate(self.queue):
+                    data, limits, key = job
+                    if self._runnable(limits) and not key in self.detached:
+                        del self.queue[idx]
+                        if key is not None:
+                            self.detached[key] = self.coalesced.pop(key)
+                        for name, limit in limits:
+                            self.running[name] = \
+                                self.running.get(name, 0) + 1
+                        self.busy += 1
+                        self.changed.notify_all()
+                        return job
+                self.changed.wait()
+            return None
+        finally:
+            self.lock.release()
+
+    def detach(self, key):
+        """Finish with a running job's key, returning its followers.
+
+        Queued jobs with the same key may start after this.
+        """
+        if key is None:
+            return []
+
+        self.lock.acquire()
+        try:
+            self.changed.notify_all()
+            return self.detached.pop(key, [])
+        finally:
+            self.lock.release()
+
+    def done(self, limits):
+        """Release the slot and concurrency caps held by a finished job."""
+        self.lock.acquire()
+        try:
+            for key, limit in limits:
+                self.running[key] -= 1
+                if self.running[key] == 0:
+                    del self.running[key]
+            self.busy -= 1
+            self.changed.notify_all()
+        finally:
+            self.lock.release()
+
+    def replace(self, worker):
+        """Start a new worker in place of one that is stuck.
+
+        The old worker is expected to call returned() and exit once it
+        comes unstuck.
+        """
+        self.lock.acquire()
+        try:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.orphaned += 1
+            if not self.stopping:
+                self._spawn()
+        finally:
+            self.lock.release()
+
+    def returned(self, worker):
+        """A worker passed to replace() has come unstuck."""
+        self.lock.acquire()
+        self.orphaned -= 1
+        self.lock.release()
+
+    def resize(self, size, max_queued=None):
+        """Change the number of workers and the wait queue length.
+
+        Surplus workers exit once they've finished their current job.
+        """
+        self.lock.acquire()
+        try:
+            self.size = max(1, int(size))
+            if max_queued is not None:
+                self.max_queued = max(1, int(max_queued))
+            # workers are only spawned here once the pool has started
+            while self.worker_factory is not None and \
+                    len(self.workers) < self.size and not self.stopping:
+                self._spawn()
+            self.changed.notify_all()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Report pool occupancy.
+
+        "available" is the number of idle workers not already spoken
+        for by queued jobs -- how many more tasks could start right now.
+        """
+        self.lock.acquire()
+        try:
+            queued = len(self.queue)
+            return {'workers': self.size,
+                    'busy': self.busy,
+                    'queued': queued,
+                    'max_queued': self.max_queued,
+                    'available': max(0, self.size - self.busy - queued),
+                    # the worker may come back before replace() is done
+                    'orphaned': max(0, self.orphaned)}
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self.stopping = True
+            self.changed.notify_all()
+        finally:
+            self.lock.release()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import contextlib
+import threading
+import time
+
+from opencenteragent import translog
+
+# Per-task phase timing.
+#
+# Each task fetched by the agent carries a Trace, a list of named spans
+# (name, start, end).  Spans are added by whichever part of the agent
+# is handling the task at the time:
+#
+# claim, pending  - by the input plugin (see input_manager.py)
+# queue           - waiting for a dispatch worker
+# dispatch        - the output handler, including any of
+#   script.fork, script.run, script.output  - from BashScriptRunner
+# report_wait, report  - handing the result back to the input plugin
+#
+# While a worker runs a task, the task's trace is the thread's current
+# trace, so code deep inside a plugin can time itself with span()
+# without being handed the trace.  span() does nothing on a thread
+# with no current trace.
+#
+# The spans up to the end of dispatch are attached to the task's
+# result_data (when it's a dict) under "trace", and every span is
+# written to the task's transaction log.
+
+_context = threading.local()
+
+
+class Trace(object):
+    def __init__(self, spans=None, logfile=None):
+        """
+        :param: spans:   initial (name, start, end) spans
+        :param: logfile: transaction log to write spans to, if any
+        """
+        self.lock = threading.Lock()
+        self.spans = [tuple(x) for x in spans or []]
+        self.logfile = logfile
+        self.written = 0
+
+    def add(self, name, start, end):
+        self.lock.acquire()
+        self.spans.append((name, start, end))
+        self.lock.release()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time())
+
+    def summary(self):
+        """The spans so far, as offsets from the start of the first."""
+        self.lock.acquire()
+        spans = sorted(self.spans, key=lambda x: x[1])
+        self.lock.release()
+
+        if not spans:
+            return {'total': 0, 'spans': []}
+
+        origin = spans[0][1]
+        return {'total': round(max([x[2] for x in spans]) - origin, 6),
+                'spans': [{'name': name,
+                           'offset': round(start - origin, 6),
+                           'duration': round(end - start, 6)}
+                          for name, start, end in spans]}
+
+    def write(self):
+        """Append any spans not yet written to the transaction log."""
+        if self.logfile is None:
+            return
+
+        self.lock.acquire()
+        try:
+            spans = self.spans[self.written:]
+            self.written = len(self.spans)
+        finally:
+            self.lock.release()
+
+        if not spans:
+            return
+
+        translog.writer.write(self.logfile, ''.join(
+            ['trace: %-14s %9.3fs  (%s)\n' % (
+                name, end - start,
+                time.strftime('%H:%M:%S', time.localtime(start)))
+             for name, start, end in spans]))
+
+
+def begin(trace):
+    """Make trace the current thread's trace."""
+    _context.trace = trace
+
+
+def end():
+    _context.trace = None
+
+
+def current():
+    return getattr(_context, 'trace', None)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time a block against the current thread's trace, if it has one."""
+    trace = current()
+    if trace is None:
+        yield
+    else:
+        with trace.span(name):
+            yield
@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import collections
+import errno
+import fcntl
+import gzip
+import logging
+import os
+import select
+import shutil
+import threading
+import time
+
+from opencenteragent.metrics import registry
+from opencenteragent.utils import Wakeup
+
+LOG = logging.getLogger('opencenter.translog')
+
+# Transaction logs (see utils.trans_log_path) are written by a single
+# background thread.
+#
+# write() queues data for a log and returns straight away.  The writer
+# thread appends everything queued for a log in one go, keeping up to
+# max_open log files open (closing the least recently used first).  If
+# more than max_buffered bytes are waiting to be written, write()
+# blocks until the writer catches up.
+#
+# Scripts run for a task write their output straight into its log.
+# acquire() hands out the log's file descriptor for that, once
+# everything queued so far has been written, and keeps it open until
+# the matching release().
+#
+# begin() starts a task's log afresh, and close() waits for everything
+# queued for it to be written, then closes it.
+#
+# The janitor thread gzips logs that haven't been written to for a
+# while, and deletes logs past a certain age, or the oldest logs once
+# they take up more than a certain amount of space.
+#
+# A task's log can instead be held in memory (see TransLogBuffer), and
+# only written out if it turns out to be wanted: the task fails or
+# times out, someone watches the log, or it grows too big.  Otherwise
+# it's dropped when the task finishes.  Logs held in memory are found
+# with live_buffer(), so they can be read while the task runs.
+#
+# A plugin's LOG is a TaskLogProxy.  While a dispatch worker runs a
+# task, the task's logger is the thread's current logger (see
+# set_logger()), and log calls made through any plugin's LOG on that
+# thread go to it.  Tasks running at once on other threads, even for
+# the same plugin, have their own.
+
+_context = threading.local()
+
+# logs being held in memory, by path
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+def set_logger(logger):
+    """Make logger the current thread's task logger, or None to clear."""
+    _context.logger = logger
+
+
+def current_logger():
+    return getattr(_context, 'logger', None)
+
+
+class TaskLogProxy(object):
+    """A logger that logs for the current thread's task, if it has one."""
+    def __init__(self, logger):
+        self.default = logger
+
+    def __getattr__(self, name):
+        return getattr(current_logger() or self.default, name)
+
+
+class TransLogWriter(object):
+    def __init__(self, max_open=32, max_buffered=1024 * 1024):
+        self.max_open = max_open
+        self.max_buffered = max_buffered
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.queue = []
+        self.buffered = 0
+        # sequence numbers of the last operation queued, and the last
+        # one carried out
+        self.queued = 0
+        self.done = 0
+        self.thread = None
+        self.running = False
+
+        # open logs, least recently used first, and how many holders
+        # of each log's descriptor there are
+        self.files_lock = threading.Lock()
+        self.files = collections.OrderedDict()
+        self.pinned = {}
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # we're in a forked worker process (see process_pool.py).
+            # the writer thread didn't come with us, and the open
+            # files are the parent's.
+            for fd in self.files.values():
+                os.close(fd)
+            self._reset()
+
+    def _enqueue(self, op, path, data=''):
+        self._check_fork()
+
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+            while self.buffered >= self.max_buffered and self.running:
+                self.changed.wait()
+
+            if self.running:
+                self.queue.append((op, path, data))
+                self.buffered += len(data)
+                self.queued += 1
+                self.changed.notify_all()
+                return
+        finally:
+            self.lock.release()
+
+        # stragglers after stop() are written as they come
+        self._apply([(op, path, data)])
+
+    def begin(self, path):
+        """Start the log at path afresh."""
+        self._enqueue('begin', path)
+
+    def write(self, path, data):
+        """Queue data to be appended to the log at path."""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._enqueue('write', path, data)
+
+    def close(self, path):
+        """Write out everything queued for a log, then close it."""
+        self._enqueue('close', path)
+        self.flush()
+
+    def flush(self):
+        """Wait for everything queued so far to be written."""
+        self._check_fork()
+
+        self.lock.acquire()
+        try:
+            target = self.queued
+            while self.done < target and self.running:
+                self.changed.wait()
+        finally:
+            self.lock.release()
+
+    def acquire(self, path):
+        """Get a log's file descriptor, held open until release().
+
+        Anything already queued for the log is written first.
+        """
+        self.flush()
+
+        self.files_lock.acquire()
+        try:
+            return self._fd(path, pin=True)
+        finally:
+            self.files_lock.release()
+
+    def release(self, path):
+        self.files_lock.acquire()
+        try:
+            self.pinned[path] -= 1
+            if not self.pinned[path]:
+                del self.pinned[path]
+            self._evict()
+        finally:
+            self.files_lock.release()
+
+    def _fd(self, path, truncate=False, pin=False):
+        fd = self.files.pop(path, None)
+        if fd is None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+            try:
+                fd = os.open(path, flags, 0644)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # the first log in its shard
+                _makedirs(os.path.dirname(path))
+                fd = os.open(path, flags, 0644)
+            _cloexec(fd)
+        if truncate:
+            os.ftruncate(fd, 0)
+
+        # most recently used go on the end
+        self.files[path] = fd
+        if pin:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+        self._evict(keep=path)
+        return fd
+
+    def _evict(self, keep=None):
+        # with too many logs pinned, we go over max_open until some
+        # are released
+        for path in list(self.files):
+            if len(self.files) <= self.max_open:
+                break
+            if not path in self.pinned and path != keep:
+                os.close(self.files.pop(path))
+
+    def _close(self, path):
+        if path in self.files and not path in self.pinned:
+            os.close(self.files.pop(path))
+
+    def _write(self, path, chunks):
+        data = ''.join(chunks)
+        try:
+            fd = self._fd(path)
+            while data:
+                data = data[os.write(fd, data):]
+        except OSError as e:
+            LOG.warning('Unable to write transaction log %s: %s' %
+                        (path, str(e)))
+
+    def _apply(self, batch):
+        self.files_lock.acquire()
+        try:
+            # consecutive writes to a log go out together
+            pending = collections.OrderedDict()
+            for op, path, data in batch:
+                if op == 'write':
+                    pending.setdefault(path, []).append(data)
+                    continue
+
+                if path in pending:
+                    self._write(path, pending.pop(path))
+                try:
+                    if op == 'begin':
+                        self._fd(path, truncate=True)
+                    elif op == 'close':
+                        self._close(path)
+                except OSError as e:
+                    LOG.warning('Unable to open transaction log %s: %s' %
+                                (path, str(e)))
+
+            for path, chunks in pending.items():
+                self._write(path, chunks)
+        finally:
+            self.files_lock.release()
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            while not self.queue and self.running:
+                self.changed.wait()
+            batch = self.queue
+            self.queue = []
+            last = self.queued
+            running = self.running
+            self.lock.release()
+
+            try:
+                self._apply(batch)
+            except Exception:
+                LOG.exception('Error writing transaction logs')
+
+            self.lock.acquire()
+            self.buffered -= sum([len(data) for op, path, data in batch])
+            self.done = last
+            self.changed.notify_all()
+            self.lock.release()
+
+            if not running and not batch:
+                break
+
+    def is_open(self, path):
+        self.files_lock.acquire()
+        try:
+            return path in self.files
+        finally:
+            self.files_lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'open': len(self.files),
+                    'queued': len(self.queue),
+                    'buffered': self.buffered}
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Write out everything queued, and close all the logs."""
+        self.lock.acquire()
+        thread = self.thread
+        self.running = False
+        self.changed.notify_all()
+        self.lock.release()
+
+        if thread is not None:
+            thread.join(5)
+
+        self.files_lock.acquire()
+        for fd in self.files.values():
+            os.close(fd)
+        self.files.clear()
+        self.files_lock.release()
+
+
+def _cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class TransLogJanitor(threading.Thread):
+    """Compresses idle transaction logs, and removes old ones."""
+    def __init__(self, base, interval=3600, compress_after=3600,
+                 max_age=0, max_size=0, log_writer=None):
+        """
+        :param: base:           trans_log_dir
+        :param: interval:       seconds between sweeps
+        :param: compress_after: gzip logs not written to for this many
+                                seconds (0 to never compress them)
+        :param: max_age:        seconds to keep logs for (0 for ever)
+        :param: max_size:       bytes of logs to keep (0 for no limit)
+        """
+        super(TransLogJanitor, self).__init__()
+        self.setDaemon(True)
+
+        self.base = base
+        self.interval = interval
+        self.compress_after = compress_after
+        self.max_age = max_age
+        self.max_size = max_size
+        self.writer = log_writer or writer
+        self.stopping = Wakeup()
+        self.running = False
+
+    def _files(self):
+        # flat-layout logs from older agents, then the shards
+        dirs = [self.base]
+        for name in os.listdir(self.base):
+            path = os.path.join(self.base, name)
+            if len(name) == 2 and os.path.isdir(path):
+                dirs.append(path)
+
+        found = []
+        for path in dirs:
+            for name in os.listdir(path):
+                if name.startswith('trans_') and \
+                        name.endswith(('.log', '.prof', '.log.gz',
+                                       '.prof.gz')):
+                    try:
+                        found.append((os.path.join(path, name),
+                                      os.stat(os.path.join(path, name))))
+                    except OSError:
+                        # deleted from under us
+                        pass
+        return found
+
+    def _compress(self, path, st):
+        tmp = path + '.gz.tmp'
+        try:
+            with open(path, 'rb') as f:
+                out = gzip.open(tmp, 'wb')
+                try:
+                    shutil.copyfileobj(f, out)
+                finally:
+                    out.close()
+            # keep the log's age for retention
+            os.utime(tmp, (st.st_atime, st.st_mtime))
+            os.rename(tmp, path + '.gz')
+            os.unlink(path)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to compress %s: %s' % (path, str(e)))
+            return path, st
+
+        registry.incr('translog.compressed')
+        return path + '.gz', os.stat(path + '.gz')
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+            registry.incr('translog.removed')
+        except OSError as e:
+            LOG.warning('Unable to remove %s: %s' % (path, str(e)))
+
+    def sweep(self):
+        """Compress and remove logs as needed."""
+        now = time.time()
+        kept = []
+        for path, st in self._files():
+            # logs still being written to are left alone, however old
+            if self.writer.is_open(path):
+                kept.append((path, st))
+                continue
+
+            if self.max_age and now - st.st_mtime > self.max_age:
+                self._remove(path)
+                continue
+
+            if self.compress_after and not path.endswith('.gz') and \
+                    now - st.st_mtime > self.compress_after:
+                path, st = self._compress(path, st)
+            kept.append((path, st))
+
+        if self.max_size:
+            total = sum([st.st_size for path, st in kept])
+            for path, st in sorted(kept, key=lambda x: x[1].st_mtime):
+                if total <= self.max_size:
+                    break
+                if self.writer.is_open(path):
+                    continue
+                self._remove(path)
+                total -= st.st_size
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                self.sweep()
+            except (IOError, OSError):
+                LOG.exception('Error cleaning up transaction logs')
+            self.stopping.wait(self.interval)
+
+    def stop(self):
+        running = self.running
+        self.running = False
+        if running:
+            self.stopping.notify()
+            self.join(5)
+
+
+def live_buffer(path):
+    """The TransLogBuffer holding the log at path, if there is one."""
+    _buffers_lock.acquire()
+    try:
+        return _buffers.get(path)
+    finally:
+        _buffers_lock.release()
+
+
+def spill(path, reason):
+    """Write the log at path out to disk, if it's held in memory."""
+    buf = live_buffer(path)
+    if buf is not None:
+        buf.spill(reason)
+
+
+class TransLogBuffer(object):
+    """A task's transaction log, held in memory until it's wanted."""
+    def __init__(self, path, max_size, log_writer=None):
+        """
+        :param: path:     where the log goes if it's written out
+        :param: max_size: bytes to hold before writing the log out
+        """
+        self.path = path
+        self.max_size = max_size
+        self.writer = log_writer or writer
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.size = 0
+        self.spilled = False
+
+        # scripts write to pipes, which are read into the buffer until
+        # the log is closed
+        self.pipes = set()
+        self.pumps = []
+        self.closing = None
+
+        _buffers_lock.acquire()
+        _buffers[path] = self
+        _buffers_lock.release()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.lock.acquire()
+        try:
+            if self.spilled:
+                self.writer.write(self.path, data)
+                return
+
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size <= self.max_size:
+                return
+        finally:
+            self.lock.release()
+
+        self.spill('size')
+
+    def spill(self, reason):
+        """Write the log out, and carry on writing it to disk."""
+        self.lock.acquire()
+        try:
+            if self.spilled:
+                return
+            self.spilled = True
+            self.writer.begin(self.path)
+            self.writer.write(self.path, ''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+        finally:
+            self.lock.release()
+
+        LOG.debug('Writing out transaction log %s (%s)' % (self.path,
+                                                           reason))
+        registry.incr('translog.spilled', key=reason)
+
+    def getvalue(self):
+        """The log so far, or None once it's been written out."""
+        self.lock.acquire()
+        try:
+            if self.spilled:
+                return None
+            return ''.join(self.chunks)
+        finally:
+            self.lock.release()
+
+    def acquire(self):
+        """A file descriptor for a script to write the log to.
+
+        Hand it back with release() once the script has started.
+        """
+        self.lock.acquire()
+        try:
+            if not self.spilled:
+                if self.closing is None:
+                    self.closing = Wakeup()
+                read, write = os.pipe()
+                _cloexec(read)
+                _cloexec(write)
+                pump = threading.Thread(target=self._pump, args=(read,))
+                pump.setDaemon(True)
+                pump.start()
+                self.pumps.append(pump)
+                self.pipes.add(write)
+                return write
+        finally:
+            self.lock.release()
+
+        return self.writer.acquire(self.path)
+
+    def release(self, fd):
+        self.lock.acquire()
+        try:
+            if fd in self.pipes:
+                self.pipes.remove(fd)
+                os.close(fd)
+                return
+        finally:
+            self.lock.release()
+
+        self.writer.release(self.path)
+
+    def _pump(self, fd):
+        try:
+            while True:
+                ready = select.select([fd, self.closing.read_fd],
+                                      [], [])[0]
+                if self.closing.read_fd in ready:
+                    break
+                data = os.read(fd, 65536)
+                if not data:
+                    return
+                self.write(data)
+
+            # the task's scripts have exited, so everything they wrote
+            # is in the pipe.  anything still holding it open was left
+            # running in the background, and isn't waited for.
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            deadline = time.time() + 1
+            while time.time() < deadline:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    break
+                if not data:
+                    return
+                self.write(data)
+
+            LOG.debug('Not logging output from processes left running '
+                      'for %s' % self.path)
+        finally:
+            os.close(fd)
+
+    def close(self, keep=False):
+        """Finish with the log, dropping it unless it's been written out.
+
+        :param: keep: write the log out if it hasn't been already
+
+        :returns: True if the log was written out
+        """
+        # read in what the task's scripts wrote before they exited,
+        # and stop reading their pipes
+        if self.closing is not None:
+            self.closing.notify()
+            # each pump reads for at most a second once woken
+            deadline = time.time() + 5
+            for pump in self.pumps:
+                pump.join(max(0, deadline - time.time()))
+            if [pump for pump in self.pumps if pump.isAlive()]:
+                LOG.warning('Still reading script output for %s' %
+                            self.path)
+            else:
+                self.closing.close()
+
+        if keep:
+            self.spill('failed')
+
+        _buffers_lock.acquire()
+        if _buffers.get(self.path) is self:
+            del _buffers[self.path]
+        _buffers_lock.release()
+
+        if self.spilled:
+            self.writer.close(self.path)
+            return True
+
+        registry.incr('translog.dropped')
+        return False
+
+
+class TransLogHandler(logging.Handler):
+    """A logging handler that writes to a transaction log."""
+    def __init__(self, path, log_writer=None, buffer=None):
+        """
+        :param: buffer: a TransLogBuffer to hold the log in, if any
+        """
+        logging.Handler.__init__(self)
+        self.path = path
+        self.writer = log_writer or writer
+        self.buffer = buffer
+
+    def emit(self, record):
+        try:
+            data = self.format(record) + '\n'
+            if self.buffer is not None:
+                self.buffer.write(data)
+            else:
+                self.writer.write(self.path, data)
+        except Exception:
+            self.handleError(record)
+
+    def open_fd(self):
+        """A file descriptor for a script to write the log to.
+
+        :returns: the descriptor, or None if the log can't be opened
+        """
+        try:
+            if self.buffer is not None:
+                return self.buffer.acquire()
+            return self.writer.acquire(self.path)
+        except OSError:
+            return None
+
+    def close_fd(self, fd):
+        if self.buffer is not None:
+            self.buffer.release(fd)
+        else:
+            self.writer.release(self.path)
+
+
+writer = TransLogWriter()
@@ -25,8 +25,12 @@
 #
 
 import contextlib
+import errno
+import fcntl
+import hashlib
 import logging
 import os
+import select
 import shutil
 import sys
 import tempfile
@@ -42,6 +46,46 @@ def detailed_exception():
     return full_traceback
 
 
+def boolean(value):
+    """Interpret a config file value as a boolean."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def trans_log_path(config, task_id, kind='log'):
+    """Path to a task's transaction log, or another per-task file.
+
+    The files are spread over 256 subdirectories of trans_log_dir, by
+    a hash of the task id, so no one directory gets too big.
+
+    :param: config:  the agent config
+    :param: task_id: the task's id
+    :param: kind:    file extension -- 'log', or 'prof' for profiles
+    """
+    base = config.get('main', {}).get('trans_log_dir', '/var/log/opencenter')
+    shard = hashlib.md5(str(task_id)).hexdigest()[:2]
+    return os.path.join(base, shard, 'trans_%s.%s' % (task_id, kind))
+
+
+def find_trans_log(config, task_id, kind='log'):
+    """Find an existing transaction log or other per-task file.
+
+    Besides where trans_log_path() puts it, the file may have been
+    compressed (see translog.TransLogJanitor), or be in trans_log_dir
+    itself, from before the files were sharded.
+
+    :returns: the path, or None if there's no such file
+    """
+    path = trans_log_path(config, task_id, kind)
+    flat = os.path.join(os.path.dirname(os.path.dirname(path)),
+                        os.path.basename(path))
+    for candidate in (path, path + '.gz', flat, flat + '.gz'):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
 @contextlib.contextmanager
 def temporary_file():
     try:
@@ -64,3 +108,58 @@ def temporary_directory():
     finally:
         if os.path.exists(path):
             shutil.rmtree(path)
+
+
+class Wakeup(object):
+    """A wakeup flag one thread can wait on and any thread can set.
+
+    notify() may be called any number of times from any thread.  wait()
+    returns as soon as notify() has been called since the previous
+    wait() returned, or when the timeout expires.  It's built on a pipe
+    so that waiting, even with a timeout, doesn't burn CPU the way
+    threading.Condition.wait(timeout) does.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            fl = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fl | fcntl.FD_CLOEXEC)
+
+    def notify(self):
+        try:
+            os.write(self.write_fd, '.')
+        except OSError as e:
+            # a full pipe means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """Wait for a notify().
+
+        :param: timeout: seconds to wait, or None to wait forever
+
+        :returns: True if woken by notify(), False on timeout or signal
+        """
+        try:
+            ready = select.select([self.read_fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+
+        if not ready:
+            return False
+
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
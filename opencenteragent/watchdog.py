@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import errno
+import heapq
+import logging
+import os
+import signal
+import threading
+import time
+
+from opencenteragent.utils import Wakeup
+
+LOG = logging.getLogger('opencenter.watchdog')
+
+# The watchdog enforces the timeouts actions are registered with.
+#
+# A dispatch worker calls watch() before running a handler and
+# release() afterwards.  Between the two, any child processes started
+# for the task (see register_child(), called from BashExec) are tracked
+# against the watch.  If the deadline passes first, the watchdog sends
+# SIGTERM to each child's process group, then SIGKILL after a grace
+# period, and calls the watch's expire callback.  release() tells the
+# worker whether it finished in time or whether the watchdog already
+# reported the task as timed out.
+
+_context = threading.local()
+
+
+def register_child(pid):
+    """Track a child process group started for the current thread's task.
+
+    The child should have made itself a process group leader.
+    """
+    watch = getattr(_context, 'watch', None)
+    if watch is not None:
+        watch.lock.acquire()
+        watch.children.add(pid)
+        watch.lock.release()
+
+
+def unregister_child(pid):
+    """Stop tracking a child, usually because it has been reaped."""
+    watch = getattr(_context, 'watch', None)
+    if watch is not None:
+        watch.lock.acquire()
+        watch.children.discard(pid)
+        watch.lock.release()
+
+
+def _killpg(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class Watch(object):
+    def __init__(self, timeout, on_expire):
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        self.children = set()
+        self.expired = False
+        self.finished = False
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, kill_grace=10):
+        super(Watchdog, self).__init__()
+        self.setDaemon(True)
+
+        self.kill_grace = kill_grace
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
+        self.deadlines = []
+        self.running = False
+
+    def watch(self, timeout, on_expire):
+        """Start watching the calling thread's task.
+
+        :param: timeout:   seconds before the task is considered hung
+        :param: on_expire: called from the watchdog thread on expiry
+
+        :returns: a Watch to hand back to release()
+        """
+        watch = Watch(timeout, on_expire)
+        _context.watch = watch
+        self._schedule(watch.deadline, self._expire, watch)
+        return watch
+
+    def release(self, watch):
+        """Stop watching a task.
+
+        :returns: True if the task finished in time, False if the
+                  watchdog has already expired it
+        """
+        _context.watch = None
+        watch.lock.acquire()
+        try:
+            if watch.expired:
+                return False
+            watch.finished = True
+            return True
+        finally:
+            watch.lock.release()
+
+    def later(self, delay, fn):
+        """Call fn from the watchdog thread after delay seconds."""
+        self._schedule(time.time() + delay, lambda watch: fn(), None)
+
+    def _schedule(self, when, fn, watch):
+        self.lock.acquire()
+        heapq.heappush(self.deadlines, (when, id(watch), fn, watch))
+        self.lock.release()
+        self.wakeup.notify()
+
+    def _expire(self, watch):
+        watch.lock.acquire()
+        try:
+            if watch.finished:
+                return
+            watch.expired = True
+            children = list(watch.children)
+        finally:
+            watch.lock.release()
+
+        LOG.warning('Task exceeded its %ss timeout, killing %d child '
+                    'process group(s)' % (watch.timeout, len(children)))
+        for pid in children:
+            _killpg(pid, signal.SIGTERM)
+
+        if children:
+            self._schedule(time.time() + self.kill_grace, self._kill, watch)
+
+        watch.on_expire()
+
+    def _kill(self, watch):
+        watch.lock.acquire()
+        children = list(watch.children)
+        watch.lock.release()
+
+        for pid in children:
+            LOG.warning('Process group %s ignored SIGTERM, killing' % pid)
+            _killpg(pid, signal.SIGKILL)
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            self.lock.acquire()
+            due = []
+            now = time.time()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                due.append(heapq.heappop(self.deadlines))
+
+            # released watches are left in the heap and skipped when
+            # they come due, so the heap can hold finished entries
+            timeout = None
+            if self.deadlines:
+                timeout = self.deadlines[0][0] - now
+            self.lock.release()
+
+            for when, key, fn, watch in due:
+                try:
+                    fn(watch)
+                except Exception:
+                    LOG.exception('Error expiring task')
+
+            if not due:
+                self.wakeup.wait(timeout)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.notify()
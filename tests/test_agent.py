@@ -28,14 +28,22 @@ import fixtures
 import fcntl
 import logging
 import os
+import signal
 import StringIO
 import sys
 import testtools
+import threading
+import time
 import unittest
 
 from opencenteragent import exceptions
 from opencenteragent import OpenCenterAgent
+from opencenteragent import OpenCenterAgentDispatchWorker
+from opencenteragent import tracing
+from opencenteragent import translog
 from opencenteragent import utils
+from opencenteragent.pool import DispatchPool
+from opencenteragent.watchdog import Watchdog
 
 
 # Suppress WARNING logs
@@ -327,7 +335,7 @@ class TestInfrastructure(testtools.TestCase):
 
         agent = OpenCenterAgentNoInitialization([])
         background, debug, config_file = agent._parse_opts(
-            ['--config', 'gerkin', '--verbose', '-d'])
+            ['--config', 'gerkin', '--verbose', '-d', '-C', 'cache'])
 
         self.assertEqual(self.exit_code_set, None)
         self.assertEqual(len(io.getvalue()), 0)
@@ -335,6 +343,7 @@ class TestInfrastructure(testtools.TestCase):
         self.assertTrue(background)
         self.assertTrue(debug)
         self.assertEqual(config_file, 'gerkin')
+        self.assertEqual(agent.config_cache_dir, 'cache')
 
     def test_configure_logs_no_config(self):
         agent = OpenCenterAgentNoInitialization([])
@@ -434,6 +443,99 @@ endpoint = butthis""")
             self.assertEquals(config['taskerator']['endpoint'], 'butthis')
             self.assertEquals(config['taskerator']['original'], 'foo')
 
+    def test_read_config_cache(self):
+        agent = OpenCenterAgentNoInitialization([])
+        agent.config_section = 'taskerator'
+        with utils.temporary_directory() as path:
+            # created as needed
+            agent.config_cache_dir = os.path.join(path, 'cache')
+            config_file = os.path.join(path, 'config')
+            included_dir = os.path.join(path, 'included')
+            os.mkdir(included_dir)
+
+            with open(config_file, 'w') as f:
+                f.write("""[taskerator]
+endpoint = http://127.0.0.1:8080/admin
+include_dir = %s""" % included_dir)
+            with open(os.path.join(included_dir, 'foo.conf'), 'w') as f:
+                f.write("""[taskerator]
+log = %(base_dir)s/log""")
+
+            config = agent._read_config(config_file,
+                                        defaults={'base_dir': '/base'})
+            self.assertEqual(config['taskerator']['log'], '/base/log')
+
+            # nothing is parsed while the files stay the same
+            def no_parsing(*args):
+                raise AssertionError('configuration was parsed')
+
+            agent._read_config_file = no_parsing
+            config = agent._read_config(config_file,
+                                        defaults={'base_dir': '/base'})
+            self.assertEqual(config['taskerator']['log'], '/base/log')
+            del agent._read_config_file
+
+            # but a new file in the include dir is picked up
+            with open(os.path.join(included_dir, 'zzz.conf'), 'w') as f:
+                f.write("""[taskerator]
+log = elsewhere""")
+            os.utime(included_dir, (0, 0))
+            config = agent._read_config(config_file,
+                                        defaults={'base_dir': '/base'})
+            self.assertEqual(config['taskerator']['log'], 'elsewhere')
+
+    def test_reload_config(self):
+        agent = OpenCenterAgentNoInitialization([])
+        agent.config_section = 'main'
+        reconfigured = []
+
+        class Handler(object):
+            def reconfigure(self, sections):
+                reconfigured.append(sections)
+
+        with utils.temporary_directory() as path:
+            agent.config_cache_dir = path
+            agent.configfile = os.path.join(path, 'config')
+            with open(agent.configfile, 'w') as f:
+                f.write("""[main]
+trans_log_dir = /tmp
+dispatch_workers = 2
+
+[plugin]
+value = 1""")
+            config = agent.config = agent._read_config(
+                agent.configfile, defaults={'base_dir': agent.base})
+            main = config['main']
+            agent.pool = DispatchPool(2, 4)
+            agent.output_handler = agent.input_handler = Handler()
+
+            agent._reload_config()
+            self.assertEqual(reconfigured, [])
+
+            with open(agent.configfile, 'w') as f:
+                f.write("""[main]
+trans_log_dir = /var/tmp
+dispatch_workers = 3
+
+[other]
+value = 2""")
+            agent._reload_config()
+
+            # the same dicts, with the new values
+            self.assertTrue(agent.config is config)
+            self.assertTrue(agent.config['main'] is main)
+            self.assertEqual(main['trans_log_dir'], '/var/tmp')
+            self.assertFalse('plugin' in config)
+            self.assertEqual(config['other']['value'], '2')
+            self.assertEqual(agent.pool.size, 3)
+            self.assertEqual(reconfigured, [['main', 'other', 'plugin']] * 2)
+
+            # a broken config is ignored
+            with open(agent.configfile, 'w') as f:
+                f.write('')
+            agent._reload_config()
+            self.assertEqual(main['trans_log_dir'], '/var/tmp')
+
     def test_handle_pidfile_exists(self):
         self.useFixture(fixtures.MonkeyPatch('sys.exit', self.fake_exit))
 
@@ -513,5 +615,211 @@ endpoint = butthis""")
         self.assertTrue(self.fork_called)
 
 
+class FakeInputHandler(object):
+    def __init__(self):
+        self.results = []
+        self.got_result = threading.Event()
+
+    def result(self, data):
+        self.results.append(data)
+        self.got_result.set()
+
+
+class FakeOutputHandler(object):
+    def __init__(self, output, delay=0, timeout=None):
+        self.output = output
+        self.delay = delay
+        self.timeout_value = timeout
+        self.release = threading.Event()
+
+    def timeout(self, action):
+        return self.timeout_value
+
+    def dispatch(self, input_data):
+        if self.delay:
+            self.release.wait(self.delay)
+        return self.output
+
+
+class TestDispatchWorker(unittest.TestCase):
+    def test_dispatch(self):
+        pool = DispatchPool(1, 1)
+        pool.put({'input': {'action': 'test'}, 'plugin': 'input'})
+        data, limits, key = pool.get()
+
+        input_handler = FakeInputHandler()
+        output_handler = FakeOutputHandler({'result_code': 0})
+        worker = OpenCenterAgentDispatchWorker(input_handler, output_handler,
+                                               None, pool)
+
+        self.assertTrue(worker.dispatch(data, limits))
+        self.assertEqual(input_handler.results[0]['output'],
+                         {'result_code': 0})
+        self.assertEqual(pool.stats()['busy'], 0)
+
+    def test_dispatch_trace(self):
+        pool = DispatchPool(1, 1)
+        pool.put({'input': {'action': 'test'}, 'plugin': 'input',
+                  'queued_at': time.time()})
+        data, limits, key = pool.get()
+
+        input_handler = FakeInputHandler()
+        output = {'result_code': 0, 'result_data': {'a': 1}}
+        output_handler = FakeOutputHandler(output)
+        worker = OpenCenterAgentDispatchWorker(input_handler, output_handler,
+                                               None, pool)
+
+        self.assertTrue(worker.dispatch(data, limits))
+        result_data = input_handler.results[0]['output']['result_data']
+        self.assertEqual(result_data['a'], 1)
+        self.assertEqual([x['name'] for x in result_data['trace']['spans']],
+                         ['queue', 'dispatch'])
+
+        # the handler's own dict is left alone
+        self.assertEqual(output['result_data'], {'a': 1})
+
+    def test_dispatch_coalesced(self):
+        pool = DispatchPool(1, 1)
+        key = ('test', '{}')
+        pool.put({'input': {'action': 'test', 'id': 1}}, key=key)
+        pool.put({'input': {'action': 'test', 'id': 2}}, key=key)
+        self.assertEqual(pool.stats()['queued'], 1)
+        data, limits, key = pool.get()
+
+        input_handler = FakeInputHandler()
+        output_handler = FakeOutputHandler({'result_code': 0})
+        worker = OpenCenterAgentDispatchWorker(input_handler, output_handler,
+                                               None, pool)
+
+        self.assertTrue(worker.dispatch(data, limits, key))
+        self.assertEqual([r['input']['id'] for r in input_handler.results],
+                         [1, 2])
+        self.assertEqual([r['output'] for r in input_handler.results],
+                         [{'result_code': 0}, {'result_code': 0}])
+
+    def test_dispatch_coalesced_log(self):
+        with utils.temporary_directory() as path:
+            logs = [os.path.join(path, 'trans_%d.log' % x) for x in (1, 2)]
+            pool = DispatchPool(1, 1)
+            key = ('test', '{}')
+            for x, log in zip((1, 2), logs):
+                pool.put({'input': {'action': 'test', 'id': x},
+                          'trace': tracing.Trace(logfile=log)}, key=key)
+            data, limits, key = pool.get()
+
+            worker = OpenCenterAgentDispatchWorker(
+                FakeInputHandler(), FakeOutputHandler({'result_code': 0}),
+                None, pool)
+            self.assertTrue(worker.dispatch(data, limits, key))
+            translog.writer.flush()
+
+            # the follower's log points at the task that did the work
+            with open(logs[1]) as f:
+                self.assertEqual(f.read(), 'coalesced with task 1, see %s\n'
+                                 % logs[0])
+
+    def test_dispatch_forked(self):
+        # a handler that forks, as agent_restart does
+        class ForkingOutputHandler(FakeOutputHandler):
+            def dispatch(self, input_data):
+                self.pid = os.fork()
+                if self.pid:
+                    return {'result_code': 0, 'result_data': 'parent'}
+                return {'result_code': 0, 'result_data': 'child'}
+
+        pool = DispatchPool(1, 1)
+        output_handler = ForkingOutputHandler(None)
+        pool.start(lambda pool: OpenCenterAgentDispatchWorker(
+            FakeInputHandler(), output_handler, None, pool))
+        pool.put({'input': {'action': 'test'}, 'plugin': 'input'})
+
+        # the child's worker exits once it's done, rather than waiting
+        # on the pool for more work
+        deadline = time.time() + 5
+        while not hasattr(output_handler, 'pid') and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        pid = output_handler.pid
+        try:
+            while time.time() < deadline:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    pid = None
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pid, None)
+        finally:
+            if pid is not None:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            pool.stop()
+
+    def test_dispatch_timeout(self):
+        wd = Watchdog()
+        wd.start()
+        pool = DispatchPool(1, 1)
+        pool.worker_factory = lambda pool: threading.Thread()
+        pool.put({'input': {'action': 'test'}, 'plugin': 'input'})
+        data, limits, key = pool.get()
+
+        input_handler = FakeInputHandler()
+        output_handler = FakeOutputHandler({'result_code': 0}, delay=5,
+                                           timeout=0.05)
+        worker = OpenCenterAgentDispatchWorker(input_handler, output_handler,
+                                               wd, pool)
+        result = []
+        t = threading.Thread(target=lambda: result.append(
+            worker.dispatch(data, limits)))
+        t.start()
+
+        # the timeout is reported, and the worker replaced, while the
+        # handler is still running.  its slot is held for kill_grace.
+        input_handler.got_result.wait(5)
+        self.assertEqual(input_handler.results[0]['output']['result_code'],
+                         252)
+        self.assertEqual(pool.stats()['busy'], 1)
+        self.assertEqual(pool.stats()['orphaned'], 1)
+        self.assertEqual(len(pool.workers), 1)
+
+        # and the late result is thrown away
+        output_handler.release.set()
+        t.join()
+        self.assertEqual(result, [False])
+        self.assertEqual(len(input_handler.results), 1)
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertEqual(pool.stats()['orphaned'], 0)
+        wd.stop()
+
+    def test_dispatch_timeout_grace(self):
+        wd = Watchdog(kill_grace=0.1)
+        wd.start()
+        pool = DispatchPool(1, 1)
+        pool.worker_factory = lambda pool: threading.Thread()
+        pool.put({'input': {'action': 'test'}, 'plugin': 'input'})
+        data, limits, key = pool.get()
+
+        input_handler = FakeInputHandler()
+        output_handler = FakeOutputHandler({'result_code': 0}, delay=5,
+                                           timeout=0.05)
+        worker = OpenCenterAgentDispatchWorker(input_handler, output_handler,
+                                               wd, pool)
+        t = threading.Thread(target=worker.dispatch, args=(data, limits))
+        t.start()
+
+        # the slot is freed once kill_grace is up, even though the
+        # handler is still stuck
+        deadline = time.time() + 5
+        while pool.stats()['busy'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertEqual(pool.stats()['orphaned'], 1)
+
+        # and not freed again when it comes back
+        output_handler.release.set()
+        t.join()
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertEqual(pool.stats()['orphaned'], 0)
+        wd.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import imp
+import json
+import os
+import unittest
+import urllib2
+
+fake_server = imp.load_source(
+    'fake_server',
+    os.path.join(os.path.dirname(__file__), '..', 'benchmarks',
+                 'fake_server.py'))
+
+
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_server.FakeOpenCenter(poll_timeout=0.1)
+        self.server = fake_server.FakeServer(self.fake)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def request(self, path, method='GET', body=None, driver=False):
+        headers = {'Content-Type': 'application/json'}
+        if driver:
+            headers['X-Load-Driver'] = '1'
+        request = urllib2.Request(self.server.url + path,
+                                  json.dumps(body) if body else None,
+                                  headers)
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request)
+            return response.getcode(), json.loads(response.read())
+        except urllib2.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def test_parse_value(self):
+        self.assertEqual(fake_server._parse_value(''), '')
+        self.assertEqual(fake_server._parse_value(' "x" '), 'x')
+        self.assertEqual(fake_server._parse_value('None'), None)
+        self.assertEqual(fake_server._parse_value('4'), 4)
+
+    def test_task_round_trip(self):
+        # an agent registers...
+        status, resp = self.request('/nodes/whoami', 'POST',
+                                    {'hostname': 'agent'})
+        self.assertEqual(status, 200)
+        node_id = resp['node_id']
+        status, resp = self.request('/nodes/whoami', 'POST',
+                                    {'node_id': node_id})
+        self.assertEqual(resp['node']['name'], 'agent')
+
+        status, resp = self.request('/nodes/filter', 'POST',
+                                    {'filter': 'name = "agent"'})
+        self.assertEqual([n['id'] for n in resp['nodes']], [node_id])
+
+        # ...is given a task...
+        status, resp = self.request('/nodes/%d/tasks_blocking' % node_id)
+        self.assertEqual(status, 404)
+        status, resp = self.request('/tasks/', 'POST',
+                                    {'node_id': node_id, 'action': 'x'},
+                                    driver=True)
+        self.assertEqual(status, 201)
+        task_id = resp['task']['id']
+        status, resp = self.request('/nodes/%d/tasks_blocking' % node_id)
+        self.assertEqual(resp['task']['id'], task_id)
+
+        # ...and reports it done
+        status, resp = self.request('/tasks/%d' % task_id, 'PUT',
+                                    {'state': 'done'})
+        self.assertEqual(resp['task']['state'], 'done')
+
+        stats = self.fake.stats()
+        self.assertTrue(task_id in stats['completed'])
+        self.assertEqual(stats['driver_requests'], 1)
+        self.assertEqual(stats['requests']['PUT /tasks/<id>'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import os
+import unittest
+
+from opencenteragent import journal
+from opencenteragent import utils
+
+
+def _task(tid, action='test'):
+    return {'plugin': 'input', 'input': {'id': tid, 'action': action}}
+
+
+class TestJournal(unittest.TestCase):
+    def test_replay(self):
+        with utils.temporary_directory() as path:
+            jfile = os.path.join(path, 'agent.journal')
+            j = journal.Journal(jfile, sync_interval=0)
+            self.assertEqual(j.open(), [])
+
+            first = j.intake(_task(1))
+            second = j.intake(_task(2))
+            j.intake(_task(3))
+            j.done(second)
+            # as if the agent crashed part way through a write
+            os.write(j.fd, '{"op": "done", "i')
+            j.close()
+
+            j = journal.Journal(jfile, sync_interval=0)
+            tasks = j.open()
+            self.assertEqual([t['input']['id'] for t in tasks], [1, 3])
+
+            # ids carry on from the old run
+            self.assertTrue(j.intake(_task(4)) > tasks[-1]['id'])
+            j.done(first)
+            j.close()
+
+    def test_compact(self):
+        with utils.temporary_directory() as path:
+            jfile = os.path.join(path, 'agent.journal')
+            j = journal.Journal(jfile, sync_interval=0, compact_after=5)
+            j.open()
+
+            j.intake(_task(0))
+            for x in range(1, 6):
+                j.done(j.intake(_task(x)))
+            j.sync()
+
+            with open(jfile) as f:
+                self.assertEqual(len(f.readlines()), 1)
+            j.close()
+
+            j = journal.Journal(jfile)
+            self.assertEqual([t['input']['id'] for t in j.open()], [0])
+            j.close()
+
+    def test_creates_directory(self):
+        with utils.temporary_directory() as path:
+            jfile = os.path.join(path, 'logs', 'agent.journal')
+            j = journal.Journal(jfile)
+            self.assertEqual(j.open(), [])
+            j.close()
+            self.assertTrue(os.path.isfile(jfile))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import json
+import os
+import socket
+import unittest
+
+from opencenteragent import metrics
+from opencenteragent import utils
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters_and_gauges(self):
+        self.registry.incr('fetched')
+        self.registry.incr('fetched', 2)
+        self.registry.incr('failures', key='a')
+        self.registry.incr('failures', key='b')
+        self.registry.gauge('inflight', 1)
+        self.registry.gauge('inflight', 1)
+        self.registry.gauge('inflight', -1)
+        self.registry.set_gauge('workers', 8)
+
+        snap = self.registry.snapshot()
+        self.assertEqual(snap['counters'], {'fetched': 3,
+                                            'failures': {'a': 1, 'b': 1}})
+        self.assertEqual(snap['gauges'], {'inflight': 1, 'workers': 8})
+
+    def test_histogram(self):
+        for value in (0.001, 0.2, 0.2, 7200):
+            self.registry.observe('latency', value, key='action')
+
+        hist = self.registry.snapshot()['histograms']['latency']['action']
+        self.assertEqual(hist['count'], 4)
+        self.assertEqual(hist['max'], 7200)
+        self.assertEqual(hist['buckets']['0.005'], 1)
+        self.assertEqual(hist['buckets']['0.25'], 3)
+        self.assertEqual(hist['buckets']['3600'], 3)
+        self.assertEqual(hist['buckets']['+Inf'], 4)
+
+    def test_collectors(self):
+        self.registry.register_collector('pool', lambda: {'busy': 2})
+        self.registry.register_collector('broken', lambda: 1 / 0)
+        snap = self.registry.snapshot()
+        self.assertEqual(snap['pool'], {'busy': 2})
+        self.assertFalse('broken' in snap)
+
+        self.registry.unregister_collector('pool')
+        self.assertFalse('pool' in self.registry.snapshot())
+
+    def _get(self, path, url):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall('GET %s HTTP/1.0\r\n\r\n' % url)
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response.split('\r\n\r\n', 1)
+
+    def test_stats_server(self):
+        self.registry.incr('fetched')
+        with utils.temporary_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'stats')
+            server = metrics.StatsServer(path, self.registry)
+            server.start()
+            try:
+                headers, body = self._get(path, '/stats')
+                self.assertTrue(headers.startswith('HTTP/1.0 200'))
+                self.assertEqual(json.loads(body)['counters'],
+                                 {'fetched': 1})
+
+                headers, body = self._get(path, '/nope')
+                self.assertTrue(headers.startswith('HTTP/1.0 404'))
+            finally:
+                server.stop()
+            self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
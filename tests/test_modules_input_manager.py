@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import os
+import unittest
+
+from opencenteragent.journal import Journal
+from opencenteragent.modules import input_manager
+from opencenteragent import utils
+
+
+PLUGIN = """
+name = 'queued'
+queue = []
+
+
+def setup(config={}):
+    pass
+
+
+def fetch():
+    if queue:
+        return queue.pop()
+    return {}
+
+
+def add(task):
+    queue.append(task)
+    wakeup()
+"""
+
+
+BUSY_PLUGIN = """
+name = '%s'
+
+
+def setup(config={}):
+    pass
+
+
+def fetch():
+    return {'id': 1, 'action': name}
+
+
+def depth():
+    return 1
+"""
+
+
+BATCH_PLUGIN = """
+name = 'batch'
+reported = []
+
+
+def setup(config={}):
+    pass
+
+
+def fetch():
+    return {}
+
+
+def results(batch):
+    reported.append(batch)
+"""
+
+
+DEFER_PLUGIN = """
+name = 'defer'
+defers_results = True
+held = []
+
+
+def setup(config={}):
+    pass
+
+
+def fetch():
+    return {}
+
+
+def results(batch):
+    held.extend(batch)
+"""
+
+
+class TestModuleInputManager(unittest.TestCase):
+    def _manager(self, path):
+        with open(os.path.join(path, 'queued.py'), 'w') as f:
+            f.write(PLUGIN)
+        return input_manager.InputManager(path)
+
+    def test_fetch_empty(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertEqual(im.fetch(), {})
+
+    def test_wakeup(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertFalse(im.wait(0))
+
+            im.plugins['queued']['add']({'id': 1, 'action': 'test'})
+            self.assertTrue(im.wait(0))
+            self.assertEqual(im.fetch(), {'plugin': 'queued',
+                                          'input': {'id': 1,
+                                                    'action': 'test'}})
+
+    def test_weighted_fetch(self):
+        with utils.temporary_directory() as path:
+            for name in ('heavy', 'light'):
+                with open(os.path.join(path, '%s.py' % name), 'w') as f:
+                    f.write(BUSY_PLUGIN % name)
+
+            im = input_manager.InputManager(path, config={
+                'heavy': {'weight': '3'}})
+
+            served = {'heavy': 0, 'light': 0}
+            for x in range(40):
+                served[im.fetch()['plugin']] += 1
+            self.assertEqual(served, {'heavy': 30, 'light': 10})
+
+            stats = im.stats()
+            self.assertEqual(stats['heavy']['served'], 30)
+            self.assertEqual(stats['heavy']['weight'], 3)
+            self.assertEqual(stats['light']['served'], 10)
+            self.assertEqual(stats['light']['depth'], 1)
+            self.assertTrue(stats['light']['wait_max'] >= 0)
+
+    def test_idle_plugin_does_not_bank_credit(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'busy.py'), 'w') as f:
+                f.write(BUSY_PLUGIN % 'busy')
+            im = self._manager(path)
+
+            for x in range(10):
+                self.assertEqual(im.fetch()['plugin'], 'busy')
+
+            # the queued plugin was idle all along, so once it has
+            # work the two should alternate rather than it taking over
+            for x in range(3):
+                im.plugins['queued']['add']({'id': x, 'action': 'test'})
+            plugins = [im.fetch()['plugin'] for x in range(4)]
+            self.assertEqual(sorted(plugins),
+                             ['busy', 'busy', 'queued', 'queued'])
+
+    def test_capacity(self):
+        with utils.temporary_directory() as path:
+            im = self._manager(path)
+            self.assertEqual(im.plugins['queued']['capacity'](), None)
+
+            stats = {'available': 3}
+            im = input_manager.InputManager(path,
+                                            capacity=lambda: stats)
+            self.assertEqual(im.plugins['queued']['capacity'](), stats)
+
+    def test_batched_results(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'batch.py'), 'w') as f:
+                f.write(BATCH_PLUGIN)
+            im = input_manager.InputManager(path, config={
+                'main': {'result_batch_window': '10'}})
+
+            for x in range(3):
+                im.result({'plugin': 'batch',
+                           'input': {'id': x},
+                           'output': {'result_code': 0}})
+
+            # nothing goes out until the window closes or we stop
+            im.stop()
+            reported = im.plugins['batch']['reported']
+            self.assertEqual(len(reported), 1)
+            self.assertEqual([i['id'] for i, o in reported[0]], [0, 1, 2])
+
+    def test_results_after_fork(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'batch.py'), 'w') as f:
+                f.write(BATCH_PLUGIN)
+            im = input_manager.InputManager(path, config={
+                'main': {'result_batch_window': '10'}})
+
+            # as if a handler had forked, leaving the reporter behind
+            im.reporter.pid = -1
+            im.result({'plugin': 'batch',
+                       'input': {'id': 1},
+                       'output': {'result_code': 0}})
+            reported = im.plugins['batch']['reported']
+            self.assertEqual([i['id'] for i, o in reported[0]], [1])
+            self.assertFalse(im.reporter.isAlive())
+            im.stop()
+
+    def test_recover(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'batch.py'), 'w') as f:
+                f.write(BATCH_PLUGIN)
+            jfile = os.path.join(path, 'agent.journal')
+
+            journal = Journal(jfile)
+            journal.open()
+            journal.intake({'plugin': 'batch', 'input': {'id': 1}})
+            journal.intake({'plugin': 'gone', 'input': {'id': 2}})
+            journal.close()
+
+            im = input_manager.InputManager(path, config={
+                'main': {'result_batch_window': '0'}})
+            tasks = im.recover(Journal(jfile))
+            self.assertEqual([t['input'] for t in tasks],
+                             [{'id': 1, 'recovered': True}])
+
+            # reporting a result closes the task in the journal
+            tasks[0]['output'] = {'result_code': 251}
+            im.result(tasks[0])
+            im.stop()
+            im.journal.close()
+
+            journal = Journal(jfile)
+            self.assertEqual(journal.open(), [])
+            journal.close()
+
+    def test_deferred_results(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'defer.py'), 'w') as f:
+                f.write(DEFER_PLUGIN)
+            jfile = os.path.join(path, 'agent.journal')
+
+            journal = Journal(jfile)
+            journal.open()
+            journal.intake({'plugin': 'defer', 'input': {'id': 1}})
+            journal.intake({'plugin': 'defer', 'input': {'id': 2}})
+            journal.close()
+
+            im = input_manager.InputManager(path, config={
+                'main': {'result_batch_window': '0'}})
+            tasks = im.recover(Journal(jfile))
+            for task in tasks:
+                task['output'] = {'result_code': 251}
+                im.result(task)
+            im.stop()
+
+            # only the result the plugin delivered is closed
+            held = im.plugins['defer']['held']
+            self.assertEqual(len(held), 2)
+            im.plugins['defer']['delivered'](held[0][0])
+            im.journal.close()
+
+            journal = Journal(jfile)
+            self.assertEqual([r['input']['id'] for r in journal.open()],
+                             [held[1][0]['id']])
+            journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
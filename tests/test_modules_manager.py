@@ -87,6 +87,91 @@ class TestModuleManager(testtools.TestCase):
             m.load(subdir_path)
             self.assertEqual(self.files_loaded, 2)
 
+    def test_code_cache(self):
+        with utils.temporary_directory() as path:
+            plugin = os.path.join(path, 'plugin.py')
+            with open(plugin, 'w') as f:
+                f.write('name = "cached"\nvalue = 1\n')
+
+            m = manager.Manager(path, {'main': {'cache_dir': path}})
+            ns = m._read_file(plugin)
+            self.assertEqual(ns['value'], 1)
+            self.assertEqual(ns['__file__'], plugin)
+            self.assertTrue('register_action' in ns)
+            self.assertEqual(len(os.listdir(os.path.join(path, 'code'))), 1)
+
+            # the cached code is used while the file looks the same...
+            m._compile_source = None
+            self.assertEqual(m._read_file(plugin)['value'], 1)
+            del m._compile_source
+
+            # ...and not once it changes
+            with open(plugin, 'w') as f:
+                f.write('name = "cached"\nvalue = 22\n')
+            self.assertEqual(m._read_file(plugin)['value'], 22)
+
+    def test_reconfigure(self):
+        with utils.temporary_directory() as path:
+            plugin = os.path.join(path, 'plugin.py')
+            with open(plugin, 'w') as f:
+                f.write("""
+name = 'plugin'
+config_sections = ['endpoints']
+seen = []
+
+
+def setup(config):
+    pass
+
+
+def reconfigure(config):
+    seen.append(dict(config))
+""")
+
+            config = {'main': {}, 'endpoints': {}}
+            m = manager.Manager(path, config)
+            m.load(plugin)
+            seen = m.plugins['plugin']['seen']
+
+            m.reconfigure(['main'])
+            self.assertEqual(seen, [])
+
+            config['plugin'] = {'value': '1'}
+            m.reconfigure(['plugin'])
+            self.assertEqual(seen, [{'value': '1'}])
+            self.assertEqual(m.plugins['plugin']['module_config'],
+                             {'value': '1'})
+
+            m.reconfigure(['endpoints'])
+            self.assertEqual(len(seen), 2)
+
+    def test_setup_failure(self):
+        with utils.temporary_directory() as path:
+            for name in ['a', 'b', 'c']:
+                with open(os.path.join(path, '%s.py' % name), 'w') as f:
+                    f.write("""
+name = '%s'
+
+
+def setup(config):
+    if name == 'b':
+        raise ValueError('banana')
+    global_config['events'].append(('setup', name))
+
+
+def teardown():
+    global_config['events'].append(('teardown', name))
+""" % name)
+
+            # one at a time, so b fails before c is started
+            config = {'main': {'setup_threads': '1'}, 'events': []}
+            m = manager.Manager(path, config)
+            self.assertRaises(ValueError, m.load, path)
+            self.assertEqual(config['events'], [('setup', 'a'),
+                                                ('teardown', 'a')])
+            self.assertEqual(m.plugins, {})
+            self.assertEqual(m.loaded_modules, ['modules'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -24,16 +24,140 @@
 ##############################################################################
 #
 
+import cStringIO
 import fixtures
+import gzip
+import logging
 import os
+import pstats
 import socket
 import testtools
+import threading
+import time
 import unittest
 
 from opencenteragent.modules import output_manager
+from opencenteragent import translog
 from opencenteragent import utils
 
 
+PID_PLUGIN = """
+import os
+import signal
+import time
+
+name = 'pid'
+
+
+def setup(config={}):
+    register_action('pid', handle_pid)
+    register_action('pid_raises', handle_raise)
+    register_action('pid_dies', handle_die)
+    register_action('pid_hangs', handle_hang, timeout=1)
+
+
+def handle_pid(input_data):
+    return {'result_code': 0,
+            'result_str': 'success',
+            'result_data': os.getpid()}
+
+
+def handle_raise(input_data):
+    raise ValueError('banana')
+
+
+def handle_die(input_data):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def handle_hang(input_data):
+    time.sleep(60)
+"""
+
+
+VERSION_PLUGIN = """
+name = 'version'
+version = %d
+
+
+def setup(config={}):
+    if version < 0:
+        raise ValueError('bad version')
+    register_action('version', handle_version)
+
+
+def teardown():
+    global_config['torn_down'].append(version)
+
+
+def handle_version(input_data):
+    global_config['running'].set()
+    global_config['release'].wait(5)
+    return {'result_code': 0,
+            'result_str': 'success',
+            'result_data': version}
+"""
+
+
+CONFIG_PLUGIN = """
+name = 'conf'
+value = None
+
+
+def setup(config={}):
+    global value
+    value = config.get('value')
+    register_action('conf', handle_conf)
+
+
+def handle_conf(input_data):
+    return {'result_code': 0,
+            'result_str': 'success',
+            'result_data': value}
+"""
+
+
+LOG_PLUGIN = """
+name = 'log'
+
+
+def setup(config={}):
+    register_action('log', handle_log)
+
+
+def handle_log(input_data):
+    LOG.warning('logging for %s' % input_data['id'])
+    if 'started' in global_config:
+        # let the other task log, then log again
+        global_config['started'][input_data['id']].set()
+        global_config['started'][3 - input_data['id']].wait(5)
+        LOG.warning('still logging for %s' % input_data['id'])
+    return {'result_code': input_data.get('payload', {}).get('code', 0),
+            'result_str': 'success',
+            'result_data': {}}
+"""
+
+
+WAIT_PLUGIN = """
+name = 'wait%d'
+
+
+def setup(config={}):
+    # each plugin's setup waits for the other's to start
+    global_config['started'][name].set()
+    for event in global_config['started'].values():
+        if not event.wait(5):
+            raise RuntimeError('setups ran one at a time')
+    register_action(name, handle_wait)
+
+
+def handle_wait(input_data):
+    return {'result_code': 0,
+            'result_str': 'success',
+            'result_data': name}
+"""
+
+
 class FakeSocket(object):
     def __init__(self, protocol, transport):
         self.sent = []
@@ -66,7 +190,7 @@ class TestModuleOutputManager(testtools.TestCase):
     def test_register_action_duplicate(self):
         with utils.temporary_directory() as path:
             om = output_manager.OutputManager(path)
-            om.dispatch_table['action'] = {'short_path': 'shortpath',
+            om.dispatch_table['action'] = {'shortpath': 'shortpath',
                                            'method': 'method'}
             self.assertRaises(NameError, om.register_action, 'shortpath',
                               'plugin', 'action', 'method')
@@ -76,6 +200,155 @@ class TestModuleOutputManager(testtools.TestCase):
             om = output_manager.OutputManager(path)
             self.assertTrue(len(om.actions()) > 0)
 
+    def test_limits(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(path)
+            om.config = {'plugin': {'max_concurrency': '2'}}
+            om.register_action('plugin', 'shortpath', 'capped',
+                               self.fake_loadfile, concurrency=1)
+            self.assertEqual(om.limits('capped'),
+                             [(('action', 'capped'), 1),
+                              (('plugin', 'plugin'), 2)])
+            self.assertEqual(om.limits('no.such.action'), [])
+
+    def test_process_execution(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                with open(os.path.join(path, 'pid.py'), 'w') as f:
+                    f.write(PID_PLUGIN)
+
+                om = output_manager.OutputManager(
+                    path, {'main': {'trans_log_dir': logdir},
+                           'pid': {'execution': 'process',
+                                   'processes': '1',
+                                   'max_tasks_per_process': '1'}})
+                try:
+                    out = om.dispatch({'action': 'pid', 'payload': {}})
+                    self.assertEqual(out['result_code'], 0)
+                    first_pid = out['result_data']
+                    self.assertNotEqual(first_pid, os.getpid())
+
+                    # the worker is recycled after every task
+                    out = om.dispatch({'action': 'pid', 'payload': {}})
+                    self.assertNotEqual(out['result_data'], first_pid)
+
+                    out = om.dispatch({'action': 'pid_raises',
+                                       'payload': {}})
+                    self.assertEqual(out['result_code'], 254)
+                    self.assertTrue('banana' in out['result_data'])
+
+                    # nothing is kept about tasks that have returned
+                    pool = om.process_pools['pid']
+                    self.assertEqual(pool.pids, {})
+                    self.assertEqual(pool.outstanding, set())
+                    self.assertTrue(pool.started.empty())
+                finally:
+                    om.stop()
+
+    def test_process_execution_failures(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                with open(os.path.join(path, 'pid.py'), 'w') as f:
+                    f.write(PID_PLUGIN)
+
+                om = output_manager.OutputManager(
+                    path, {'main': {'trans_log_dir': logdir,
+                                    'kill_grace': '0'},
+                           'pid': {'execution': 'process',
+                                   'processes': '1'}})
+                try:
+                    out = om.dispatch({'action': 'pid_dies', 'payload': {}})
+                    self.assertEqual(out['result_code'], 254)
+                    self.assertEqual(out['result_str'],
+                                     'worker process died')
+
+                    # a stuck worker is killed, and replaced
+                    out = om.dispatch({'action': 'pid_hangs',
+                                       'payload': {}})
+                    self.assertEqual(out['result_code'], 252)
+
+                    out = om.dispatch({'action': 'pid', 'payload': {}})
+                    self.assertEqual(out['result_code'], 0)
+                finally:
+                    om.stop()
+
+    def test_process_reload(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                plugin = os.path.join(path, 'version.py')
+                with open(plugin, 'w') as f:
+                    f.write(VERSION_PLUGIN % 1)
+
+                config = {'main': {'trans_log_dir': logdir},
+                          'version': {'execution': 'process',
+                                      'processes': '1',
+                                      'max_tasks_per_process': '0'},
+                          'torn_down': [],
+                          'running': threading.Event(),
+                          'release': threading.Event()}
+                config['release'].set()
+                om = output_manager.OutputManager(path, config)
+                try:
+                    pool = om.process_pools['version']
+                    out = om.dispatch({'action': 'version'})
+                    self.assertEqual(out['result_data'], 1)
+
+                    with open(plugin, 'w') as f:
+                        f.write(VERSION_PLUGIN % 2)
+                    om.handle_modules({'action': 'modules.reload',
+                                       'payload': {'plugins': ['version']}})
+
+                    # the same workers load the new code
+                    self.assertTrue(om.process_pools['version'] is pool)
+                    out = om.dispatch({'action': 'version'})
+                    self.assertEqual(out['result_data'], 2)
+                finally:
+                    om.stop()
+
+    def test_process_reconfigure(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                with open(os.path.join(path, 'conf.py'), 'w') as f:
+                    f.write(CONFIG_PLUGIN)
+
+                config = {'main': {'trans_log_dir': logdir},
+                          'conf': {'execution': 'process',
+                                   'processes': '1',
+                                   'max_tasks_per_process': '0',
+                                   'value': 'old'}}
+                om = output_manager.OutputManager(path, config)
+                try:
+                    out = om.dispatch({'action': 'conf'})
+                    self.assertEqual(out['result_data'], 'old')
+
+                    # the workers pick up the change too
+                    config['conf'] = dict(config['conf'], value='new')
+                    om.reconfigure(['conf'])
+                    out = om.dispatch({'action': 'conf'})
+                    self.assertEqual(out['result_data'], 'new')
+                finally:
+                    om.stop()
+
+    def test_coalesce_key(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(path)
+            om.register_action('plugin', 'shortpath', 'unique',
+                               self.fake_loadfile)
+
+            self.assertEqual(om.coalesce_key({'action': 'unique',
+                                              'payload': {}}), None)
+            self.assertEqual(om.coalesce_key({'action': 'no.such.action'}),
+                             None)
+
+            key = om.coalesce_key({'action': 'modules.list', 'id': 1,
+                                   'payload': {'a': 1, 'b': 2}})
+            self.assertEqual(key, om.coalesce_key(
+                {'action': 'modules.list', 'id': 2,
+                 'payload': {'b': 2, 'a': 1}}))
+            self.assertNotEqual(key, om.coalesce_key(
+                {'action': 'modules.list', 'id': 3,
+                 'payload': {'a': 2, 'b': 2}}))
+
     def test_handle_modules_list(self):
         with utils.temporary_directory() as path:
             om = output_manager.OutputManager(path)
@@ -98,6 +371,65 @@ class TestModuleOutputManager(testtools.TestCase):
                              'opencenter_agent_actions')
             self.assertTrue('value' in out['result_data'])
 
+    def test_profiling(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                with open(os.path.join(path, 'pid.py'), 'w') as f:
+                    f.write(PID_PLUGIN)
+                om = output_manager.OutputManager(
+                    path, {'main': {'trans_log_dir': logdir,
+                                    'profile_actions': 'pid_raises'}})
+
+                def prof(task_id):
+                    return utils.trans_log_path(om.config, task_id, 'prof')
+
+                om.dispatch({'action': 'pid', 'id': 1, 'payload': {}})
+                self.assertFalse(os.path.exists(prof(1)))
+
+                om.dispatch({'action': 'pid', 'id': 2,
+                             'payload': {'profile': True}})
+                stats = pstats.Stats(prof(2))
+                self.assertTrue([f for f in stats.stats
+                                 if f[2] == 'handle_pid'])
+
+                # a profile is still written when the action blows up
+                self.assertRaises(ValueError, om.dispatch,
+                                  {'action': 'pid_raises', 'id': 3,
+                                   'payload': {}})
+                self.assertTrue(os.path.exists(prof(3)))
+
+                sock = FakeSocket(socket.AF_INET, socket.SOCK_STREAM)
+                out = om.handle_logfile({'action': 'logfile.tail',
+                                         'payload': {'task_id': 2,
+                                                     'type': 'prof',
+                                                     'dest_ip': '127.0.0.1',
+                                                     'dest_port': 4242}},
+                                        sock=sock)
+                self.assertEqual(out['result_code'], 0)
+                with open(prof(2), 'rb') as f:
+                    self.assertEqual(''.join(sock.sent), f.read())
+
+    def test_handle_stats(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(path)
+            out = om.dispatch({'action': 'no.such.action'})
+            self.assertEqual(out['result_code'], 253)
+            out = om.handle_stats({'action': 'agent.stats'})
+            self.assertEqual(out['result_code'], 0)
+            self.assertTrue(
+                out['result_data']['counters']['action.unknown'] >= 1)
+
+    def test_dispatch_none_result(self):
+        with utils.temporary_directory() as path:
+            om = output_manager.OutputManager(
+                path, {'main': {'trans_log_dir': path}})
+            om.register_action('plugin', 'shortpath', 'nothing',
+                               self.fake_nothing)
+            self.assertEqual(om.dispatch({'action': 'nothing'}), None)
+
+    def fake_nothing(self, input_data):
+        return None
+
     def fake_loadfile(self, path):
         self.loadfile_calls += 1
 
@@ -137,6 +469,216 @@ class TestModuleOutputManager(testtools.TestCase):
             self.assertEqual(out['result_code'], 0)
             self.assertEqual(out['result_str'], 'success')
 
+    def test_reload(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                plugin = os.path.join(path, 'version.py')
+                with open(plugin, 'w') as f:
+                    f.write(VERSION_PLUGIN % 1)
+
+                config = {'main': {'trans_log_dir': logdir},
+                          'torn_down': [],
+                          'running': threading.Event(),
+                          'release': threading.Event()}
+                om = output_manager.OutputManager(path, config)
+
+                # a task that's already running when we reload
+                result = []
+                t = threading.Thread(target=lambda: result.append(
+                    om.dispatch({'action': 'version'})))
+                t.start()
+                config['running'].wait(5)
+
+                with open(plugin, 'w') as f:
+                    f.write(VERSION_PLUGIN % 2)
+                reloader = threading.Thread(
+                    target=om.handle_modules,
+                    args=({'action': 'modules.reload',
+                           'payload': {'plugins': ['version']}},))
+                reloader.start()
+
+                # the new code is live before the old is torn down
+                while om.plugins['version']['version'] != 2:
+                    reloader.join(0.01)
+                self.assertEqual(config['torn_down'], [])
+
+                config['release'].set()
+                t.join()
+                reloader.join()
+                for retire in om.retiring:
+                    retire.join()
+                self.assertEqual(result[0]['result_data'], 1)
+                self.assertEqual(config['torn_down'], [1])
+                self.assertEqual(
+                    om.dispatch({'action': 'version'})['result_data'], 2)
+
+                # a plugin that fails to set up leaves the old in place
+                with open(plugin, 'w') as f:
+                    f.write(VERSION_PLUGIN % -1)
+                self.assertRaises(ValueError, om.reload)
+                self.assertEqual(
+                    om.dispatch({'action': 'version'})['result_data'], 2)
+                self.assertEqual(om.loaded_modules.count('version'), 1)
+
+                out = om.handle_modules({'action': 'modules.reload',
+                                         'payload': {'plugins': ['nope']}})
+                self.assertEqual(out['result_code'], 1)
+
+    def test_loadfile(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as plugins:
+                om = output_manager.OutputManager(plugins)
+                self.assertFalse('pid' in om.dispatch_table)
+
+                plugin = os.path.join(path, 'pid.py')
+                with open(plugin, 'w') as f:
+                    f.write(PID_PLUGIN)
+                out = om.handle_modules({'action': 'modules.load',
+                                         'payload': {'path': plugin}})
+                self.assertEqual(out['result_code'], 0)
+                self.assertTrue('pid' in om.dispatch_table)
+                self.assertTrue('pid' in om.loaded_modules)
+
+    def test_lazy_load(self):
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as cache:
+                plugin = os.path.join(path, 'pid.py')
+                with open(plugin, 'w') as f:
+                    f.write(PID_PLUGIN)
+
+                config = {'main': {'trans_log_dir': cache,
+                                   'cache_dir': cache}}
+                om = output_manager.OutputManager(path, config)
+                self.assertTrue('pid' in om.plugins)
+                self.assertTrue(os.path.exists(om.manifest_path))
+
+                # the second time round, the plugin isn't loaded until
+                # one of its actions is dispatched
+                om = output_manager.OutputManager(path, config)
+                self.assertFalse('pid' in om.plugins)
+                self.assertTrue('pid' in om.loaded_modules)
+                self.assertEqual(om.actions()['pid_raises']['plugin'],
+                                 'pid')
+                out = om.dispatch({'action': 'pid', 'payload': {}})
+                self.assertEqual(out['result_data'], os.getpid())
+                self.assertTrue('pid' in om.plugins)
+                self.assertEqual(om.lazy, {})
+
+                # a changed file is loaded up front again
+                with open(plugin, 'a') as f:
+                    f.write('\n')
+                om = output_manager.OutputManager(path, config)
+                self.assertTrue('pid' in om.plugins)
+
+                # as is everything, if the config changes
+                config['pid'] = {'lazy_load': 'no'}
+                om = output_manager.OutputManager(path, config)
+                self.assertTrue('pid' in om.plugins)
+                om = output_manager.OutputManager(path, config)
+                self.assertTrue('pid' in om.plugins)
+
+    def test_trans_log(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'log.py'), 'w') as f:
+                f.write(LOG_PLUGIN)
+
+            om = output_manager.OutputManager(
+                path, {'main': {'trans_log_dir': path}})
+            out = om.dispatch({'id': 42, 'action': 'log'})
+            self.assertEqual(out['result_code'], 0)
+
+            # the log is complete once the task is done, and the
+            # task's logger is gone
+            with open(utils.trans_log_path(om.config, 42)) as f:
+                self.assertEqual(f.read(), 'logging for 42\n')
+            self.assertFalse('opencenter.output.trans_42' in
+                             logging.Logger.manager.loggerDict)
+
+            # a task run from within another leaves the outer task's
+            # logger in place
+            outer = logging.Logger('outer')
+            translog.set_logger(outer)
+            try:
+                om.dispatch({'id': 43, 'action': 'log'})
+                self.assertTrue(translog.current_logger() is outer)
+            finally:
+                translog.set_logger(None)
+
+    def test_concurrent_trans_logs(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'log.py'), 'w') as f:
+                f.write(LOG_PLUGIN)
+
+            config = {'main': {'trans_log_dir': path},
+                      'started': {1: threading.Event(),
+                                  2: threading.Event()}}
+            om = output_manager.OutputManager(path, config)
+            threads = [threading.Thread(target=om.dispatch,
+                                        args=({'id': x, 'action': 'log'},))
+                       for x in (1, 2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for x in (1, 2):
+                with open(utils.trans_log_path(config, x)) as f:
+                    self.assertEqual(f.read(),
+                                     'logging for %d\nstill logging for %d\n'
+                                     % (x, x))
+
+    def test_trans_log_memory(self):
+        with utils.temporary_directory() as path:
+            with open(os.path.join(path, 'log.py'), 'w') as f:
+                f.write(LOG_PLUGIN)
+
+            om = output_manager.OutputManager(
+                path, {'main': {'trans_log_dir': path,
+                                'trans_log_memory': 64}})
+
+            # successful tasks' logs are dropped, failed ones kept
+            out = om.dispatch({'id': 1, 'action': 'log'})
+            self.assertEqual(out['result_code'], 0)
+            self.assertFalse(os.path.exists(utils.trans_log_path(om.config,
+                                                                 1)))
+
+            out = om.dispatch({'id': 2, 'action': 'log',
+                               'payload': {'code': 1}})
+            self.assertEqual(out['result_code'], 1)
+            with open(utils.trans_log_path(om.config, 2)) as f:
+                self.assertEqual(f.read(), 'logging for 2\n')
+
+            # a running task's log is tailed from memory
+            log = translog.TransLogBuffer(utils.trans_log_path(om.config, 3),
+                                          1024)
+            log.write('in memory\n')
+            sock = FakeSocket(socket.AF_INET, socket.SOCK_STREAM)
+            out = om.handle_logfile({'action': 'logfile.tail',
+                                     'payload': {'task_id': 3,
+                                                 'dest_ip': '127.0.0.1',
+                                                 'dest_port': 4242}},
+                                    sock=sock)
+            self.assertEqual(out['result_code'], 0)
+            self.assertEqual(''.join(sock.sent), 'in memory\n')
+            self.assertFalse(log.close())
+
+    def test_parallel_setup(self):
+        with utils.temporary_directory() as path:
+            for x in range(2):
+                with open(os.path.join(path, 'wait%d.py' % x), 'w') as f:
+                    f.write(WAIT_PLUGIN % x)
+
+            config = {'main': {'setup_threads': '2'},
+                      'started': {'wait0': threading.Event(),
+                                  'wait1': threading.Event()}}
+            om = output_manager.OutputManager(path, config)
+            self.assertTrue('wait0' in om.dispatch_table)
+            self.assertTrue('wait1' in om.dispatch_table)
+
+            gauges = om.handle_stats({})['result_data']['gauges']
+            self.assertTrue('wait0' in gauges['plugin.setup_time'])
+            self.assertTrue('wait1' in gauges['plugin.import_time'])
+
     def test_xter_to_eof(self):
         class FileLikeObject(object):
             def __init__(self, good_reads):
@@ -174,6 +716,47 @@ class TestModuleOutputManager(testtools.TestCase):
         s = ExceptionalSocketLikeObject()
         self.assertFalse(output_manager._xfer_to_eof(f, s))
 
+    def test_xfer_to_eof_partial_sends(self):
+        class TrickleSocket(FakeSocket):
+            def send(self, data):
+                self.sent.append(data[:100])
+                return len(self.sent[-1])
+
+        f = cStringIO.StringIO('x' * 100000)
+        s = TrickleSocket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(output_manager._xfer_to_eof(f, s), 100000)
+        self.assertEqual(''.join(s.sent), 'x' * 100000)
+
+    def test_xfer_to_eof_slow_reader(self):
+        with utils.temporary_directory() as path:
+            size = 4 * 1024 * 1024
+            with open(os.path.join(path, 'log'), 'w') as f:
+                f.write('skipped\n' + 'x' * size)
+
+            # as the agent's sockets are, with a default timeout.  the
+            # send buffer fills up well before the reader catches up.
+            ours, theirs = socket.socketpair()
+            ours.settimeout(30)
+            received = []
+
+            def reader():
+                while True:
+                    time.sleep(0.001)
+                    data = theirs.recv(65536)
+                    if not data:
+                        break
+                    received.append(data)
+
+            t = threading.Thread(target=reader)
+            t.start()
+            with open(os.path.join(path, 'log'), 'rb') as f:
+                f.seek(8)
+                self.assertEqual(output_manager._xfer_to_eof(f, ours), size)
+            ours.close()
+            t.join(30)
+            theirs.close()
+            self.assertEqual(len(''.join(received)), size)
+
     def test_handle_logfile_no_payload(self):
         with utils.temporary_directory() as path:
             om = output_manager.OutputManager(path)
@@ -236,6 +819,28 @@ class TestModuleOutputManager(testtools.TestCase):
                 self.assertEqual(out['result_code'], 0)
                 self.assertNotEqual(sock.sent, [])
 
+    def test_handle_logfile_compressed(self):
+        sock = FakeSocket(socket.AF_INET, socket.SOCK_STREAM)
+        with utils.temporary_directory() as path:
+            with utils.temporary_directory() as logdir:
+                om = output_manager.OutputManager(path)
+                om.config = {'main': {'trans_log_dir': logdir}}
+
+                # as left behind by an older agent
+                f = gzip.open(os.path.join(logdir, 'trans_42.log.gz'), 'wb')
+                f.write('This\nis\na\nlog\nfile')
+                f.close()
+
+                out = om.handle_logfile({'action': 'logfile.tail',
+                                         'payload': {'task_id': '42',
+                                                     'dest_ip': '127.0.0.1',
+                                                     'dest_port': 4242,
+                                                     'offset': 1024}},
+                                        sock=sock)
+                self.assertEqual(out['result_code'], 0)
+                self.assertEqual(''.join(sock.sent), 'This\nis\na\nlog\nfile')
+                self.assertEqual(out['result_data'], {'bytes': 18})
+
     def test_handle_logfile_tail_socket_fail(self):
         self.useFixture(fixtures.MonkeyPatch('socket.socket',
                                              FakeSocketSendFails))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import threading
+import time
+import unittest
+
+from opencenteragent.pool import DispatchPool
+
+
+class TestDispatchPool(unittest.TestCase):
+    def test_put_get_done(self):
+        pool = DispatchPool(2, 4)
+        self.assertTrue(pool.put('a'))
+        self.assertEqual(pool.stats()['queued'], 1)
+
+        self.assertEqual(pool.stats()['available'], 1)
+
+        data, limits, key = pool.get()
+        self.assertEqual(data, 'a')
+        self.assertEqual(pool.stats()['busy'], 1)
+        self.assertEqual(pool.stats()['queued'], 0)
+        self.assertEqual(pool.stats()['available'], 1)
+
+        pool.put('b')
+        pool.put('c')
+        self.assertEqual(pool.stats()['available'], 0)
+        pool.get()
+        pool.get()
+
+        pool.done(limits)
+        pool.done(limits)
+        pool.done(limits)
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertEqual(pool.stats()['available'], 2)
+
+    def test_limits_skip_capped_jobs(self):
+        pool = DispatchPool(4, 4)
+        pool.put('chef1', [('chef', 1)])
+        pool.put('chef2', [('chef', 1)])
+        pool.put('other', [('other', None)])
+
+        first = pool.get()
+        self.assertEqual(first[0], 'chef1')
+
+        # chef2 is over its cap, so the next job handed out is other
+        second = pool.get()
+        self.assertEqual(second[0], 'other')
+        self.assertEqual(pool.stats()['queued'], 1)
+
+        pool.done(first[1])
+        third = pool.get()
+        self.assertEqual(third[0], 'chef2')
+
+    def test_put_blocks_when_full(self):
+        pool = DispatchPool(1, 1)
+        pool.put('a')
+        finished = threading.Event()
+
+        def producer():
+            pool.put('b')
+            finished.set()
+
+        t = threading.Thread(target=producer)
+        t.setDaemon(True)
+        t.start()
+
+        finished.wait(0.2)
+        self.assertFalse(finished.isSet())
+
+        pool.get()
+        finished.wait(5)
+        self.assertTrue(finished.isSet())
+
+    def test_coalesce(self):
+        pool = DispatchPool(2, 4)
+        pool.put('a1', key='a')
+        pool.put('b', key='b')
+        pool.put('a2', key='a')
+        self.assertEqual(pool.stats()['queued'], 2)
+
+        job = pool.get()
+        self.assertEqual(job[0], 'a1')
+        self.assertEqual(job[2], 'a')
+
+        # a1 is running, so these are queued afresh, together
+        pool.put('a3', key='a')
+        pool.put('a4', key='a')
+        self.assertEqual(pool.stats()['queued'], 2)
+
+        # but a3 can't start until a1 is done
+        job = pool.get()
+        self.assertEqual(job[0], 'b')
+        self.assertEqual(pool.detach('a'), ['a2'])
+        job = pool.get()
+        self.assertEqual(job[0], 'a3')
+        self.assertEqual(pool.detach('a'), ['a4'])
+        self.assertEqual(pool.detach(None), [])
+
+    def test_stop(self):
+        pool = DispatchPool(1, 1)
+        pool.stop()
+        self.assertEqual(pool.get(), None)
+        self.assertFalse(pool.put('a'))
+
+    def test_workers(self):
+        pool = DispatchPool(3, 10)
+        seen = []
+        seen_lock = threading.Lock()
+        all_done = threading.Event()
+
+        class Worker(threading.Thread):
+            def __init__(self, pool):
+                super(Worker, self).__init__()
+                self.pool = pool
+
+            def run(self):
+                while True:
+                    job = self.pool.get()
+                    if job is None:
+                        break
+                    seen_lock.acquire()
+                    seen.append(job[0])
+                    if len(seen) == 10:
+                        all_done.set()
+                    seen_lock.release()
+                    self.pool.done(job[1])
+
+        pool.start(Worker)
+        self.assertEqual(len(pool.workers), 3)
+        for x in range(10):
+            pool.put(x)
+
+        all_done.wait(5)
+        self.assertEqual(sorted(seen), range(10))
+        pool.stop()
+
+    def test_resize(self):
+        pool = DispatchPool(2, 2)
+        exited = []
+
+        class Worker(threading.Thread):
+            def __init__(self, pool):
+                super(Worker, self).__init__()
+                self.pool = pool
+
+            def run(self):
+                while self.pool.get() is not None:
+                    pass
+                exited.append(self)
+
+        pool.start(Worker)
+        pool.resize(4, 8)
+        self.assertEqual(len(pool.workers), 4)
+        self.assertEqual(pool.stats()['max_queued'], 8)
+
+        # surplus workers drop out
+        workers = list(pool.workers)
+        pool.resize(1)
+        deadline = time.time() + 5
+        while len(pool.workers) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(pool.workers), 1)
+        for worker in workers:
+            if not worker in pool.workers:
+                worker.join(5)
+                self.assertFalse(worker.isAlive())
+        self.assertEqual(len(exited), 3)
+
+        pool.stop()
+        pool.workers[0].join(5)
+        self.assertEqual(len(exited), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
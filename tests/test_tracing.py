@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+
+import os
+import unittest
+
+from opencenteragent import tracing
+from opencenteragent import translog
+from opencenteragent import utils
+
+
+class TestTracing(unittest.TestCase):
+    def test_summary(self):
+        trace = tracing.Trace([('claim', 10.0, 10.5)])
+        trace.add('queue', 11.0, 11.25)
+        summary = trace.summary()
+        self.assertEqual(summary['total'], 1.25)
+        self.assertEqual(summary['spans'],
+                         [{'name': 'claim', 'offset': 0, 'duration': 0.5},
+                          {'name': 'queue', 'offset': 1, 'duration': 0.25}])
+
+    def test_current_span(self):
+        # no current trace, nothing happens
+        with tracing.span('nothing'):
+            pass
+
+        trace = tracing.Trace()
+        tracing.begin(trace)
+        try:
+            with tracing.span('outer'):
+                with tracing.span('inner'):
+                    pass
+        finally:
+            tracing.end()
+
+        self.assertEqual([x[0] for x in trace.spans], ['inner', 'outer'])
+        self.assertEqual(tracing.current(), None)
+
+    def test_write(self):
+        with utils.temporary_directory() as path:
+            logfile = os.path.join(path, 'trans_1.log')
+            trace = tracing.Trace([('claim', 10.0, 10.5)], logfile)
+            trace.write()
+            trace.add('report', 11.0, 12.0)
+            trace.write()
+            trace.write()
+            translog.writer.close(logfile)
+
+            with open(logfile) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[0].startswith('trace: claim'))
+            self.assertTrue('1.000s' in lines[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import gzip
+import logging
+import os
+import subprocess
+import time
+import unittest
+
+from opencenteragent import translog
+from opencenteragent import utils
+
+
+class TestTransLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.writer = translog.TransLogWriter(max_open=2)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_write(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            with open(log, 'w') as f:
+                f.write('old run\n')
+
+            self.writer.begin(log)
+            self.writer.write(log, 'one\n')
+            self.writer.write(log, u'two\n')
+            self.writer.close(log)
+            self.assertEqual(self.read(log), 'one\ntwo\n')
+            self.assertEqual(self.writer.stats()['open'], 0)
+
+            # later writes append
+            self.writer.write(log, 'three\n')
+            self.writer.flush()
+            self.assertEqual(self.read(log), 'one\ntwo\nthree\n')
+
+    def test_max_open(self):
+        with utils.temporary_directory() as path:
+            logs = [os.path.join(path, 'trans_%d.log' % x) for x in range(4)]
+            for log in logs:
+                self.writer.write(log, 'data\n')
+            self.writer.flush()
+            self.assertEqual(self.writer.stats()['open'], 2)
+
+            for log in logs:
+                self.assertEqual(self.read(log), 'data\n')
+
+    def test_acquire(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            self.writer.write(log, 'before\n')
+
+            # everything queued is written before the fd is handed out
+            fd = self.writer.acquire(log)
+            self.assertEqual(self.read(log), 'before\n')
+            os.write(fd, 'script\n')
+
+            # a held log isn't closed to make room for others
+            for x in range(3):
+                self.writer.write(os.path.join(path, 'other%d' % x), 'x')
+            self.writer.close(log)
+            self.writer.flush()
+            os.write(fd, 'more\n')
+
+            self.writer.release(log)
+            self.assertEqual(self.read(log), 'before\nscript\nmore\n')
+
+    def test_stopped(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            self.writer.write(log, 'queued\n')
+            self.writer.stop()
+
+            # anything after the writer has stopped is written directly
+            self.writer.write(log, 'late\n')
+            self.writer.close(log)
+            self.assertEqual(self.read(log), 'queued\nlate\n')
+
+    def test_acquire_past_max_open(self):
+        with utils.temporary_directory() as path:
+            logs = [os.path.join(path, 'trans_%d.log' % x) for x in range(3)]
+            fds = [self.writer.acquire(log) for log in logs]
+            for fd, log in zip(fds, logs):
+                os.write(fd, log)
+            self.assertEqual(self.writer.stats()['open'], 3)
+
+            # the extra log is closed once it's released
+            for log in logs:
+                self.writer.release(log)
+            self.assertEqual(self.writer.stats()['open'], 2)
+            for log in logs:
+                self.assertEqual(self.read(log), log)
+
+    def test_handler(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            handler = translog.TransLogHandler(log, self.writer)
+            logger = logging.Logger('test')
+            logger.addHandler(handler)
+            logger.warning('hello %s', 'there')
+
+            fd = handler.open_fd()
+            os.write(fd, 'script\n')
+            handler.close_fd(fd)
+            self.assertEqual(self.read(log), 'hello there\nscript\n')
+
+            handler = translog.TransLogHandler(
+                os.path.join(log, 'trans_2.log'), self.writer)
+            self.assertEqual(handler.open_fd(), None)
+
+
+class TestTransLogBuffer(unittest.TestCase):
+    def setUp(self):
+        self.writer = translog.TransLogWriter()
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_dropped(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            buf = translog.TransLogBuffer(log, 1024, self.writer)
+            self.assertTrue(translog.live_buffer(log) is buf)
+
+            buf.write('one\n')
+            buf.write(u'two\n')
+            self.assertEqual(buf.getvalue(), 'one\ntwo\n')
+            self.assertFalse(buf.close())
+            self.assertFalse(os.path.exists(log))
+            self.assertEqual(translog.live_buffer(log), None)
+
+    def test_spill(self):
+        with utils.temporary_directory() as path:
+            # too big
+            log = os.path.join(path, 'trans_1.log')
+            buf = translog.TransLogBuffer(log, 8, self.writer)
+            buf.write('one\n')
+            buf.write('two\n')
+            buf.write('three\n')
+            self.assertEqual(buf.getvalue(), None)
+            self.assertTrue(buf.close())
+            self.assertEqual(self.read(log), 'one\ntwo\nthree\n')
+
+            # failed
+            log = os.path.join(path, 'trans_2.log')
+            buf = translog.TransLogBuffer(log, 1024, self.writer)
+            buf.write('failing\n')
+            self.assertTrue(buf.close(keep=True))
+            self.assertEqual(self.read(log), 'failing\n')
+
+            # asked for
+            log = os.path.join(path, 'trans_3.log')
+            buf = translog.TransLogBuffer(log, 1024, self.writer)
+            buf.write('before\n')
+            translog.spill(log, 'test')
+            buf.write('after\n')
+            self.assertTrue(buf.close())
+            self.assertEqual(self.read(log), 'before\nafter\n')
+
+    def test_script_output(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            buf = translog.TransLogBuffer(log, 1024, self.writer)
+            handler = translog.TransLogHandler(log, self.writer, buffer=buf)
+            logger = logging.Logger('test')
+            logger.addHandler(handler)
+            logger.warning('starting')
+
+            fd = handler.open_fd()
+            os.write(fd, 'script\n')
+            handler.close_fd(fd)
+            self.assertTrue(buf.close(keep=True))
+            self.assertEqual(self.read(log), 'starting\nscript\n')
+
+    def test_script_left_running(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            buf = translog.TransLogBuffer(log, 1024, self.writer)
+
+            fd = buf.acquire()
+            subprocess.call(['sh', '-c', 'echo hi; sleep 5 &'],
+                            stdout=fd)
+            buf.release(fd)
+
+            # the background sleep holding the pipe isn't waited for
+            start = time.time()
+            self.assertTrue(buf.close(keep=True))
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertFalse([pump for pump in buf.pumps
+                              if pump.isAlive()])
+            self.assertEqual(self.read(log), 'hi\n')
+
+    def test_script_left_writing(self):
+        with utils.temporary_directory() as path:
+            log = os.path.join(path, 'trans_1.log')
+            buf = translog.TransLogBuffer(log, 1024 * 1024, self.writer)
+
+            fd = buf.acquire()
+            script = subprocess.Popen(['sh', '-c', 'yes &'], stdout=fd)
+            script.wait()
+            buf.release(fd)
+
+            # output that never lets up doesn't keep the log open
+            start = time.time()
+            buf.close(keep=True)
+            self.assertTrue(time.time() - start < 3)
+            self.assertFalse([pump for pump in buf.pumps
+                              if pump.isAlive()])
+
+
+class TestTransLogJanitor(unittest.TestCase):
+    def make(self, path, age, size=10):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        when = time.time() - age
+        os.utime(path, (when, when))
+        return path
+
+    def test_sweep(self):
+        with utils.temporary_directory() as path:
+            config = {'main': {'trans_log_dir': path}}
+            recent = self.make(utils.trans_log_path(config, 1), 10)
+            idle = self.make(utils.trans_log_path(config, 2), 7200)
+            old = self.make(utils.trans_log_path(config, 3, 'prof'), 90000)
+            flat = self.make(os.path.join(path, 'trans_4.log'), 7200)
+            journal = self.make(os.path.join(path, 'agent.journal'), 90000)
+
+            janitor = translog.TransLogJanitor(path, compress_after=3600,
+                                               max_age=86400)
+            janitor.sweep()
+
+            self.assertTrue(os.path.exists(recent))
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(journal))
+            for log in (idle, flat):
+                self.assertFalse(os.path.exists(log))
+                f = gzip.open(log + '.gz')
+                self.assertEqual(f.read(), 'x' * 10)
+                f.close()
+
+                # compressed logs keep their age
+                self.assertTrue(os.stat(log + '.gz').st_mtime <
+                                time.time() - 3600)
+
+    def test_max_size(self):
+        with utils.temporary_directory() as path:
+            config = {'main': {'trans_log_dir': path}}
+            logs = [self.make(utils.trans_log_path(config, x), 100 - x, 100)
+                    for x in range(5)]
+
+            janitor = translog.TransLogJanitor(path, compress_after=0,
+                                               max_size=250)
+            janitor.sweep()
+            self.assertEqual([os.path.exists(log) for log in logs],
+                             [False, False, False, True, True])
+
+    def test_open_logs(self):
+        with utils.temporary_directory() as path:
+            config = {'main': {'trans_log_dir': path}}
+            log = self.make(utils.trans_log_path(config, 1), 90000, 100)
+            writer = translog.TransLogWriter()
+            try:
+                writer.acquire(log)
+                janitor = translog.TransLogJanitor(path, max_age=86400,
+                                                   max_size=50,
+                                                   log_writer=writer)
+                janitor.sweep()
+                self.assertTrue(os.path.exists(log))
+
+                writer.release(log)
+                writer.close(log)
+                janitor.sweep()
+                self.assertFalse(os.path.exists(log))
+            finally:
+                writer.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,8 @@
 
 import logging
 import os
+import threading
+import time
 import unittest
 
 from opencenteragent import utils
@@ -69,5 +71,51 @@ class TestTemporaryFiles(unittest.TestCase):
         self.assertFalse(os.path.exists(path))
 
 
+class TestTransLogPaths(unittest.TestCase):
+    def test_find_trans_log(self):
+        with utils.temporary_directory() as path:
+            config = {'main': {'trans_log_dir': path}}
+            log = utils.trans_log_path(config, 42)
+            self.assertEqual(os.path.dirname(os.path.dirname(log)), path)
+            self.assertEqual(os.path.basename(log), 'trans_42.log')
+            self.assertEqual(utils.find_trans_log(config, 42), None)
+
+            # older agents' logs are found, compressed or not
+            flat = os.path.join(path, 'trans_42.log')
+            for candidate in (flat + '.gz', flat, log + '.gz'):
+                if not os.path.isdir(os.path.dirname(candidate)):
+                    os.mkdir(os.path.dirname(candidate))
+                open(candidate, 'w').close()
+                self.assertEqual(utils.find_trans_log(config, 42), candidate)
+
+
+class TestWakeup(unittest.TestCase):
+    def test_wait_times_out(self):
+        w = utils.Wakeup()
+        self.assertFalse(w.wait(0.01))
+        w.close()
+
+    def test_notify_before_wait(self):
+        w = utils.Wakeup()
+        w.notify()
+        w.notify()
+        self.assertTrue(w.wait(0))
+
+        # multiple notifies collapse into a single wakeup
+        self.assertFalse(w.wait(0))
+        w.close()
+
+    def test_notify_from_thread(self):
+        w = utils.Wakeup()
+        t = threading.Timer(0.05, w.notify)
+        t.start()
+
+        start = time.time()
+        self.assertTrue(w.wait(5))
+        self.assertTrue(time.time() - start < 5)
+        t.join()
+        w.close()
+
+
 if __name__ == '__main__':
     unittest.main()
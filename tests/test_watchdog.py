@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#               OpenCenter(TM) is Copyright 2013 by Rackspace US, Inc.
+##############################################################################
+#
+# OpenCenter is licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  This
+# version of OpenCenter includes Rackspace trademarks and logos, and in
+# accordance with Section 6 of the License, the provision of commercial
+# support services in conjunction with a version of OpenCenter which includes
+# Rackspace trademarks and logos is prohibited.  OpenCenter source code and
+# details are available at: # https://github.com/rcbops/opencenter or upon
+# written request.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0 and a copy, including this
+# notice, is available in the LICENSE file accompanying this software.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the # specific language governing permissions and limitations
+# under the License.
+#
+##############################################################################
+#
+
+import os
+import subprocess
+import threading
+import time
+import unittest
+
+from opencenteragent import watchdog
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.wd = watchdog.Watchdog(kill_grace=0.1)
+        self.wd.start()
+        self.expired = threading.Event()
+
+    def tearDown(self):
+        self.wd.stop()
+
+    def test_release_in_time(self):
+        watch = self.wd.watch(5, self.expired.set)
+        self.assertTrue(self.wd.release(watch))
+        self.assertFalse(self.expired.isSet())
+
+    def test_expire(self):
+        watch = self.wd.watch(0.05, self.expired.set)
+        self.expired.wait(5)
+        self.assertTrue(self.expired.isSet())
+        self.assertFalse(self.wd.release(watch))
+
+    def test_expire_kills_children(self):
+        proc = subprocess.Popen(['sleep', '30'], preexec_fn=os.setpgrp)
+        watch = self.wd.watch(0.05, self.expired.set)
+        watchdog.register_child(proc.pid)
+
+        self.expired.wait(5)
+        self.assertTrue(self.expired.isSet())
+
+        start = time.time()
+        while proc.poll() is None and time.time() - start < 5:
+            time.sleep(0.01)
+        self.assertNotEqual(proc.returncode, None)
+        watchdog.unregister_child(proc.pid)
+        self.assertFalse(self.wd.release(watch))
+
+    def test_register_without_watch(self):
+        # outside of a watched task this is a no-op
+        watchdog.register_child(1)
+        watchdog.unregister_child(1)
+
+
+if __name__ == '__main__':
+    unittest.main()